@@ -688,6 +688,22 @@ queue.put = function(space, tube, ...)
     return put_task(space, tube, queue.default.ipri, ...)
 end
 
+-- queue.put_batch(space, tube, delay, ttl, ttr, pri, data, delay, ttl, ttr, pri, data, ...)
+--  put several tasks in one call, every task is five arguments like in
+--  queue.put but with a single data field. Returns the tasks after they
+--  are written.
+queue.put_batch = function(space, tube, ...)
+    space = tonumber(space)
+    local args = {...}
+    local tasks = {}
+    for i = 1, #args, 5 do
+        queue.stat[space][tube]:inc('put')
+        table.insert(tasks, put_task(space, tube, queue.default.ipri,
+            args[i], args[i + 1], args[i + 2], args[i + 3], args[i + 4]))
+    end
+    return unpack(tasks)
+end
+
 -- queue.put_unique(space, tube, delay, ttl, ttr, pri, ...)
 --  put unique task into queue.
 --   arguments
@@ -743,6 +759,50 @@ queue.urgent = function(space, tube, delayed, ...)
     return put_task(space, tube, ipri, delayed, ...)
 end
 
+-- take_ready_task(space, tube)
+--  take the first ready task without waiting, nil if there is none
+local function take_ready_task(space, tube)
+    local iterator = box.space[space].index[idx_tube]
+                            :iterator(box.index.EQ, tube, ST_READY)
+
+    for task in iterator do
+        local now = box.time64()
+        local created = box.unpack('l', task[i_created])
+        local ttr = box.unpack('l', task[i_ttr])
+        local ttl = box.unpack('l', task[i_ttl])
+        local event = now + ttr
+        if event > created + ttl then
+            event = created + ttl
+            -- tube started too late
+            if event <= now then
+                return
+            end
+        end
+
+
+        task = box.update(space,
+            task[i_uuid],
+                '=p=p=p+p',
+                i_status,
+                ST_TAKEN,
+
+                i_event,
+                event,
+
+                i_cid,
+                box.session.id(),
+
+                i_ctaken,
+                1
+        )
+
+        queue.workers[space][tube].ch:put(true, 0)
+        queue.consumers[space][tube]:put(true, 0)
+        queue.stat[space][tube]:inc('take')
+        return rettask(task)
+    end
+end
+
 -- queue.take(space, tube, timeout)
 -- take task for processing
 queue.take = function(space, tube, timeout)
@@ -762,44 +822,9 @@ queue.take = function(space, tube, timeout)
 
     while true do
 
-        local iterator = box.space[space].index[idx_tube]
-                                :iterator(box.index.EQ, tube, ST_READY)
-
-        for task in iterator do
-            local now = box.time64()
-            local created = box.unpack('l', task[i_created])
-            local ttr = box.unpack('l', task[i_ttr])
-            local ttl = box.unpack('l', task[i_ttl])
-            local event = now + ttr
-            if event > created + ttl then
-                event = created + ttl
-                -- tube started too late
-                if event <= now then
-                    break
-                end
-            end
-
-
-            task = box.update(space,
-                task[i_uuid],
-                    '=p=p=p+p',
-                    i_status,
-                    ST_TAKEN,
-
-                    i_event,
-                    event,
-
-                    i_cid,
-                    box.session.id(),
-
-                    i_ctaken,
-                    1
-            )
-
-            queue.workers[space][tube].ch:put(true, 0)
-            queue.consumers[space][tube]:put(true, 0)
-            queue.stat[space][tube]:inc('take')
-            return rettask(task)
+        local task = take_ready_task(space, tube)
+        if task ~= nil then
+            return task
         end
 
         if timeout > 0 then
@@ -817,6 +842,29 @@ queue.take = function(space, tube, timeout)
 end
 
 
+-- queue.take_batch(space, tube, timeout, count)
+--  take up to count tasks in one call: waits for the first task like
+--  queue.take (timeout 0 - do not wait at all), the rest are taken
+--  only if they are ready
+queue.take_batch = function(space, tube, timeout, count)
+    count = tonumber(count)
+    local tasks = {}
+    local task
+    if tonumber(timeout) > 0 then
+        task = queue.take(space, tube, timeout)
+    else
+        task = take_ready_task(tonumber(space), tube)
+    end
+    while task ~= nil do
+        table.insert(tasks, task)
+        if #tasks >= count then
+            break
+        end
+        task = take_ready_task(tonumber(space), tube)
+    end
+    return unpack(tasks)
+end
+
 -- queue.delete(space, id)
 --  deletes task from queue
 queue.delete = function(space, id)
@@ -853,6 +901,21 @@ queue.ack = function(space, id)
 end
 
 
+-- queue.ack_batch(space, id, ...)
+--  ack several tasks in one call. Tasks that can not be acked (released
+--  by ttr, taken by another consumer) are skipped, only acked tasks are
+--  returned.
+queue.ack_batch = function(space, ...)
+    local tasks = {}
+    for _, id in ipairs({...}) do
+        local ok, task = pcall(queue.ack, space, id)
+        if ok then
+            table.insert(tasks, task)
+        end
+    end
+    return unpack(tasks)
+end
+
 -- queue.touch(space, id)
 --  prolong ttr for taken task
 queue.touch = function(space, id)
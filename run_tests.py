@@ -6,6 +6,19 @@ import socket
 import sys
 import unittest
 from source.tests.test_lib_init import InitTestCase
+from source.tests.test_handle_pool import CurlPoolTestCase
+from source.tests.test_curl_share import DnsCacheTestCase
+from source.tests.test_shared_cache import SharedCacheTestCase
+from source.tests.test_breaker import HostBreakerTestCase
+from source.tests.test_memo import MemoCacheTestCase
+from source.tests.test_latency import HostLatencyTestCase
+from source.tests.test_supervisor import WorkerPoolTestCase
+from source.tests.test_network_monitor import NetworkMonitorTestCase
+from source.tests.test_forkserver import ForkServerTestCase
+from source.tests.test_autoscaler import AutoscalerTestCase
+from source.tests.test_timing import MetricsTestCase
+from source.tests.test_profiler import ProfilerTestCase
+from source.tests.test_control import ControlServerTestCase
 
 source_dir = os.path.join(os.path.dirname(__file__), 'source')
 sys.path.insert(0, source_dir)
@@ -36,6 +49,19 @@ if __name__ == '__main__':
         unittest.makeSuite(NotificationPusherTestCase),
         unittest.makeSuite(RedirectCheckerTestCase),
         unittest.makeSuite(InitTestCase),
+        unittest.makeSuite(CurlPoolTestCase),
+        unittest.makeSuite(DnsCacheTestCase),
+        unittest.makeSuite(SharedCacheTestCase),
+        unittest.makeSuite(HostBreakerTestCase),
+        unittest.makeSuite(MemoCacheTestCase),
+        unittest.makeSuite(HostLatencyTestCase),
+        unittest.makeSuite(WorkerPoolTestCase),
+        unittest.makeSuite(NetworkMonitorTestCase),
+        unittest.makeSuite(ForkServerTestCase),
+        unittest.makeSuite(AutoscalerTestCase),
+        unittest.makeSuite(MetricsTestCase),
+        unittest.makeSuite(ProfilerTestCase),
+        unittest.makeSuite(ControlServerTestCase),
         unittest.makeSuite(UtilsTestCase),
         unittest.makeSuite(WorkerTestCase),
     ))
@@ -1,3 +1,4 @@
+import os
 import sys
 from codecs import getwriter
 
@@ -12,17 +13,148 @@ OUTPUT_QUEUE_SPACE = 0
 
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
+# the pool starts with WORKER_POOL_SIZE workers and is scaled between WORKER_POOL_MIN_SIZE
+# (at least 1) and WORKER_POOL_MAX_SIZE (equal sizes turn autoscaling off) every AUTOSCALE_INTERVAL seconds:
+# ready and taken input tasks should keep workers AUTOSCALE_TARGET_UTILIZATION busy;
+# the pool grows only while its workers are that busy and shrinks only when
+# AUTOSCALE_DOWN_MARGIN smaller pool is enough and AUTOSCALE_COOLDOWN seconds have passed
 WORKER_POOL_SIZE = 10
+WORKER_POOL_MIN_SIZE = 2
+WORKER_POOL_MAX_SIZE = 40
+AUTOSCALE_INTERVAL = 10
+AUTOSCALE_TARGET_UTILIZATION = 0.7
+AUTOSCALE_DOWN_MARGIN = 0.3
+AUTOSCALE_COOLDOWN = 120
+
 QUEUE_TAKE_TIMEOUT = 0.1
+# tasks resolved concurrently by one worker process
+MAX_TASKS_IN_FLIGHT = 30
+# tasks whose next hop waits for a host at its HOST_CONCURRENCY_LIMITS
+MAX_TASKS_WAITING = 100
+# tasks taken from the input queue in one call
+TAKE_BATCH_SIZE = 10
+# results are put and their tasks acked in one call per queue once there are
+# RESULT_BATCH_SIZE of them or the oldest has waited RESULT_BATCH_LINGER seconds
+RESULT_BATCH_SIZE = 20
+RESULT_BATCH_LINGER = 0.2
 
+# seconds between network checks
 SLEEP = 10
+# workers report to the parent every WORKER_HEARTBEAT_INTERVAL seconds and are
+# killed after WORKER_HEARTBEAT_TIMEOUT seconds of silence; a draining worker
+# is killed if it has not finished its tasks in WORKER_DRAIN_TIMEOUT
+WORKER_HEARTBEAT_INTERVAL = 1
+WORKER_HEARTBEAT_TIMEOUT = 60
+WORKER_DRAIN_TIMEOUT = 60
+# workers are forked by a template process with counter rules already loaded
+# instead of the main process; set to False to fork them from the main process
+WORKER_FORK_SERVER = True
+# a worker finishes its tasks and exits (the pool replaces it) once its private
+# memory (shared caches excluded) exceeds MAX_WORKER_RSS bytes or it has processed
+# MAX_TASKS_PER_WORKER tasks, lowered by up to RECYCLE_JITTER per worker; 0 disables a limit
+MAX_WORKER_RSS = 256 * 1024 * 1024
+MAX_TASKS_PER_WORKER = 50000
+RECYCLE_JITTER = 0.1
 
+# seconds per hop; connecting gets at most HTTP_CONNECT_TIMEOUT of it,
+# so a dead host does not eat the whole hop budget
 HTTP_TIMEOUT = 3
+HTTP_CONNECT_TIMEOUT = 1
+# seconds for a whole chain, hops share it; a chain that runs out ends with DEADLINE
+TASK_DEADLINE = 20
 MAX_REDIRECTS = 30
+# a broken chain is rechecked up to RECHECK_MAX_ATTEMPTS times, resuming from the failed hop;
+# the delay doubles with every recheck from the first value up to the second one, per error class,
+# and is cut by up to RECHECK_JITTER; other errors wait RECHECK_DELAY
 RECHECK_DELAY = 300
+RECHECK_MAX_ATTEMPTS = 3
+RECHECK_BACKOFF = {
+    'dns': (600, 6 * 3600),
+    'connect': (120, 3600),
+    'timeout': (300, 3600),
+    'unavailable': (60, 3600),
+}
+RECHECK_JITTER = 0.5
+# response bodies are cut after this many bytes
+MAX_CONTENT_SIZE = 1024 * 1024
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
-CHECK_URL = "http://t.mail.ru"
+# idle curl handles kept per worker process for connection reuse
+CURL_POOL_SIZE = 32
+CURL_POOL_MAX_IDLE_TIME = 60
+# seconds to keep resolved host names in the per-process DNS cache
+DNS_CACHE_TTL = 300
+STATS_LOG_INTERVAL = 60
+# UNIX socket of the main process for status and commands (status, config, resize N|auto,
+# pause, resume, flush), one command per connection; None turns it off
+CONTROL_SOCKET = '/tmp/redirect_checker.sock'
+# sampling profiler started by SIGUSR2 (in the signalled process) or by the control command
+# profile [seconds] (main process and all workers): stacks are sampled every PROFILE_INTERVAL
+# seconds of CPU time for PROFILE_DURATION seconds and written to PROFILE_DIR as
+# {name}.{pid}.{time}.collapsed, ready for flamegraph.pl or speedscope
+PROFILE_DIR = '/tmp'
+PROFILE_DURATION = 30
+PROFILE_INTERVAL = 0.01
+# every worker exports timing histograms (curl phases per hop, page parsing, queue calls)
+# each METRICS_INTERVAL seconds as statsd counters over UDP and/or JSON lines appended
+# to METRICS_FILE; None turns an exporter off, with both off nothing is measured
+METRICS_INTERVAL = 10
+METRICS_STATSD_ADDRESS = ('127.0.0.1', 8125)
+METRICS_PREFIX = 'redirect_checker'
+METRICS_FILE = None
+# redirect hops cache shared by all workers: memory budget in bytes, slot size
+# (longer entries are not cached) and seconds to keep a hop by redirect type
+HOP_CACHE_SIZE = 64 * 1024 * 1024
+HOP_CACHE_SLOT_SIZE = 1024
+HOP_CACHE_TTL = {
+    'http_status': 3600,
+    'meta_tag': 600,
+}
+# files kept across restarts live in STATE_DIR: it is created with mode 0700 and the checker
+# refuses to start if it belongs to another user or is open to others (None - do not create it)
+STATE_DIR = os.path.expanduser('~/.redirect_checker')
+# resolved chain tails (up to the final page and its counters) kept in a file
+# that survives restarts; a tail older than SUFFIX_CACHE_TTL seconds is walked again
+SUFFIX_CACHE_PATH = os.path.join(STATE_DIR, 'suffixes.cache')
+SUFFIX_CACHE_SIZE = 64 * 1024 * 1024
+SUFFIX_CACHE_SLOT_SIZE = 4096
+SUFFIX_CACHE_TTL = 1800
+# a host failing to connect HOST_BREAKER_THRESHOLD times in a row is not requested
+# for HOST_BREAKER_COOL_DOWN seconds (doubled after each failed probe, up to the max);
+# rechecks of chains failed on it are delayed until then
+HOST_BREAKER_SIZE = 4 * 1024 * 1024
+HOST_BREAKER_THRESHOLD = 5
+HOST_BREAKER_COOL_DOWN = 60
+HOST_BREAKER_MAX_COOL_DOWN = 900
+# per-host latency histograms (namelookup, connect, total time), shared by workers
+# and kept in HOST_LATENCY_PATH across restarts; 0 size - fixed HTTP_TIMEOUT/HTTP_CONNECT_TIMEOUT.
+# Once a host has HOST_LATENCY_MIN_SAMPLES requests, its timeouts are the latency at
+# HOST_LATENCY_PERCENTILE times HOST_LATENCY_MARGIN, clamped to the (min, max) bounds
+HOST_LATENCY_PATH = os.path.join(STATE_DIR, 'latency.cache')
+HOST_LATENCY_SIZE = 4 * 1024 * 1024
+HOST_LATENCY_PERCENTILE = 0.99
+HOST_LATENCY_MARGIN = 2
+HOST_LATENCY_MIN_SAMPLES = 20
+HOST_TIMEOUT_BOUNDS = (0.5, 10)
+HOST_CONNECT_TIMEOUT_BOUNDS = (0.2, 3)
+# py file with COUNTER_TYPES (see counter_rules.py), re-read by workers on SIGHUP;
+# None - built-in counter list
+COUNTER_RULES_FILE = None
+
+# concurrent requests of one worker to a host: the first matching host name
+# regexp sets the limit, others get HOST_CONCURRENCY_DEFAULT (0 - no limit)
+HOST_CONCURRENCY_LIMITS = (
+    (r'(^|\.)bit\.ly$', 4),
+    (r'(^|\.)goo\.gl$', 4),
+)
+HOST_CONCURRENCY_DEFAULT = 8
+
+# network is probed every SLEEP seconds, a probe succeeds if any of CHECK_URLS answers;
+# workers are paused after NETWORK_DOWN_THRESHOLD failed probes in a row
+# and resumed after NETWORK_UP_THRESHOLD successful ones
+CHECK_URLS = ("http://t.mail.ru", "http://ya.ru", "http://google.com")
+NETWORK_DOWN_THRESHOLD = 3
+NETWORK_UP_THRESHOLD = 2
 
 LOGGING = {
     'version': 1,
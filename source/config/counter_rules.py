@@ -0,0 +1,13 @@
+# Counter detection rules for redirect_checker, see COUNTER_RULES_FILE in checker_config.py.
+# Every pattern must look like .*literal.* and is matched case-insensitively.
+# Edit and send SIGHUP to redirect_checker to apply without restarting workers.
+COUNTER_TYPES = (
+    ('GOOGLE_ANALYTICS', r'.*google-analytics\.com/ga\.js.*'),
+    ('YA_METRICA', r'.*mc\.yandex\.ru/metrika/watch\.js.*'),
+    ('TOP_MAIL_RU', r'.*top-fwz1\.mail\.ru/counter.*'),
+    ('TOP_MAIL_RU', r'.*top\.mail\.ru/jump\?from.*'),
+    ('DOUBLECLICK', r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*'),
+    ('VISUALDNA', r'.*//a1\.vdna-assets\.com/analytics\.js.*'),
+    ('LI_RU', r'.*/counter\.yadro\.ru/hit.*'),
+    ('RAMBLER_TOP100', r'.*counter\.rambler\.ru/top100.*'),
+)
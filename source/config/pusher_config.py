@@ -13,6 +13,10 @@ SLEEP_ON_FAIL = 10
 
 WORKER_POOL_SIZE = 10
 
+PROFILE_DIR = '/tmp'
+PROFILE_DURATION = 30
+PROFILE_INTERVAL = 0.01
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -1,18 +1,44 @@
 # coding: utf-8
+from collections import deque, Counter
+from HTMLParser import HTMLParser, HTMLParseError
 from StringIO import StringIO
 from logging import getLogger, NullHandler
 import re
+from time import sleep, time
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
 from bs4 import BeautifulSoup
 import pycurl
 
+from .breaker import HostBreaker, HostUnavailableError, HOST_FAILURE_ERRORS
+from .curl_share import DnsCache
+from .handle_pool import CurlPool
+from .latency import HostLatency
+from .memo import MemoCache
+from .timing import Metrics, SIZE_BUCKETS
+from .shared_cache import SharedCache
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
 REDIRECT_META = 'meta_tag'
 REDIRECT_HTTP = 'http_status'
+REDIRECT_ERROR = 'ERROR'
+REDIRECT_DEADLINE = 'DEADLINE'
+
+ERROR_DNS = 'dns'
+ERROR_CONNECT = 'connect'
+ERROR_TIMEOUT = 'timeout'
+ERROR_UNAVAILABLE = 'unavailable'
+ERROR_OTHER = 'other'
+"""Классы ошибок, обрывающих цепочку; от класса зависит, когда ее перепроверять"""
+ERROR_CLASSES = {
+    pycurl.E_COULDNT_RESOLVE_HOST: ERROR_DNS,
+    pycurl.E_COULDNT_CONNECT: ERROR_CONNECT,
+    pycurl.E_SSL_CONNECT_ERROR: ERROR_CONNECT,
+    pycurl.E_OPERATION_TIMEOUTED: ERROR_TIMEOUT,
+}
 
 OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.I)
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
@@ -28,9 +54,57 @@ COUNTER_TYPES = (
     ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
     ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
 )
+COUNTER_PATTERN = re.compile(r'^\.\*((?:[^\\.^$*+?{}\[\]|()]|\\[^\w])+)\.\*$', re.S)
+"""Регулярка счетчика должна иметь вид .*литерал.* - по литералу и ищем"""
 GOOGLE_MARKET_PREFIX = "market://"
 GOOGLE_PLAY_PREFIX = "http://play.google.com/store/apps/"
 
+MULTI_IDLE_SLEEP = 0.01
+
+MAX_CONTENT_SIZE = 1024 * 1024
+"""Сколько байт тела ответа читать не больше"""
+HEAD_END = re.compile(r'</head\s*>', re.I)
+HEAD_END_OVERLAP = 16
+META_TAG_START = re.compile(r'<meta', re.I)
+
+PREPARED_URLS_CACHE_SIZE = 20000
+IDNA_CACHE_SIZE = 5000
+
+prepared_urls = MemoCache(PREPARED_URLS_CACHE_SIZE)
+"""Урл -> нормализованный урл, нормализованный урл -> он сам"""
+idna_netlocs = MemoCache(IDNA_CACHE_SIZE)
+"""netloc -> его IDNA-запись или IDNA_ERROR"""
+IDNA_ERROR = object()
+IDEMPOTENT_URL_PREFIXES = ('http://', 'https://')
+
+meta_stats = {'fast': 0, 'soup': 0}
+"""Сколько страниц разобрано быстрым поиском мета-тега, а сколько - BeautifulSoup"""
+
+dns_cache = DnsCache()
+"""Общий кэш DNS и TLS-сессий для хэндлов текущего процесса"""
+
+curl_pool = CurlPool(factory=dns_cache.create_handle)
+"""Пул curl-хэндлов текущего процесса"""
+
+hop_cache = SharedCache()
+"""Кэш переходов (урл, юзер-агент) -> (урл редиректа, тип, счетчики), общий для воркеров"""
+hop_cache_ttl = {}
+"""Сколько секунд хранить переход в кэше по типу редиректа, остальные типы не кэшируются"""
+
+suffix_cache = SharedCache()
+"""Хвосты цепочек (урл, юзер-агент) -> (типы, урлы до конечного, счетчики, время проверки), в файле"""
+suffix_cache_ttl = 0
+"""Через сколько секунд после проверки хвост считается устаревшим"""
+
+host_breaker = HostBreaker()
+"""Общая для воркеров таблица недоступных хостов"""
+
+host_latency = HostLatency()
+"""Общие для воркеров гистограммы задержек хостов, по ним подстраиваются таймауты"""
+
+metrics = Metrics()
+"""Гистограммы таймингов переходов, разбора страниц и очереди текущего процесса"""
+
 
 def to_unicode(val, errors='strict'):
     return val if isinstance(val, unicode) else val.decode('utf8', errors=errors)
@@ -40,35 +114,153 @@ def to_str(val, errors='strict'):
     return val.encode('utf8', errors=errors) if isinstance(val, unicode) else val
 
 
+def get_counter_matchers(counter_types):
+    """
+    Превращает регулярки счетчиков вида .*литерал.* в тройки
+    (тип счетчика, литерал в нижнем регистре, регулярка литерала)
+    """
+    matchers = []
+    for counter_name, regexp in counter_types:
+        match = COUNTER_PATTERN.match(regexp.pattern)
+        if not match:
+            raise ValueError(u'Counter {} pattern is not .*literal.*: {}'.format(counter_name, regexp.pattern))
+        literal = re.sub(r'\\(.)', r'\1', match.group(1))
+        matchers.append((counter_name, literal.lower(), re.compile(match.group(1), regexp.flags)))
+    return tuple(matchers)
+
+
+COUNTER_MATCHERS = get_counter_matchers(COUNTER_TYPES)
+"""Текущие правила поиска счетчиков, подменяются целиком в set_counter_types"""
+
+
+def set_counter_types(counter_types):
+    """
+    Компилирует новый список счетчиков и одним присваиванием подменяет текущий.
+    Регулярки-строки компилируются с re.I + re.S, как встроенные COUNTER_TYPES.
+    При ошибке в правилах текущий список не меняется.
+    """
+    global COUNTER_MATCHERS
+    COUNTER_MATCHERS = get_counter_matchers([
+        (counter_name, re.compile(regexp, re.I + re.S) if isinstance(regexp, basestring) else regexp)
+        for counter_name, regexp in counter_types
+    ])
+    return len(COUNTER_MATCHERS)
+
+
 def get_counters(content):
     """
-    Ищет в хтмл-странице счетчик и возвращает массив типов найденных
+    Ищет в хтмл-странице счетчик и возвращает массив типов найденных.
+
+    Страница приводится к нижнему регистру один раз, литералы ищутся
+    в ней str.find, а найденное место проверяется исходной регуляркой
+    (lower() для unicode знает больше символов, чем re.I).
     """
+    lowered = content.lower()
     counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
-            counters.append(counter_name)
+    # правила могут подмениться по SIGHUP, берем одну их версию на всю страницу
+    for counter_name, literal, regexp in COUNTER_MATCHERS:
+        pos = lowered.find(literal)
+        while pos != -1:
+            if regexp.match(content, pos):
+                counters.append(counter_name)
+                break
+            pos = lowered.find(literal, pos + 1)
     return counters
 
 
+class MetaTagParser(HTMLParser):
+    """
+    Токенизатор html.parser (тот же, что у BeautifulSoup(content, "html.parser")),
+    запоминающий атрибуты первого тега <meta>. Дерево документа не строится.
+    """
+
+    def reset(self):
+        HTMLParser.reset(self)
+        self.meta_attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta' and self.meta_attrs is None:
+            self.meta_attrs = attrs
+
+
+def find_first_meta(content):
+    """
+    Возвращает атрибуты первого тега <meta> страницы или None.
+
+    Документ токенизируется только до первого настоящего тега <meta>:
+    в парсер по очереди подаются куски до конца очередного вхождения "<meta"
+    (вхождение может оказаться внутри комментария, скрипта или атрибута).
+    """
+    parser = MetaTagParser()
+    pos = 0
+    while parser.meta_attrs is None:
+        match = META_TAG_START.search(content, pos)
+        if match is None:
+            if parser.rawdata:
+                # the last candidate may be a tag split by '>' in an attribute
+                parser.feed(content[pos:])
+            break
+        end = content.find('>', match.end())
+        end = len(content) if end == -1 else end + 1
+        parser.feed(content[pos:end])
+        pos = end
+
+    if parser.meta_attrs is None:
+        return None
+    # BeautifulSoup keeps the last of repeated attributes and '' for empty ones
+    return dict((name, '' if value is None else value) for name, value in parser.meta_attrs)
+
+
+def is_ascii(value):
+    return all(ord(char) < 128 for char in value)
+
+
+def get_meta_refresh_url(refresh, url):
+    """Достает урл из значения content мета-тега refresh"""
+    splitted = refresh.split(";")
+    if len(splitted) != 2:
+        return
+    wait, text = splitted
+    text = text.strip()
+    m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
+    if m:
+        meta_url = m.groups()[0]
+        return urljoin(url, to_unicode(meta_url, 'ignore'))
+
+
 def check_for_meta(content, url):
     """
     Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+
+    Учитывается только первый тег <meta>, как и в check_for_meta_soup.
+    Если страницу нельзя надежно разобрать без декодирования (utf-16,
+    не-ascii в урле, ошибка парсера), используется check_for_meta_soup.
+    """
+    try:
+        if '\x00' in content:
+            raise UnicodeError('multibyte encoding')
+        attrs = find_first_meta(content)
+        if attrs and not is_ascii(attrs.get('content', '')):
+            raise UnicodeError('content attribute needs document encoding')
+    except (HTMLParseError, UnicodeError):
+        meta_stats['soup'] += 1
+        return check_for_meta_soup(content, url)
+
+    meta_stats['fast'] += 1
+    if attrs and 'content' in attrs and attrs.get('http-equiv', '').lower() == 'refresh':
+        return get_meta_refresh_url(attrs['content'], url)
+
+
+def check_for_meta_soup(content, url):
+    """
+    Ищет мета-редирект, строя полное дерево BeautifulSoup
     """
     soup = BeautifulSoup(content, "html.parser")
     result = soup.find("meta")
     if result and 'content' in result.attrs:
         for attr, value in result.attrs.items():
             if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
-                if len(splitted) != 2:
-                    return
-                wait, text = splitted
-                text = text.strip()
-                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
-                if m:
-                    meta_url = m.groups()[0]
-                    return urljoin(url, to_unicode(meta_url, 'ignore'))
+                return get_meta_refresh_url(result['content'], url)
 
 
 def fix_market_url(url):
@@ -76,42 +268,431 @@ def fix_market_url(url):
     return GOOGLE_PLAY_PREFIX + url.lstrip(GOOGLE_MARKET_PREFIX)
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class ResponseBuffer(object):
+    """
+    Принимает ответ через HEADERFUNCTION/WRITEFUNCTION curl и прерывает
+    загрузку, как только тело перестает быть нужным:
+
+    + у http-редиректа и у не-html ответа тело не читается вообще;
+    + тело обрезается после max_size байт;
+    + если в <head> уже найден мета-редирект, страница промежуточная
+      и дальше </head> не читается, найденный урл остается в meta_url.
 
+    Полностью (в пределах max_size) читается только конечная страница,
+    на которой потом ищутся счетчики.
+    """
+
+    def __init__(self, url, max_size=MAX_CONTENT_SIZE):
+        self.url = url
+        self.max_size = max_size
+        self.body = StringIO()
+        self.size = 0
+        self.status = None
+        self.location = None
+        self.content_type = None
+        self.need_body = None
+        self.head_tail = ''
+        self.aborted = False
+        self.redirect_aborted = False
+        self.meta_url = None
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            # each response (e.g. after 100 Continue) starts with a status line
+            parts = line.split(None, 2)
+            self.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            self.location = self.content_type = None
+            return
+        name, sep, value = line.partition(':')
+        if not sep:
+            return
+        name = name.strip().lower()
+        if name == 'location':
+            self.location = value.strip()
+        elif name == 'content-type':
+            self.content_type = value.strip().lower()
+
+    def write(self, data):
+        if self.need_body is None:
+            self.need_body = self._is_body_needed()
+        if not self.need_body:
+            self.redirect_aborted = self._is_redirect()
+            return self._abort()
+
+        if self.max_size and self.size + len(data) >= self.max_size:
+            self.body.write(data[:self.max_size - self.size])
+            self.size = self.max_size
+            return self._abort()
+        self.body.write(data)
+        self.size += len(data)
+
+        if self.head_tail is not None:
+            window = self.head_tail + data
+            if HEAD_END.search(window):
+                self.head_tail = None
+                with metrics.timer('parse.meta'):
+                    self.meta_url = check_for_meta(self.body.getvalue(), self.url)
+                if self.meta_url:
+                    return self._abort()
+            else:
+                self.head_tail = window[-HEAD_END_OVERLAP:]
+
+    def getvalue(self):
+        return self.body.getvalue()
+
+    def is_abort_error(self, error):
+        """Ошибка curl вызвана тем, что загрузку прервал сам буфер"""
+        return self.aborted and error.args[0] == pycurl.E_WRITE_ERROR
+
+    def _is_redirect(self):
+        """Ответ - http-редирект: как и REDIRECT_URL libcurl, Location учитывается только у 3xx"""
+        return self.status is not None and 300 <= self.status < 400 and bool(self.location)
+
+    def _is_body_needed(self):
+        if self._is_redirect():
+            # the body of an ignored ok login redirect may be the final page
+            return bool(OK_REDIRECT.match(self.location))
+        return not self.content_type or 'html' in self.content_type
+
+    def _abort(self):
+        self.aborted = True
+        return 0
+
+
+def setup_curl(curl, url, timeout, useragent, buff, connect_timeout=None):
+    """
+    Настраивает curl-хэндл на запрос урла (без перехода по редиректам)
+    :param timeout: время на весь запрос в секундах, может быть дробным
+    :param connect_timeout: время на установку соединения, не больше timeout
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
     curl.setopt(curl.URL, prepared_url)
+    dns_cache.setup(curl)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.HEADERFUNCTION, buff.header)
+    curl.setopt(curl.WRITEFUNCTION, buff.write)
     curl.setopt(curl.FOLLOWLOCATION, False)
-    # curl.setopt(curl.CONNECTTIMEOUT, timeout)
-    curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
+    # 0 для *_MS означает "без ограничения", поэтому не меньше миллисекунды
+    if connect_timeout:
+        curl.setopt(curl.CONNECTTIMEOUT_MS, max(int(min(connect_timeout, timeout) * 1000), 1))
+    curl.setopt(curl.TIMEOUT_MS, max(int(timeout * 1000), 1))
+
+
+def read_curl_response(curl, buff, host):
+    """
+    Забирает результат выполненного запроса и возвращает хэндл в пул
+    :return: содержимое ответа, урл редиректа
+    """
     content = buff.getvalue()
     redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
+    if redirect_url is None and buff.redirect_aborted:
+        # libcurl does not resolve Location of a transfer aborted by us
+        redirect_url = urljoin(curl.getinfo(curl.EFFECTIVE_URL), buff.location)
+    dns_cache.account(curl)
+    host_breaker.success(to_str(host))
+    account_latency(curl, host)
+    account_hop_metrics(curl)
+    curl_pool.release(host, curl)
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+def get_url_host(url):
+    """Ключ пула хэндлов: схема и хост урла"""
+    parts = urlsplit(url)
+    return u'{}://{}'.format(parts.scheme, parts.netloc.lower())
+
+
+def init_curl_pool(max_size, max_idle_time):
+    """Задает ограничения пула curl-хэндлов процесса"""
+    curl_pool.close()
+    curl_pool.max_size = max_size
+    curl_pool.max_idle_time = max_idle_time
+
+
+def init_dns_cache(ttl):
+    """Задает время жизни записей DNS-кэша процесса"""
+    dns_cache.ttl = ttl
+
+
+def init_hop_cache(max_size, slot_size, ttl):
+    """
+    Выделяет память кэша переходов. Вызывается до запуска воркеров,
+    чтобы они унаследовали общую память.
+
+    :param ttl: словарь тип редиректа -> время жизни записи в секундах
+    """
+    hop_cache.configure(max_size, slot_size)
+    hop_cache_ttl.clear()
+    hop_cache_ttl.update(ttl)
+
+
+def init_host_breaker(max_size, threshold, cool_down, max_cool_down):
+    """
+    Выделяет общую таблицу недоступных хостов. Вызывается до запуска воркеров.
+
+    :param threshold: после скольких ошибок соединения подряд хост отключается
+    :param cool_down: на сколько секунд отключается хост, удваивается до max_cool_down
+    """
+    host_breaker.configure(max_size, threshold, cool_down, max_cool_down)
+
+
+def check_host_available(host):
+    """Бросает HostUnavailableError, если запросы к хосту сейчас не делаются"""
+    if not host_breaker.allow(to_str(host)):
+        raise HostUnavailableError(u'Host {} is unavailable, retry in {:.0f}s'.format(
+            host, host_breaker.get_retry_delay(to_str(host))))
+
+
+def account_host_error(host, error):
+    """Учитывает в таблице недоступных хостов ошибку запроса"""
+    if error.args and error.args[0] in HOST_FAILURE_ERRORS:
+        host_breaker.failure(to_str(host))
+
+
+def init_host_latency(max_size, path, percentile, margin, min_samples, timeout_bounds, connect_timeout_bounds):
+    """
+    Открывает файл гистограмм задержек хостов. Вызывается до запуска воркеров.
+
+    :param percentile: по какому перцентилю задержек считается таймаут хоста
+    :param margin: во сколько раз таймаут больше перцентиля
+    :param min_samples: со скольких запросов к хосту таймауты подстраиваются
+    """
+    host_latency.configure(max_size, path, percentile, margin, min_samples,
+                           timeout_bounds=timeout_bounds, connect_timeout_bounds=connect_timeout_bounds)
+
+
+def account_latency(curl, host, timed_out=False):
+    """
+    Учитывает задержки выполненного запроса в гистограммах хоста.
+    Запрос, оборванный по таймауту, учитывается временем до обрыва:
+    если таких запросов много, таймаут хоста растет.
+    """
+    if not host_latency.enabled:
+        return
+    total = curl.getinfo(curl.TOTAL_TIME)
+    if timed_out and not curl.getinfo(curl.CONNECT_TIME):
+        # не дождались соединения
+        connect = total
+    elif curl.getinfo(curl.NUM_CONNECTS):
+        connect = curl.getinfo(curl.CONNECT_TIME)
+    else:
+        # соединение взято из кэша, время соединения ничего не говорит о хосте
+        connect = None
+    host_latency.add(to_str(host), curl.getinfo(curl.NAMELOOKUP_TIME), connect, total)
+
+
+def get_url_timeouts(url, timeout, connect_timeout):
+    """
+    :return: таймауты запроса и соединения для хоста урла: по его задержкам или переданные
+    """
+    try:
+        host = get_url_host(url)
+    except ValueError:
+        return timeout, connect_timeout
+    return host_latency.get_timeouts(to_str(host), timeout, connect_timeout)
+
+
+def account_hop_metrics(curl):
+    """
+    Учитывает фазы запроса в гистограммах метрик. Фазы, которых не было
+    (соединение из кэша, запрос без TLS, нет ответа), не учитываются.
+    """
+    if not metrics.enabled:
+        return
+    # время каждой фазы - от начала запроса, как его отдает curl
+    metrics.add('hop.namelookup', curl.getinfo(curl.NAMELOOKUP_TIME))
+    if curl.getinfo(curl.NUM_CONNECTS):
+        metrics.add('hop.connect', curl.getinfo(curl.CONNECT_TIME))
+    for name, info in (('hop.appconnect', curl.APPCONNECT_TIME), ('hop.starttransfer', curl.STARTTRANSFER_TIME)):
+        value = curl.getinfo(info)
+        if value:
+            metrics.add(name, value)
+    metrics.add('hop.total', curl.getinfo(curl.TOTAL_TIME))
+    metrics.add('hop.size_download', curl.getinfo(curl.SIZE_DOWNLOAD))
+
+
+def clear_hop_caches():
+    """Очищает общие кэши переходов и хвостов цепочек, вызывается в главном процессе"""
+    hop_cache.clear()
+    suffix_cache.clear()
+
+
+def reset_connections():
+    """Закрывает простаивающие соединения и забывает DNS-кэш текущего процесса"""
+    curl_pool.close()
+    dns_cache.reset()
+
+
+def init_metrics():
+    """Включает метрики текущего процесса, вызывается в воркере"""
+    metrics.enable({'hop.size_download': SIZE_BUCKETS})
+
+
+def account_request_error(curl, host, error):
+    """Учитывает в гистограммах хоста запрос, оборванный по таймауту"""
+    if error.args and error.args[0] == pycurl.E_OPERATION_TIMEOUTED:
+        account_latency(curl, host, timed_out=True)
+
+
+def account_failed_request(curl, host, error, timeout_cut=False):
+    """
+    Учитывает запрос, завершившийся ошибкой: в таблице недоступных хостов, задержках хоста и метриках.
+    Таймаут, урезанный сроком цепочки, ничего не говорит о хосте и учитывается только в метриках.
+
+    :param timeout_cut: таймаут запроса был меньше таймаута хоста из-за срока цепочки
+    """
+    if not (timeout_cut and error.args and error.args[0] == pycurl.E_OPERATION_TIMEOUTED):
+        account_host_error(host, error)
+        account_request_error(curl, host, error)
+    account_hop_metrics(curl)
+
+
+def get_url_retry_delay(url):
+    """
+    :return: через сколько секунд хост урла снова будет проверяться, 0 - если он доступен
+    """
+    return host_breaker.get_retry_delay(to_str(get_url_host(url)))
+
+
+def init_suffix_cache(max_size, slot_size, ttl, path):
+    """
+    Открывает файл хвостов цепочек. Вызывается до запуска воркеров.
+
+    :param ttl: через сколько секунд после проверки хвост устаревает
+    :param path: файл хранилища, None - в памяти до перезапуска
+    """
+    global suffix_cache_ttl
+    suffix_cache.configure(max_size, slot_size, path)
+    suffix_cache_ttl = ttl
+
+
+def get_hop_cache_key(url, user_agent):
+    return to_str(url) + '\n' + to_str(user_agent or '')
+
+
+def get_cached_hop(url, user_agent):
+    """
+    :return: аргументы RedirectChain.add_hop для закэшированного перехода или None
     """
+    cached = hop_cache.get(get_hop_cache_key(url, user_agent))
+    if cached is None:
+        return None
+    redirect_url, redirect_type, counters = cached
+    return redirect_url, redirect_type, None, counters
+
+
+def cache_hop(url, user_agent, result):
+    """Кэширует результат get_url, если это редирект с заданным временем жизни"""
+    redirect_url, redirect_type, content = result
+    ttl = hop_cache_ttl.get(redirect_type)
+    if redirect_url and ttl:
+        # содержимое не храним, но оно нужно для счетчиков, если цепочка на нем оборвется
+        with metrics.timer('parse.counters'):
+            counters = get_counters(content) if content else []
+        hop_cache.set(get_hop_cache_key(url, user_agent), (redirect_url, redirect_type, counters), ttl)
+
+
+def make_pycurl_request(url, timeout, useragent=None, max_size=MAX_CONTENT_SIZE, connect_timeout=None, buff=None,
+                        timeout_cut=False):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    :param max_size: сколько байт тела ответа читать не больше
+    :param connect_timeout: время на установку соединения
+    :param buff: ResponseBuffer для ответа, по умолчанию новый
+    :param timeout_cut: таймаут урезан сроком цепочки, см. account_failed_request
+    :return: содержимое ответа, урл редиректа
+
+    """
+    if buff is None:
+        buff = ResponseBuffer(url, max_size)
+    host = get_url_host(url)
+    check_host_available(host)
+    curl = curl_pool.acquire(host)
+    try:
+        setup_curl(curl, url, timeout, useragent, buff, connect_timeout)
+        try:
+            curl.perform()
+        except pycurl.error as e:
+            if not buff.is_abort_error(e):
+                account_failed_request(curl, host, e, timeout_cut)
+                raise
+    except Exception:
+        curl.close()
+        raise
+    return read_curl_response(curl, buff, host)
+
+
+def get_url(url, timeout, user_agent=None, max_content_size=MAX_CONTENT_SIZE, connect_timeout=None,
+            timeout_cut=False):
+    """
+    :param timeout_cut: таймаут урезан сроком цепочки, см. account_failed_request
     :return: урл, тип редиректа, содержимое страницы (если есть)
     """
     content = None
+    buff = ResponseBuffer(url, max_content_size)
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
+        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent, max_content_size, connect_timeout,
+                                                        buff, timeout_cut)
     except (pycurl.error, ValueError) as e:
-        logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        return get_url_error(url, e)
+
+    return check_response(url, content, new_redirect_url, buff.meta_url)
+
 
+def get_url_error(url, error):
+    """
+    Результат перехода, завершившегося ошибкой
+    :return: ErrorHop с классом ошибки
+    """
+    logger.error(u'error in url {} {}'.format(url, error))
+    return ErrorHop(url, get_error_class(error))
+
+
+def get_error_class(error):
+    """
+    :param error: исключение, которым кончился переход
+    :return: класс ошибки (ERROR_DNS, ERROR_CONNECT, ...)
+    """
+    if isinstance(error, HostUnavailableError):
+        return ERROR_UNAVAILABLE
+    if isinstance(error, pycurl.error) and error.args:
+        return ERROR_CLASSES.get(error.args[0], ERROR_OTHER)
+    return ERROR_OTHER
+
+
+class ErrorHop(tuple):
+    """
+    Переход, завершившийся ошибкой: (урл, ERROR, пустое содержимое), как у get_url.
+    error - класс ошибки, см. get_error_class.
+    """
+
+    def __new__(cls, url, error):
+        result = tuple.__new__(cls, (url, REDIRECT_ERROR, None))
+        result.error = error
+        return result
+
+
+class ChainResult(tuple):
+    """
+    Результат проверки цепочки: (типы редиректов, урлы редиректов, счетчики на конечном урле).
+    error - класс ошибки, оборвавшей цепочку, None - цепочка не оборвалась или класс неизвестен.
+    """
+
+    def __new__(cls, history_types, history_urls, counters, error=None):
+        result = tuple.__new__(cls, (history_types, history_urls, counters))
+        result.error = error
+        return result
+
+
+def check_response(url, content, new_redirect_url, meta_url=None):
+    """
+    Определяет, куда ведет полученный ответ: http-редирект или мета-тег
+    :param meta_url: мета-редирект, найденный в <head> при загрузке (ResponseBuffer.meta_url)
+    :return: урл, тип редиректа, содержимое страницы
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -120,8 +701,14 @@ def get_url(url, timeout, user_agent=None):
 
     if new_redirect_url:
         redirect_type = REDIRECT_HTTP
+    elif meta_url:
+        new_redirect_url = meta_url
+        redirect_type = REDIRECT_META
+        # страница прочитана только до </head>, счетчики по ней были бы неполными
+        content = None
     else:
-        new_redirect_url = check_for_meta(content, url)
+        with metrics.timer('parse.meta'):
+            new_redirect_url = check_for_meta(content, url)
         if new_redirect_url:
             redirect_type = REDIRECT_META
 
@@ -131,70 +718,482 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+def splice_cached_suffix(chain, user_agent):
+    """
+    Дописывает в цепочку известный хвост от ее текущего урла до конечной страницы.
+
+    :return: True, если цепочка завершена хвостом
+    """
+    cached = suffix_cache.get(get_hop_cache_key(chain.url, user_agent))
+    if cached is None:
+        return False
+    return chain.add_suffix(*cached)
+
+
+def cache_suffixes(chain, user_agent):
+    """
+    Запоминает хвосты дошедшей до конечной страницы цепочки от каждого ее урла.
+    Хвост, взятый из хранилища, не продлевается: срок считается от его проверки.
+    """
+    if not suffix_cache_ttl or not chain.final:
+        return
+    now = time()
+    checked_at = min(now, chain.checked_at) if chain.checked_at else now
+    ttl = checked_at + suffix_cache_ttl - now
+    if ttl <= 0:
+        return
+    counters = chain.get_result()[2]
+    for index, url in enumerate(chain.history_urls):
+        suffix = (chain.history_types[index:], chain.history_urls[index + 1:], counters, checked_at)
+        suffix_cache.set(get_hop_cache_key(url, user_agent), suffix, ttl)
+
+
+class RedirectChain(object):
+    """
+    Состояние проверки цепочки редиректов одного урла.
+
+    Общее для последовательной get_redirect_history и пакетной
+    get_redirect_histories: цепочке по очереди скармливаются результаты
+    get_url, пока она не будет завершена.
+    """
+
+    def __init__(self, url, max_redirects=30, use_cache=True, deadline=None, resume=None):
+        """
+        :param use_cache: брать переходы из кэша (новые переходы кэшируются в любом случае)
+        :param deadline: сколько секунд отводится на всю цепочку, None - без ограничения
+        :param resume: (типы, урлы) уже пройденной части цепочки, проверка продолжается с последнего урла
+        """
+        self.url = prepare_url(url)
+        self.max_redirects = max_redirects
+        self.use_cache = use_cache
+        self.deadline_at = time() + deadline if deadline else None
+        self.history_types = []
+        self.history_urls = [self.url]
+        self.content = None
+        self.counters = None
+        # дошла ли цепочка до конечной страницы и когда проверен вставленный хвост
+        self.final = False
+        self.checked_at = None
+        self.error = None
+
+        # ignore mm / ok domains
+        self.done = bool(re.match(MM_URL, self.url) or re.match(OK_URL, self.url))
+        if resume and not self.done:
+            history_types, history_urls = resume
+            self.history_types = list(history_types)
+            self.history_urls = list(history_urls)
+            self.url = self.history_urls[-1]
+
+    def add_hop(self, redirect_url, redirect_type, content, counters=None):
+        """
+        Учитывает результат очередного перехода.
+
+        :param counters: счетчики страницы, если вместо содержимого известны только они (переход из кэша)
+        :return: True, если проверка цепочки завершена
+        """
+        self.content = content
+        self.counters = counters
+        if not redirect_url:
+            self.done = True
+            self.final = True
+            return self.done
+
+        if redirect_type == REDIRECT_ERROR and self.deadline_at is not None and time() >= self.deadline_at:
+            # переход оборвался, потому что его таймаут урезан до конца срока цепочки
+            redirect_type = REDIRECT_DEADLINE
+        if redirect_type == REDIRECT_DEADLINE:
+            self.error = ERROR_TIMEOUT
+        self.history_types.append(redirect_type)
+        self.history_urls.append(redirect_url)
+        self.url = redirect_url
+
+        if redirect_type in (REDIRECT_ERROR, REDIRECT_DEADLINE):
+            self.done = True
+        elif len(self.history_urls) > self.max_redirects or (redirect_url in self.history_urls[:-1]):
+            self.done = True
+        return self.done
+
+    def get_hop_timeout(self, timeout):
+        """
+        :return: таймаут очередного перехода с учетом срока цепочки, 0 - срок вышел
+        """
+        if self.deadline_at is None:
+            return timeout
+        return max(min(timeout, self.deadline_at - time()), 0)
+
+    def get_deadline_hop(self):
+        """Переход, завершающий цепочку с вышедшим сроком"""
+        logger.error(u'deadline exceeded for url {}'.format(self.url))
+        return self.url, REDIRECT_DEADLINE, None
+
+    def add_suffix(self, history_types, history_urls, counters, checked_at):
+        """
+        Дописывает хвост цепочки до конечной страницы, если по нему прошли бы до конца:
+        хвост не упирается в max_redirects и не возвращается на уже пройденные урлы.
+
+        :return: True, если хвост дописан и цепочка завершена
+        """
+        if len(self.history_urls) + len(history_urls) > self.max_redirects:
+            return False
+        visited = set(self.history_urls)
+        if any(url in visited for url in history_urls):
+            return False
+        self.history_types.extend(history_types)
+        self.history_urls.extend(history_urls)
+        self.url = self.history_urls[-1]
+        self.content = None
+        self.counters = counters
+        self.checked_at = checked_at
+        self.done = self.final = True
+        return True
+
+    def get_result(self):
+        """
+        :return: ChainResult - типы редиректов, урлы редиректов, счетчики на конечном урле
+        """
+        if self.counters is not None:
+            counters = self.counters
+        else:
+            with metrics.timer('parse.counters'):
+                counters = get_counters(self.content) if self.content else []
+        return ChainResult(self.history_types, self.history_urls, counters, self.error)
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, max_content_size=MAX_CONTENT_SIZE,
+                         use_cache=True, connect_timeout=None, deadline=None, resume=None):
     """
     Входные параметры:
 
     + url - урл для которого необходимо получить редиректы
     + timeout - таймаут на проверку *одного* урла
+    + connect_timeout - таймаут на установку соединения
+      (для хостов с накопленными задержками оба таймаута берутся из host_latency)
+    + deadline - сколько секунд отводится на всю цепочку, переходы делят его между собой
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + max_content_size - сколько байт тела ответа читать не больше
+    + use_cache - брать переходы из общего кэша (False для перепроверок)
+    + resume - (типы, урлы) пройденной части цепочки, с последнего урла которой продолжить
 
 
     Выходные параметры:
     Массив из трех элементов
 
-    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR)
+    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR, DEADLINE)
     2. урлы редиректов (включая конечный)
     3. установленные счетчики на конечном урле
 
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    chain = RedirectChain(url, max_redirects, use_cache, deadline, resume)
+    while not chain.done:
+        if chain.use_cache and splice_cached_suffix(chain, user_agent):
+            break
+        result = get_cached_hop(chain.url, user_agent) if chain.use_cache else None
+        if result is None:
+            host_timeout, host_connect_timeout = get_url_timeouts(chain.url, timeout, connect_timeout)
+            hop_timeout = chain.get_hop_timeout(host_timeout)
+            if not hop_timeout:
+                chain.add_hop(*chain.get_deadline_hop())
+                break
+            result = get_url(
+                url=chain.url,
+                timeout=hop_timeout,
+                user_agent=user_agent,
+                max_content_size=max_content_size,
+                connect_timeout=host_connect_timeout,
+                timeout_cut=hop_timeout < host_timeout
+            )
+            cache_hop(chain.url, user_agent, result)
+            if isinstance(result, ErrorHop):
+                chain.error = result.error
+        chain.add_hop(*result)
 
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
+    cache_suffixes(chain, user_agent)
+    return chain.get_result()
 
-    content = None
-    while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
-        )
-        if not redirect_url:
-            break
 
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
+class MultiRedirectResolver(object):
+    """
+    Проверяет много цепочек редиректов одновременно на одном pycurl.CurlMulti.
 
-        if redirect_type == 'ERROR':
-            break
+    Следующий переход цепочки запускается сразу после завершения предыдущего,
+    так что процесс не простаивает, пока ждет ответа по одному урлу.
+    Результаты совпадают с get_redirect_history.
 
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
-            break
+    Одновременных запросов к одному хосту не больше его лимита, переходы
+    сверх лимита ждут в очереди хоста и не занимают места остальных хостов.
+    Лимит из host_limits общий для всех подходящих под регулярку хостов.
+    """
+
+    def __init__(self, timeout, max_redirects=30, user_agent=None, max_content_size=MAX_CONTENT_SIZE,
+                 host_limits=(), default_host_limit=0, connect_timeout=None, deadline=None):
+        """
+        :param host_limits: пары (регулярка имени хоста, лимит запросов), первая подходящая задает лимит
+        :param default_host_limit: лимит для каждого из остальных хостов, 0 - без ограничения
+        :param connect_timeout, deadline: см. get_redirect_history
+        """
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.deadline = deadline
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.max_content_size = max_content_size
+        self.host_limits = [(re.compile(pattern, re.I), limit) for pattern, limit in host_limits]
+        self.default_host_limit = default_host_limit
+        self.multi = pycurl.CurlMulti()
+        self.requests = {}
+        self.host_requests = {}
+        self.host_queues = {}
+        self.waiting = 0
+        self.finished = []
+
+    def __len__(self):
+        """Количество цепочек, которые ждут ответа (без ждущих в очереди хоста)"""
+        return len(self.requests)
+
+    def get_busy_hosts(self, limit=5):
+        """
+        :return: хосты, к которым идет больше всего запросов: список (хост, запросов), по убыванию
+        """
+        return Counter(host for _, _, _, host, _ in self.requests.itervalues()).most_common(limit)
+
+    def get_host_limit(self, host):
+        """
+        :param host: схема и хост урла, как в get_url_host
+        :return: по какому ключу считать запросы к хосту и их лимит
+        """
+        hostname = urlsplit(host).hostname or ''
+        for pattern, limit in self.host_limits:
+            if pattern.search(hostname):
+                return pattern.pattern, limit
+        return hostname, self.default_host_limit
+
+    def add(self, url, tag=None, use_cache=True, resume=None):
+        """
+        Ставит урл на проверку.
+
+        :param tag: произвольный объект, который вернется вместе с результатом
+        :param use_cache: брать переходы из общего кэша
+        :param resume: пройденная часть цепочки, см. RedirectChain
+        """
+        chain = RedirectChain(url, self.max_redirects, use_cache, self.deadline, resume)
+        if chain.done:
+            self.finished.append((tag, chain))
+        else:
+            self._start_hop(tag, chain)
 
-    counters = get_counters(content) if content else []
+    def perform(self, timeout=1.0):
+        """
+        Продвигает все запросы, ожидая активности на сокетах не дольше timeout секунд.
 
-    return history_types, history_urls, counters
+        :return: список пар (tag, (history_types, history_urls, counters)) завершенных цепочек
+        """
+        if self.requests:
+            self._drive()
+        if self.requests:
+            # libcurl сам подсказывает, когда его нужно позвать снова
+            curl_timeout = self.multi.timeout()
+            if curl_timeout >= 0:
+                timeout = min(timeout, curl_timeout / 1000.0)
+            if timeout > 0 and self.multi.select(timeout) == -1:
+                # ни одного открытого сокета (например, идет резолв имен)
+                sleep(min(timeout, MULTI_IDLE_SLEEP))
+            self._drive()
+
+        finished, self.finished = self.finished, []
+        return [(tag, chain.get_result()) for tag, chain in finished]
+
+    def cancel(self):
+        """
+        Прерывает незавершенные запросы и убирает цепочки из очередей хостов,
+        resolver остается рабочим. Уже завершенные цепочки вернет perform.
+
+        :return: теги прерванных цепочек
+        """
+        tags = []
+        for curl, (tag, _, _, _, _) in self.requests.iteritems():
+            self.multi.remove_handle(curl)
+            curl.close()
+            tags.append(tag)
+        for queue in self.host_queues.itervalues():
+            tags.extend(tag for tag, _ in queue)
+        self.requests.clear()
+        self.host_requests.clear()
+        self.host_queues.clear()
+        self.waiting = 0
+        return tags
+
+    def close(self):
+        """
+        Прерывает незавершенные запросы и освобождает хэндлы
+        :return: теги прерванных цепочек, как у cancel
+        """
+        tags = self.cancel()
+        self.multi.close()
+        return tags
+
+    def _start_hop(self, tag, chain):
+        if chain.use_cache and splice_cached_suffix(chain, self.user_agent):
+            self._chain_done(tag, chain)
+            return
+        cached = get_cached_hop(chain.url, self.user_agent) if chain.use_cache else None
+        if cached is not None:
+            self._hop_done(tag, chain, cached)
+            return
+        timeout, connect_timeout = get_url_timeouts(chain.url, self.timeout, self.connect_timeout)
+        hop_timeout = chain.get_hop_timeout(timeout)
+        if not hop_timeout:
+            self._hop_done(tag, chain, chain.get_deadline_hop())
+            return
+        host = get_url_host(chain.url)
+        try:
+            check_host_available(host)
+        except HostUnavailableError as e:
+            self._hop_error(tag, chain, e)
+            return
+        key, limit = self.get_host_limit(host)
+        if limit and self.host_requests.get(key, 0) >= limit:
+            self.host_queues.setdefault(key, deque()).append((tag, chain))
+            self.waiting += 1
+            return
+        curl = curl_pool.acquire(host)
+        buff = ResponseBuffer(chain.url, self.max_content_size)
+        try:
+            setup_curl(curl, chain.url, hop_timeout, self.user_agent, buff, connect_timeout)
+        except (pycurl.error, ValueError) as e:
+            curl.close()
+            self._hop_error(tag, chain, e)
+            return
+        self.multi.add_handle(curl)
+        self.requests[curl] = (tag, chain, buff, host, hop_timeout < timeout)
+        self.host_requests[key] = self.host_requests.get(key, 0) + 1
+
+    def _hop_done(self, tag, chain, result):
+        if chain.add_hop(*result):
+            self._chain_done(tag, chain)
+        else:
+            self._start_hop(tag, chain)
+
+    def _hop_error(self, tag, chain, error):
+        result = get_url_error(chain.url, error)
+        chain.error = result.error
+        self._hop_done(tag, chain, result)
+
+    def _chain_done(self, tag, chain):
+        cache_suffixes(chain, self.user_agent)
+        self.finished.append((tag, chain))
+
+    def _drive(self):
+        while self.multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+            pass
+
+        while True:
+            num_queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self._request_done(curl)
+            for curl, errno, errmsg in err_list:
+                self._request_done(curl, pycurl.error(errno, errmsg))
+            if not num_queued:
+                break
+
+    def _release_host(self, host):
+        """
+        Освобождает место хоста и отдает его переходам из очереди хоста. Переход может
+        обойтись без запроса (кэш, срок цепочки, ошибка), тогда место берет следующий.
+        """
+        key, limit = self.get_host_limit(host)
+        count = self.host_requests.pop(key) - 1
+        if count:
+            self.host_requests[key] = count
+        queue = self.host_queues.get(key)
+        while queue and self.host_requests.get(key, 0) < limit:
+            tag, chain = queue.popleft()
+            self.waiting -= 1
+            self._start_hop(tag, chain)
+        if queue is not None and not queue:
+            del self.host_queues[key]
+
+    def _request_done(self, curl, error=None):
+        tag, chain, buff, host, timeout_cut = self.requests.pop(curl)
+        self.multi.remove_handle(curl)
+        self._release_host(host)
+        if error is not None and not buff.is_abort_error(error):
+            account_failed_request(curl, host, error, timeout_cut)
+            curl.close()
+            self._hop_error(tag, chain, error)
+        else:
+            content, redirect_url = read_curl_response(curl, buff, host)
+            result = check_response(chain.url, content, redirect_url, buff.meta_url)
+            cache_hop(chain.url, self.user_agent, result)
+            self._hop_done(tag, chain, result)
+
+
+def get_redirect_histories(urls, timeout, max_redirects=30, user_agent=None, max_content_size=MAX_CONTENT_SIZE,
+                           host_limits=(), default_host_limit=0, connect_timeout=None, deadline=None):
+    """
+    Пакетный вариант get_redirect_history: проверяет все урлы одновременно.
+
+    :param host_limits, default_host_limit: ограничения одновременных запросов к хосту, см. MultiRedirectResolver
+    :return: список результатов get_redirect_history в порядке входных урлов
+    """
+    resolver = MultiRedirectResolver(timeout, max_redirects, user_agent, max_content_size,
+                                     host_limits, default_host_limit, connect_timeout, deadline)
+    results = [None] * len(urls)
+    try:
+        for index, url in enumerate(urls):
+            resolver.add(url, index)
+        pending = len(urls)
+        while pending:
+            for index, history in resolver.perform():
+                results[index] = history
+                pending -= 1
+    finally:
+        resolver.close()
+    return results
 
 
 def prepare_url(url):
-    """Нормализация урла"""
+    """
+    Нормализация урла с мемоизацией.
+
+    Нормализация http(s)-урлов идемпотентна, поэтому такой результат
+    кэшируется и как ключ: повторная нормализация уже нормализованного
+    урла ничего не стоит. Для урлов без схемы это не так: 'a.ru:80?'
+    превращается в 'a.ru:80', а тот - в 'a.ru%3A80'.
+    """
     if url is None:
         return url
+    prepared = prepared_urls.get(url)
+    if prepared is None:
+        prepared = normalize_url(url)
+        prepared_urls.set(url, prepared)
+        if prepared.startswith(IDEMPOTENT_URL_PREFIXES):
+            prepared_urls.set(prepared, prepared)
+    return prepared
+
+
+def encode_netloc(netloc):
+    """IDNA-запись netloc, сам netloc - если она не получается"""
+    encoded = idna_netlocs.get(netloc)
+    if encoded is None:
+        try:
+            encoded = netloc.encode('idna')
+        except UnicodeError:
+            encoded = IDNA_ERROR
+        idna_netlocs.set(netloc, encoded)
+    if encoded is IDNA_ERROR:
+        logger.error("UnicodeError raise")
+        return netloc
+    return encoded
+
+
+def normalize_url(url):
+    """Нормализация урла"""
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
     )
-    try:
-        netloc = netloc.encode('idna')
-    except UnicodeError:
-        logger.error("UnicodeError raise")
-        pass
+    netloc = encode_netloc(netloc)
     path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
     qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
     return urlunparse((scheme, netloc, path, qs, anchor, fragments))
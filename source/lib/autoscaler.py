@@ -0,0 +1,70 @@
+# coding: utf-8
+from math import ceil
+
+
+class Autoscaler(object):
+    """
+    Размер пула воркеров по очереди.
+
+    Нужный размер - сколько воркеров по worker_capacity задач в работе
+    вместят готовые и взятые задачи трубы при загрузке target_utilization.
+    Отложенные задачи (перепроверки) воркеров пока не занимают и не
+    учитываются. Пул растет сразу, но только если текущие воркеры в
+    самом деле загружены: новые воркеры сначала набирают задачи, и пул
+    не раздувается, пока они разгоняются. Уменьшается пул, только когда
+    нужный размер меньше текущего на down_margin и с последнего изменения
+    прошло cooldown секунд, так что колебания очереди его не дергают.
+    """
+
+    def __init__(self, min_size, max_size, worker_capacity, size=None, target_utilization=0.7, down_margin=0.3,
+                 cooldown=120):
+        """
+        :param worker_capacity: сколько задач воркер держит в работе (MAX_TASKS_IN_FLIGHT)
+        :param size: начальный размер пула
+        :raises ValueError: пул может остаться без воркеров (min_size меньше 1)
+        """
+        if min_size < 1:
+            raise ValueError(u'Worker pool min size must be at least 1, got {}'.format(min_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.worker_capacity = worker_capacity
+        self.size = self.clamp(min_size if size is None else size)
+        self.target_utilization = target_utilization
+        self.down_margin = down_margin
+        self.cooldown = cooldown
+        self.changed_at = 0
+        self.utilization = 0
+        self.desired = self.size
+
+    @property
+    def enabled(self):
+        return self.min_size < self.max_size
+
+    def clamp(self, size):
+        return max(self.min_size, min(size, self.max_size))
+
+    def update(self, tube_stats, in_flight, now):
+        """
+        :param tube_stats: счетчики задач входной трубы, см. get_tube_stats
+        :param in_flight: сколько задач в работе у воркеров пула
+        :return: новый размер пула
+        """
+        load = tube_stats.get('ready', 0) + tube_stats.get('taken', 0)
+        self.desired = self.clamp(int(ceil(load / (self.worker_capacity * self.target_utilization))))
+        self.utilization = in_flight / float(self.size * self.worker_capacity)
+        if self.desired > self.size and self.utilization >= self.target_utilization:
+            self.resize(self.desired, now)
+        elif self.desired < self.size * (1 - self.down_margin) and now - self.changed_at >= self.cooldown:
+            self.resize(self.desired, now)
+        return self.size
+
+    def resize(self, size, now):
+        self.size = size
+        self.changed_at = now
+
+    def get_stats(self):
+        return {
+            'size': self.size,
+            'desired': self.desired,
+            'utilization': round(self.utilization, 2),
+        }
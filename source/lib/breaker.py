@@ -0,0 +1,108 @@
+# coding: utf-8
+import time
+
+import pycurl
+
+from .shared_cache import SharedCache
+
+HOST_FAILURE_ERRORS = frozenset([
+    pycurl.E_COULDNT_RESOLVE_HOST,
+    pycurl.E_COULDNT_CONNECT,
+    pycurl.E_OPERATION_TIMEOUTED,
+    pycurl.E_GOT_NOTHING,
+    pycurl.E_SEND_ERROR,
+    pycurl.E_RECV_ERROR,
+    pycurl.E_SSL_CONNECT_ERROR,
+])
+"""Ошибки curl, после которых хост считается недоступным (в отличие от ошибок урла или ответа)"""
+
+
+class HostUnavailableError(pycurl.error):
+    """Запрос не делался: хост недавно был недоступен и его автомат разомкнут"""
+
+
+class HostBreaker(object):
+    """
+    Автомат отключения недоступных хостов, общий для воркеров (SharedCache).
+
+    После threshold ошибок подряд хост отключается на cool_down секунд:
+    запросы к нему сразу завершаются HostUnavailableError. Когда время
+    выходит, пропускается один пробный запрос: успех возвращает хост,
+    ошибка снова отключает его на вдвое больший срок, но не больше
+    max_cool_down.
+
+    Запись хоста - (ошибок подряд, отключен до, сколько раз отключался подряд).
+    Процессы обновляют ее без блокировок, так что одновременные ошибки
+    могут посчитаться за одну.
+    """
+
+    def __init__(self, max_size=0, threshold=5, cool_down=60, max_cool_down=900):
+        """
+        :param max_size: сколько байт памяти под таблицу хостов, 0 - автомат выключен
+        """
+        self.table = SharedCache()
+        self.configure(max_size, threshold, cool_down, max_cool_down)
+
+    def configure(self, max_size, threshold=5, cool_down=60, max_cool_down=900):
+        self.table.configure(max_size, 256)
+        self.threshold = threshold
+        self.cool_down = cool_down
+        self.max_cool_down = max_cool_down
+        self.rejected = 0
+
+    def allow(self, host, now=None):
+        """
+        :return: можно ли сейчас делать запрос к хосту
+        """
+        state = self.table.get(host, now)
+        if state is None:
+            return True
+        failures, open_until, opens = state
+        if failures < self.threshold:
+            return True
+        now = time.time() if now is None else now
+        if now < open_until:
+            self.rejected += 1
+            return False
+        # полуоткрытое состояние: пробный запрос, остальные ждут его результата
+        self._save(host, (failures, now + self.get_cool_down(opens), opens), now)
+        return True
+
+    def success(self, host, now=None):
+        if self.table.get(host, now) is not None:
+            self._save(host, (0, 0, 0), now)
+
+    def failure(self, host, now=None):
+        now = time.time() if now is None else now
+        failures, open_until, opens = self.table.get(host, now) or (0, 0, 0)
+        failures += 1
+        if failures >= self.threshold:
+            opens += 1
+            open_until = now + self.get_cool_down(opens)
+        self._save(host, (failures, open_until, opens), now)
+
+    def get_retry_delay(self, host, now=None):
+        """
+        :return: через сколько секунд хост снова будет проверен, 0 - автомат замкнут
+        """
+        state = self.table.get(host, now)
+        if state is None or state[0] < self.threshold:
+            return 0
+        now = time.time() if now is None else now
+        return max(0, state[1] - now)
+
+    def get_cool_down(self, opens):
+        return min(self.cool_down * 2 ** max(opens - 1, 0), self.max_cool_down)
+
+    def get_stats(self):
+        return {
+            'threshold': self.threshold,
+            'cool_down': self.cool_down,
+            'rejected': self.rejected,
+        }
+
+    def _save(self, host, state, now):
+        now = time.time() if now is None else now
+        # запись живет, пока хост отключен, и еще cool_down: потом ошибки забываются
+        ttl = max(state[1] - now, 0) + self.cool_down
+        self.table.set(host, state, ttl, now)
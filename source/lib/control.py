@@ -0,0 +1,151 @@
+# coding: utf-8
+import errno
+import inspect
+import json
+from logging import getLogger
+import os
+import socket
+
+logger = getLogger('redirect_checker')
+
+MAX_REQUEST_SIZE = 4096
+
+
+class ControlError(Exception):
+    """Ошибка команды, текст уходит клиенту"""
+
+
+def get_arity(command):
+    """
+    :return: сколько строковых аргументов принимает команда: (минимум, максимум), максимум None - сколько угодно
+    """
+    spec = inspect.getargspec(command)
+    args = spec.args[1:] if inspect.ismethod(command) else spec.args
+    return len(args) - len(spec.defaults or ()), None if spec.varargs else len(args)
+
+
+def format_arity(low, high):
+    if high is None:
+        return u'at least {}'.format(low)
+    if low == high:
+        return unicode(low)
+    return u'{}-{}'.format(low, high)
+
+
+class ControlServer(object):
+    """
+    UNIX-сокет управления процессом: клиент присылает одну команду строкой
+    (имя и аргументы через пробел) и получает ответ строкой JSON, после чего
+    соединение закрывается:
+
+        echo status | socat - UNIX-CONNECT:/tmp/redirect_checker.sock
+
+    Сокет обслуживается в основном цикле процесса (handle, когда fileno
+    готов к чтению), так что команды выполняются между его итерациями
+    и не требуют блокировок. На чтение команды клиенту дается timeout секунд.
+    """
+
+    def __init__(self, path, commands, timeout=1):
+        """
+        :param commands: имя команды -> функция от строковых аргументов, возвращающая ответ для JSON
+        """
+        self.path = path
+        self.commands = commands
+        self.timeout = timeout
+        self.socket = None
+
+    def start(self):
+        """
+        :raise socket.error: EADDRINUSE, если сокет слушает другой процесс
+        """
+        if os.path.exists(self.path):
+            if self.is_listened():
+                raise socket.error(errno.EADDRINUSE, u'control socket {} is used by another process'.format(self.path))
+            # сокет от прошлого запуска, иначе bind не пройдет
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # сокет создается сразу с правами 0600, без окна между bind и chmod
+        umask = os.umask(0o177)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.socket.listen(8)
+        self.socket.setblocking(False)
+        logger.info(u'Control socket is listening on {}'.format(self.path))
+
+    def is_listened(self):
+        """Слушает ли кто-то сокет по пути path"""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(self.timeout)
+            client.connect(self.path)
+        except socket.error:
+            return False
+        finally:
+            client.close()
+        return True
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handle(self):
+        """Обслуживает всех ожидающих клиентов"""
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logger.warning(u'Control socket accept failed: {}'.format(e))
+                return
+            try:
+                connection.settimeout(self.timeout)
+                response = self.execute(self.read_request(connection))
+                connection.sendall(json.dumps(response, sort_keys=True, default=repr) + '\n')
+            except socket.error as e:
+                logger.warning(u'Control client is lost: {}'.format(e))
+            finally:
+                connection.close()
+
+    @staticmethod
+    def read_request(connection):
+        data = ''
+        while '\n' not in data and len(data) < MAX_REQUEST_SIZE:
+            chunk = connection.recv(MAX_REQUEST_SIZE)
+            if not chunk:
+                break
+            data += chunk
+        return data.split('\n', 1)[0]
+
+    def execute(self, request):
+        """
+        :return: {'result': ответ команды} или {'error': текст ошибки}
+        """
+        words = request.split()
+        if not words:
+            return {'error': 'empty command', 'commands': sorted(self.commands)}
+        command = self.commands.get(words[0])
+        if command is None:
+            return {'error': u'unknown command {}'.format(words[0]), 'commands': sorted(self.commands)}
+        args = words[1:]
+        low, high = get_arity(command)
+        if len(args) < low or high is not None and len(args) > high:
+            return {'error': u'{} takes {} arguments, got {}'.format(words[0], format_arity(low, high), len(args))}
+        logger.info(u'Control command: {}'.format(request.strip()))
+        try:
+            return {'result': command(*args)}
+        except ControlError as e:
+            return {'error': unicode(e)}
+        except Exception as e:
+            # ошибка в самой команде: в лог с трассировкой, процесс продолжает работу
+            logger.exception(e)
+            return {'error': u'{} failed: {}'.format(words[0], e)}
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,64 @@
+# coding: utf-8
+import os
+
+import pycurl
+
+FAST_NAMELOOKUP_TIME = 0.001
+"""Резолв быстрее этого (в секундах) считается попаданием в кэш"""
+
+
+class DnsCache(object):
+    """
+    Общий для всех curl-хэндлов процесса кэш DNS и TLS-сессий на pycurl.CurlShare.
+
+    libcurl не сообщает о попаданиях в DNS-кэш, поэтому они оцениваются
+    по NAMELOOKUP_TIME запросов, открывших новое соединение.
+    """
+
+    def __init__(self, ttl=60):
+        """
+        :param ttl: сколько секунд хранить результаты резолва
+        """
+        self.ttl = ttl
+        self.pid = None
+        self.share = None
+        self.hits = 0
+        self.misses = 0
+
+    def create_handle(self):
+        """Создает curl-хэндл, подключенный к кэшу"""
+        if self.pid != os.getpid():
+            # CurlShare нельзя использовать из нескольких процессов
+            self.pid = os.getpid()
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            self.hits = self.misses = 0
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    def reset(self):
+        """Забывает резолвы и TLS-сессии: следующие хэндлы получат новый CurlShare"""
+        self.pid = None
+
+    def setup(self, curl):
+        """Задает время жизни записей кэша. curl.reset() его сбрасывает, а CurlShare - нет"""
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, self.ttl)
+
+    def account(self, curl):
+        """Учитывает в статистике завершенный запрос"""
+        if not curl.getinfo(pycurl.NUM_CONNECTS):
+            # соединение переиспользовано, резолва не было
+            return
+        if curl.getinfo(pycurl.NAMELOOKUP_TIME) < FAST_NAMELOOKUP_TIME:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def get_stats(self):
+        return {
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,259 @@
+# coding: utf-8
+import errno
+import fcntl
+from logging import getLogger
+from multiprocessing import Pipe, Process
+from multiprocessing.reduction import send_handle, recv_handle
+import os
+import select
+import signal
+import sys
+import traceback
+
+from _multiprocessing import Connection
+
+from .supervisor import init_worker_process
+
+logger = getLogger('redirect_checker')
+
+SPAWN = 'spawn'
+"""Главный процесс -> шаблон: (SPAWN, сколько воркеров запустить)"""
+SPAWNED = 'spawned'
+"""Шаблон -> главный процесс: (SPAWNED, pid), следом fd канала воркера"""
+SPAWN_DONE = 'spawn_done'
+"""Шаблон -> главный процесс: запрос SPAWN выполнен"""
+EXITED = 'exited'
+"""Шаблон -> главный процесс: (EXITED, pid, код завершения как у multiprocessing)"""
+
+
+class ForkedProcess(object):
+    """Воркер, запущенный шаблоном: то, что WorkerPool берет от multiprocessing.Process"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.exitcode = None
+        self.orphaned = False
+
+    def is_alive(self):
+        if self.exitcode is None and self.orphaned and not is_running(self.pid):
+            # шаблона нет, воркер достался init, код завершения не узнать
+            self.exitcode = -signal.SIGTERM
+        return self.exitcode is None
+
+
+def is_running(pid):
+    """
+    Работает ли процесс. Зомби, которого еще не собрал init (в контейнере
+    init может и вовсе не собирать чужих детей), уже не работает.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # состояние идет после имени в скобках, а в имени могут быть и пробелы, и скобки
+            return f.read().rpartition(')')[2].split()[0] != 'Z'
+    except (IOError, IndexError):
+        # нет /proc или процесс только что исчез - решит следующая проверка
+        return True
+
+
+def get_exitcode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkServer(object):
+    """
+    Процесс-шаблон, который форкает готовые воркеры по запросу главного процесса.
+
+    Шаблон запускается до фоновых потоков главного процесса, один раз
+    выполняет preload (загрузка правил, прогрев модулей) и дальше только
+    форкает воркеров, так что они стартуют из небольшого однопоточного
+    процесса, а не из главного. Воркеры - дети шаблона: он их собирает,
+    сообщает главному процессу об их завершении и передает им SIGHUP,
+    а сам по SIGHUP повторяет preload для следующих воркеров.
+    Канал к воркеру шаблон отдает главному процессу через fd passing.
+    Шаблон выходит, когда закрыт канал к главному процессу или главный
+    процесс умер, его воркеры получают SIGTERM (PR_SET_PDEATHSIG).
+
+    Умерший шаблон не перезапускается: к этому времени в главном процессе
+    уже работают потоки, и новый шаблон пришлось бы форкать из него.
+    Пул замечает это по is_alive() и дальше запускает воркеров сам.
+    """
+
+    def __init__(self, target, args, preload=None):
+        self.target = target
+        self.args = args
+        self.preload = preload
+        self.process = None
+        self.control = None
+        self.workers = {}
+        self.reload_requested = False
+
+    def start(self):
+        self.control, server_control = Pipe()
+        self.process = Process(target=self._serve, args=(server_control, os.getpid()), name='fork-server')
+        self.process.daemon = True
+        self.process.start()
+        server_control.close()
+        logger.info(u'Started fork server {}'.format(self.process.pid))
+
+    def is_alive(self):
+        """Шаблон работает и канал к нему цел"""
+        return not self.control.closed and self.process.is_alive()
+
+    def spawn(self, num):
+        """
+        Запускает num воркеров. Если шаблон умер по дороге, запускаются не все.
+        :return: список пар (ForkedProcess, конец канала родителя), как у spawn_workers
+        """
+        workers = []
+        try:
+            self.control.send((SPAWN, num))
+            while True:
+                message = self.control.recv()
+                if message[0] == SPAWN_DONE:
+                    break
+                if message[0] == SPAWNED:
+                    process = self.workers[message[1]] = ForkedProcess(message[1])
+                    workers.append((process, Connection(recv_handle(self.control))))
+                else:
+                    self._handle(message)
+        except (IOError, EOFError) as e:
+            logger.error(u'Fork server is lost: {}'.format(e))
+            self._lost()
+        return workers
+
+    def fileno(self):
+        return self.control.fileno()
+
+    def read_messages(self):
+        """Читает сообщения шаблона о завершившихся воркерах"""
+        try:
+            while self.control.poll():
+                self._handle(self.control.recv())
+        except (IOError, EOFError):
+            self._lost()
+
+    def stop(self):
+        """Закрывает канал, шаблон выходит сам"""
+        if not self.control.closed:
+            self.control.close()
+        self.process.join()
+
+    def _handle(self, message):
+        if message[0] == EXITED:
+            process = self.workers.pop(message[1], None)
+            if process is not None:
+                process.exitcode = message[2]
+
+    def _lost(self):
+        self.control.close()
+        for process in self.workers.itervalues():
+            process.orphaned = True
+        self.workers = {}
+
+    def _serve(self, control, parent_pid):
+        # иначе шаблон не увидит EOF, когда главный процесс закроет свой конец
+        self.control.close()
+        if not init_worker_process(parent_pid):
+            return
+        if self.preload is not None:
+            self.preload()
+        pids = set()
+        wakeup_fd, wakeup_write_fd = os.pipe()
+        for fd in (wakeup_fd, wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_write_fd)
+        signal.signal(signal.SIGHUP, lambda signum, frame: self._request_reload(pids, signum))
+        signal.siginterrupt(signal.SIGHUP, False)
+        # профилировать в шаблоне нечего, а по умолчанию SIGUSR2 его убьет
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        while True:
+            try:
+                readable, _, _ = select.select([control, wakeup_fd], [], [])
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if wakeup_fd in readable:
+                try:
+                    while os.read(wakeup_fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            self._reap(control, pids)
+            if self.reload_requested and self.preload is not None:
+                self.reload_requested = False
+                self.preload()
+            if control in readable:
+                try:
+                    message = control.recv()
+                except EOFError:
+                    return
+                if message[0] == SPAWN:
+                    for _ in xrange(message[1]):
+                        self._fork(control, pids, (wakeup_fd, wakeup_write_fd))
+                    control.send((SPAWN_DONE,))
+
+    def _fork(self, control, pids, fds):
+        channel, worker_channel = Pipe()
+        parent_pid = os.getpid()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.error(u'Fork server could not fork a worker: {}'.format(e))
+            channel.close()
+            worker_channel.close()
+            return
+        if pid == 0:
+            control.close()
+            channel.close()
+            for fd in fds:
+                os.close(fd)
+            exitcode = 0
+            try:
+                self.target(*self.args, parent_pid=parent_pid, channel=worker_channel)
+            except SystemExit as e:
+                exitcode = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                exitcode = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+        worker_channel.close()
+        pids.add(pid)
+        control.send((SPAWNED, pid))
+        send_handle(control, channel.fileno(), pid)
+        channel.close()
+
+    @staticmethod
+    def _reap(control, pids):
+        while pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if not pid:
+                break
+            pids.discard(pid)
+            control.send((EXITED, pid, get_exitcode(status)))
+
+    def _request_reload(self, pids, signum):
+        self.reload_requested = True
+        for pid in list(pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
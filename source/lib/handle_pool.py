@@ -0,0 +1,101 @@
+# coding: utf-8
+import os
+import time
+
+import pycurl
+
+
+class CurlPool(object):
+    """
+    Пул curl-хэндлов процесса, сгруппированных по хосту.
+
+    Переиспользованный хэндл сохраняет keep-alive соединения, TLS-сессии
+    и DNS-кэш libcurl, поэтому повторный запрос к тому же хосту обходится
+    без новых рукопожатий.
+    """
+
+    def __init__(self, max_size=32, max_idle_time=60, factory=None):
+        """
+        :param max_size: максимальное количество простаивающих хэндлов
+        :param max_idle_time: через сколько секунд простоя хэндл закрывается
+        :param factory: функция создания нового хэндла, по умолчанию pycurl.Curl
+        """
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.factory = factory
+        self.pid = os.getpid()
+        self.idle = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, host):
+        """Возвращает сброшенный хэндл, по возможности уже ходивший на host"""
+        self._check_pid()
+        self._expire(time.time())
+        handles = self.idle.get(host)
+        if handles:
+            _, curl = handles.pop()
+            if not handles:
+                del self.idle[host]
+            self.size -= 1
+            self.hits += 1
+            curl.reset()
+            return curl
+        self.misses += 1
+        return self.factory() if self.factory else pycurl.Curl()
+
+    def release(self, host, curl):
+        """Возвращает хэндл в пул после успешного запроса"""
+        self._check_pid()
+        if self.max_size <= 0:
+            curl.close()
+            return
+        self.idle.setdefault(host, []).append((time.time(), curl))
+        self.size += 1
+        if self.size > self.max_size:
+            self._evict_oldest()
+
+    def close(self):
+        """Закрывает все простаивающие хэндлы"""
+        for handles in self.idle.itervalues():
+            for _, curl in handles:
+                curl.close()
+        self.idle.clear()
+        self.size = 0
+
+    def get_stats(self):
+        return {
+            'size': self.size,
+            'hosts': len(self.idle),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _check_pid(self):
+        # хэндлы, унаследованные через fork, делят сокеты с родителем
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def _expire(self, now):
+        deadline = now - self.max_idle_time
+        for host in self.idle.keys():
+            handles = self.idle[host]
+            while handles and handles[0][0] < deadline:
+                _, curl = handles.pop(0)
+                curl.close()
+                self.size -= 1
+            if not handles:
+                del self.idle[host]
+
+    def _evict_oldest(self):
+        host = min(self.idle, key=lambda h: self.idle[h][0][0])
+        handles = self.idle[host]
+        _, curl = handles.pop(0)
+        curl.close()
+        self.size -= 1
+        if not handles:
+            del self.idle[host]
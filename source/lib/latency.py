@@ -0,0 +1,124 @@
+# coding: utf-8
+from bisect import bisect_left
+
+from .shared_cache import SharedCache
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+"""Верхние границы корзин гистограммы в секундах, за последней - корзина для всего, что дольше"""
+NAMELOOKUP, CONNECT, TOTAL = range(3)
+"""Гистограммы хоста: резолв имени, установка соединения, весь запрос (время от начала запроса)"""
+
+
+def get_empty_histograms():
+    return tuple((0,) * (len(LATENCY_BUCKETS) + 1) for _ in xrange(3))
+
+
+def clamp(value, bounds):
+    low, high = bounds
+    return max(low, min(value, high))
+
+
+class HostLatency(object):
+    """
+    Скользящие гистограммы задержек запросов по хостам, общие для воркеров (SharedCache).
+
+    Таймаут хоста - верхняя граница корзины, в которую попадает заданный
+    перцентиль, умноженная на margin и зажатая в границы. Пока у хоста
+    меньше min_samples запросов, действуют переданные таймауты по умолчанию.
+    Когда запросов в гистограмме становится больше window, все корзины
+    делятся пополам: старые задержки постепенно забываются.
+
+    Если задан файл, гистограммы лежат в нем и переживают перезапуск.
+    Процессы обновляют запись хоста без блокировок, так что одновременные
+    запросы могут посчитаться за один.
+    """
+
+    def __init__(self, max_size=0, path=None, percentile=0.99, margin=2, min_samples=20, window=1000,
+                 timeout_bounds=(0.5, 10), connect_timeout_bounds=(0.2, 3), ttl=24 * 3600):
+        """
+        :param max_size: сколько байт памяти под таблицу хостов, 0 - таймауты не подстраиваются
+        """
+        self.table = SharedCache()
+        self.configure(max_size, path, percentile, margin, min_samples, window, timeout_bounds,
+                       connect_timeout_bounds, ttl)
+
+    def configure(self, max_size, path=None, percentile=0.99, margin=2, min_samples=20, window=1000,
+                  timeout_bounds=(0.5, 10), connect_timeout_bounds=(0.2, 3), ttl=24 * 3600):
+        """
+        :param timeout_bounds: (минимум, максимум) таймаута запроса в секундах
+        :param connect_timeout_bounds: (минимум, максимум) таймаута соединения в секундах
+        :param ttl: через сколько секунд без запросов хост забывается
+        """
+        self.table.configure(max_size, 512, path)
+        self.percentile = percentile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.window = window
+        self.timeout_bounds = timeout_bounds
+        self.connect_timeout_bounds = connect_timeout_bounds
+        self.ttl = ttl
+        self.adapted = 0
+        self.defaulted = 0
+
+    @property
+    def enabled(self):
+        return bool(self.table.sets)
+
+    def add(self, host, namelookup, connect, total, now=None):
+        """
+        Учитывает задержки запроса к хосту, None - задержка не измерена
+        """
+        if not self.enabled:
+            return
+        histograms = [list(histogram) for histogram in self.table.get(host, now) or get_empty_histograms()]
+        for histogram, value in zip(histograms, (namelookup, connect, total)):
+            if value is not None:
+                histogram[bisect_left(LATENCY_BUCKETS, value)] += 1
+                if sum(histogram) > self.window:
+                    histogram[:] = [count // 2 for count in histogram]
+        self.table.set(host, tuple(tuple(histogram) for histogram in histograms), self.ttl, now)
+
+    def get_percentile(self, histogram):
+        """
+        :return: верхняя граница корзины перцентиля, None - мало запросов
+        """
+        total = sum(histogram)
+        if total < self.min_samples:
+            return None
+        rank = self.percentile * total
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= rank:
+                break
+        # для последней корзины границы нет, берем вдвое больше предыдущей
+        return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+
+    def get_timeouts(self, host, timeout, connect_timeout, now=None):
+        """
+        :return: таймауты запроса и соединения для хоста или переданные, если задержек мало
+        """
+        if not self.enabled:
+            return timeout, connect_timeout
+        histograms = self.table.get(host, now)
+        total = self.get_percentile(histograms[TOTAL]) if histograms else None
+        if total is None:
+            self.defaulted += 1
+            return timeout, connect_timeout
+        self.adapted += 1
+        timeout = clamp(total * self.margin, self.timeout_bounds)
+        connect = self.get_percentile(histograms[CONNECT])
+        if connect is not None:
+            connect_timeout = clamp(connect * self.margin, self.connect_timeout_bounds)
+        return timeout, connect_timeout
+
+    def flush(self):
+        """Сбрасывает гистограммы в файл"""
+        self.table.flush()
+
+    def get_stats(self):
+        return {
+            'percentile': self.percentile,
+            'adapted': self.adapted,
+            'defaulted': self.defaulted,
+        }
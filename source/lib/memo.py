@@ -0,0 +1,55 @@
+# coding: utf-8
+
+
+class MemoCache(object):
+    """
+    Ограниченный словарь для мемоизации с приближенным LRU в два поколения.
+
+    Новые записи попадают в текущее поколение; когда оно заполняется, старое
+    выбрасывается целиком, а текущее становится старым. Найденная в старом
+    поколении запись переносится в текущее, так что часто используемые
+    записи не вытесняются. Поиск - одно-два обращения к dict.
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: сколько записей хранить не больше
+        """
+        self.generation_size = max(max_size // 2, 1)
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def get(self, key, default=None):
+        try:
+            value = self.current[key]
+        except KeyError:
+            try:
+                value = self.previous.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.set(key, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if len(self.current) >= self.generation_size and key not in self.current:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = value
+
+    def clear(self):
+        self.current.clear()
+        self.previous.clear()
+
+    def get_stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,74 @@
+# coding: utf-8
+from threading import Event, Thread
+
+from .utils import check_network_status
+
+
+class NetworkMonitor(object):
+    """
+    Фоновая проверка сети с гистерезисом.
+
+    Раз в interval секунд запрашивает урлы по очереди: раунд удачен, если
+    ответил хоть один. Сеть считается упавшей после down_threshold
+    неудачных раундов подряд и поднявшейся после up_threshold удачных,
+    так что короткие сбои не останавливают воркеры.
+
+    Поток ничего не логирует и не берет чужих блокировок: главный процесс
+    форкает воркеры, и захваченная потоком блокировка осталась бы в
+    потомке навсегда. О смене состояния он сообщает через on_change.
+    """
+
+    def __init__(self, urls, timeout, interval, down_threshold=3, up_threshold=2, on_change=None):
+        self.urls = urls
+        self.timeout = timeout
+        self.interval = interval
+        self.down_threshold = down_threshold
+        self.up_threshold = up_threshold
+        self.on_change = on_change
+        self.is_up = True
+        self.failures = 0
+        self.successes = 0
+        self.stopped = Event()
+        self.thread = None
+
+    def probe(self):
+        """
+        :return: ответил ли хоть один урл
+        """
+        return any(check_network_status(url, self.timeout) for url in self.urls)
+
+    def update(self, ok):
+        """
+        Учитывает результат раунда проверки
+        :return: изменилось ли состояние сети
+        """
+        if ok:
+            self.failures = 0
+            self.successes += 1
+            if not self.is_up and self.successes >= self.up_threshold:
+                self.is_up = True
+                return True
+        else:
+            self.successes = 0
+            self.failures += 1
+            if self.is_up and self.failures >= self.down_threshold:
+                self.is_up = False
+                return True
+        return False
+
+    def start(self):
+        """Проверяет сеть сразу, не дожидаясь порогов, и запускает фоновые проверки"""
+        self.is_up = self.probe()
+        self.thread = Thread(target=self.run, name='network-monitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.update(self.probe()) and self.on_change is not None:
+                self.on_change()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,160 @@
+# coding: utf-8
+import errno
+from hashlib import md5
+import marshal
+import mmap
+import os
+import stat
+import struct
+import time
+import zlib
+
+SLOT_HEADER = struct.Struct('<IdQdH')
+"""Заголовок слота: crc32, время последнего обращения, хэш ключа, срок жизни, длина данных"""
+CHECKED_OFFSET = 12
+"""crc32 считается от хэша ключа и дальше, время обращения меняется без перезаписи слота"""
+WAYS = 8
+"""Сколько слотов в одной корзине, вытеснение LRU идет внутри корзины"""
+
+
+def get_key_hash(key):
+    return struct.unpack_from('<Q', md5(key).digest())[0]
+
+
+class SharedCache(object):
+    """
+    Кэш ключ -> значение с TTL в mmap, общий для процесса и его потомков,
+    порожденных после configure(). Если задан файл, кэш лежит в нем
+    и переживает перезапуск процессов.
+
+    Память делится на корзины по WAYS слотов фиксированного размера, ключ
+    попадает в корзину по хэшу, при нехватке места вытесняется давно не
+    использованный слот корзины. Блокировок нет: слот пишется целиком и
+    проверяется по crc32, поэтому недописанный другим процессом слот
+    (или процессом, убитым посреди записи) читается как промах.
+    """
+
+    def __init__(self, max_size=0, slot_size=1024, path=None):
+        """
+        :param max_size: сколько байт памяти занимать, 0 - кэш выключен
+        :param slot_size: размер слота, записи больше него не кэшируются
+        :param path: файл кэша, None - анонимная память. Симлинк, чужой или доступный
+            на запись другим файл не открывается (OSError): его содержимое читается как наше.
+        """
+        self.memory = None
+        self.sets = 0
+        self.configure(max_size, slot_size, path)
+
+    def configure(self, max_size, slot_size=1024, path=None):
+        """
+        Выделяет новую память кэша: пустую или, для файла, с прежними записями.
+        При смене размера записи файла теряются (ключи попадают в другие корзины).
+        """
+        if self.memory is not None:
+            self.memory.close()
+        self.max_size = max_size
+        self.slot_size = slot_size
+        self.path = path
+        self.set_size = slot_size * WAYS
+        self.sets = max_size // self.set_size if slot_size > SLOT_HEADER.size else 0
+        self.memory = self._map(self.sets * self.set_size, path) if self.sets else None
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def get(self, key, now=None):
+        """
+        :param key: строка байт
+        :return: значение или None, если его нет или истек срок жизни
+        """
+        if not self.sets:
+            return None
+        now = time.time() if now is None else now
+        key_hash = get_key_hash(key)
+        set_offset = key_hash % self.sets * self.set_size
+        data = self.memory[set_offset:set_offset + self.set_size]
+        for offset in xrange(0, self.set_size, self.slot_size):
+            crc, _, slot_hash, expires, length = SLOT_HEADER.unpack_from(data, offset)
+            if slot_hash != key_hash or expires <= now or length > self.slot_size - SLOT_HEADER.size:
+                continue
+            end = offset + SLOT_HEADER.size + length
+            if zlib.crc32(data[offset + CHECKED_OFFSET:end]) & 0xffffffff != crc:
+                continue
+            slot_key, value = marshal.loads(data[offset + SLOT_HEADER.size:end])
+            if slot_key != key:
+                continue
+            struct.pack_into('<d', self.memory, set_offset + offset + 4, now)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl, now=None):
+        """
+        Кладет значение на ttl секунд. Значение должно сериализоваться marshal.
+        """
+        if not self.sets:
+            return
+        payload = marshal.dumps((key, value))
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            self.skipped += 1
+            return
+        now = time.time() if now is None else now
+        key_hash = get_key_hash(key)
+        set_offset = key_hash % self.sets * self.set_size
+        data = self.memory[set_offset:set_offset + self.set_size]
+        victim = None
+        for offset in xrange(0, self.set_size, self.slot_size):
+            _, last_used, slot_hash, expires, _ = SLOT_HEADER.unpack_from(data, offset)
+            if slot_hash == key_hash:
+                victim = offset
+                break
+            if expires <= now:
+                last_used = -1
+            if victim is None or last_used < victim_last_used:
+                victim, victim_last_used = offset, last_used
+
+        checked = struct.pack('<QdH', key_hash, now + ttl, len(payload)) + payload
+        slot = struct.pack('<Id', zlib.crc32(checked) & 0xffffffff, now) + checked
+        offset = set_offset + victim
+        self.memory[offset:offset + len(slot)] = slot
+
+    def clear(self):
+        """Удаляет все записи - для всех процессов, которые делят кэш"""
+        if not self.sets:
+            return
+        # нулевой слот просрочен и ничей
+        empty = '\0' * self.set_size
+        for offset in xrange(0, self.sets * self.set_size, self.set_size):
+            self.memory[offset:offset + self.set_size] = empty
+
+    def flush(self):
+        """Дописывает в файл измененные страницы памяти, для анонимной памяти ничего не делает"""
+        if self.memory is not None and self.path is not None:
+            self.memory.flush()
+
+    @staticmethod
+    def _map(size, path):
+        if path is None:
+            # mmap(-1, ...) - MAP_SHARED | MAP_ANONYMOUS, память видна потомкам после fork
+            return mmap.mmap(-1, size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        try:
+            info = os.fstat(fd)
+            if not stat.S_ISREG(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0022:
+                raise OSError(errno.EPERM, 'Cache file is not a file of the current user', path)
+            if info.st_size != size:
+                os.ftruncate(fd, size)
+            return mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': self.sets * self.set_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / requests if requests else 0.0,
+            'skipped': self.skipped,
+        }
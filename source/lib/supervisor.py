@@ -0,0 +1,376 @@
+# coding: utf-8
+from collections import deque
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+from logging import getLogger
+import os
+import select
+import signal
+from time import time
+
+from .utils import spawn_workers
+
+logger = getLogger('redirect_checker')
+
+PR_SET_PDEATHSIG = 1
+
+HEARTBEAT = 'heartbeat'
+"""Воркер -> родитель: (HEARTBEAT, pid, задач в работе, воркер сам решил завершиться, состояние воркера)"""
+DRAIN = 'drain'
+"""Родитель -> воркер: перестать брать задачи, доделать начатые и выйти"""
+PAUSE = 'pause'
+"""Родитель -> воркер: вернуть начатые задачи в очередь и не брать новые до RESUME"""
+RESUME = 'resume'
+"""Родитель -> воркер: снова брать задачи"""
+FLUSH = 'flush'
+"""Родитель -> воркер: закрыть простаивающие соединения и забыть DNS-кэш"""
+PROFILE = 'profile'
+"""Родитель -> воркер: (PROFILE, секунд) - снять профиль воркера, см. profiler.SamplingProfiler"""
+
+RATE_WINDOW = 60
+"""За сколько последних секунд считаются скорости задач и ошибок пула"""
+
+libc = None
+"""libc для prctl, загружается один раз: find_library запускает ldconfig"""
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def get_private_rss():
+    """
+    :return: сколько байт памяти занимает процесс без общей с другими процессами
+        (общие кэши воркеров и код), 0 - не удалось узнать (не Linux)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            fields = statm.read().split()
+        return (int(fields[1]) - int(fields[2])) * PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
+def get_libc():
+    global libc
+    if libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc
+
+
+def init_worker_process(parent_pid, death_signal=signal.SIGTERM):
+    """
+    Готовит процесс воркера: сбрасывает унаследованные от родителя SIGCHLD
+    и wakeup fd и просит ядро прислать death_signal, когда родитель умрет
+    (prctl PR_SET_PDEATHSIG, только Linux) - вместо проверки /proc на каждой итерации.
+
+    :return: жив ли родитель (он мог умереть до вызова prctl)
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+    try:
+        if get_libc().prctl(PR_SET_PDEATHSIG, death_signal) != 0:
+            raise OSError(ctypes.get_errno(), 'prctl failed')
+    except (OSError, AttributeError) as e:
+        logger.warning(u'Parent death signal is not set, parent is checked by heartbeats only: {}'.format(e))
+    return os.getppid() == parent_pid
+
+
+def heartbeat(channel, in_flight, timeout=0, draining=False, status=None):
+    """
+    Сообщает родителю, что воркер жив, и забирает присланные им команды
+
+    :param channel: конец канала воркера, None - воркер запущен без родителя
+    :param timeout: сколько секунд ждать команды, если их еще нет
+    :param draining: воркер доделывает задачи и выйдет, родитель может сразу запустить замену
+    :param status: словарь состояния воркера для отчета: state, hosts, tasks и errors с его запуска
+    :return: список команд; [DRAIN], если родителя больше нет
+    """
+    if channel is None:
+        return []
+    commands = []
+    try:
+        channel.send((HEARTBEAT, os.getpid(), in_flight, draining, status or {}))
+        if timeout:
+            channel.poll(timeout)
+        while channel.poll():
+            commands.append(channel.recv())
+    except (IOError, EOFError):
+        return [DRAIN]
+    return commands
+
+
+class WorkerState(object):
+    def __init__(self, process, channel, now):
+        self.process = process
+        self.channel = channel
+        self.last_seen = now
+        self.in_flight = 0
+        self.drain_deadline = None
+        self.status = {}
+
+
+class WorkerPool(object):
+    """
+    Воркеры главного процесса и каналы к ним.
+
+    Воркер шлет по каналу heartbeat; кто молчит дольше heartbeat_timeout,
+    считается зависшим и убивается. Остановка воркера - команда DRAIN: он
+    перестает брать задачи, доделывает начатые и выходит, а не успевший
+    за drain_timeout убивается. Воркер может и сам начать выход (превысил
+    лимит памяти или задач) - тогда он сообщает об этом в heartbeat и сразу
+    перестает занимать место в пуле. На время без сети воркеры ставятся на
+    паузу (PAUSE/RESUME) и сохраняют кэши. Завершение воркера будит wait() через
+    SIGCHLD и wakeup fd, так что его место освобождается сразу.
+
+    С fork_server (см. forkserver.ForkServer) воркеры запускает шаблон,
+    о завершении воркера он сообщает по своему каналу. Если шаблон умер,
+    следующие воркеры пул запускает сам, как без него.
+
+    В heartbeat воркер присылает и свое состояние (get_workers), по его
+    счетчикам задач пул считает скорости (get_rates). Другие дескрипторы
+    главного процесса (сокет управления) обслуживаются в wait() через watch().
+    """
+
+    def __init__(self, target, args, heartbeat_timeout, drain_timeout, fork_server=None):
+        self.target = target
+        self.args = args
+        self.fork_server = fork_server
+        self.heartbeat_timeout = heartbeat_timeout
+        self.drain_timeout = drain_timeout
+        self.workers = {}
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.killed = 0
+        self.recycled = 0
+        self.paused = False
+        self.readers = {}
+        # задачи и ошибки всех воркеров пула, в том числе завершившихся
+        self.tasks_done = 0
+        self.task_errors = 0
+        self.samples = deque()
+
+    def __len__(self):
+        """Сколько воркеров работает, не считая останавливаемых"""
+        return sum(1 for state in self.workers.itervalues() if state.drain_deadline is None)
+
+    def install_signal_handlers(self):
+        """SIGCHLD прерывает wait(), даже если пришел до select"""
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeup_write_fd)
+
+    def spawn(self, num, parent_pid):
+        self._check_fork_server()
+        if self.fork_server is not None:
+            workers = self.fork_server.spawn(num)
+        else:
+            workers = spawn_workers(num, self.target, self.args, parent_pid)
+        now = time()
+        for process, channel in workers:
+            state = self.workers[process.pid] = WorkerState(process, channel, now)
+            if self.paused:
+                self._send(process.pid, state, PAUSE)
+
+    def drain(self, num=None):
+        """
+        Просит воркеры доделать задачи и выйти
+        :param num: сколько наименее загруженных воркеров остановить, None - все
+        """
+        now = time()
+        running = sorted((state.in_flight, pid) for pid, state in self.workers.iteritems()
+                         if state.drain_deadline is None)
+        for _, pid in running[:num]:
+            state = self.workers[pid]
+            state.drain_deadline = now + self.drain_timeout
+            self._send(pid, state, DRAIN)
+
+    def flush(self):
+        """Просит воркеры закрыть простаивающие соединения и забыть DNS-кэш"""
+        self._send_all(FLUSH)
+
+    def profile(self, duration):
+        """Просит воркеры снять свой профиль за duration секунд"""
+        self._send_all((PROFILE, duration))
+
+    def watch(self, fileobj, callback):
+        """wait() вызывает callback, когда fileobj готов к чтению"""
+        self.readers[fileobj.fileno()] = callback
+
+    def pause(self):
+        """Просит воркеры вернуть задачи в очередь и ждать resume(); новые воркеры стартуют на паузе"""
+        self._send_all(PAUSE)
+        self.paused = True
+
+    def resume(self):
+        self._send_all(RESUME)
+        self.paused = False
+
+    def wake_up(self):
+        """Прерывает wait(), можно вызывать из другого потока"""
+        try:
+            os.write(self.wakeup_write_fd, '\0')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """
+        Ждет сообщений воркеров или завершения воркера не дольше timeout секунд,
+        затем убирает завершившиеся и убивает зависшие воркеры.
+        """
+        channels = dict((state.channel.fileno(), state) for state in self.workers.itervalues())
+        fds = [self.wakeup_fd] + channels.keys() + self.readers.keys()
+        if self.fork_server is not None:
+            fds.append(self.fork_server.fileno())
+        try:
+            readable, _, _ = select.select(fds, [], [], max(timeout, 0))
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        now = time()
+        for fd in readable:
+            if fd == self.wakeup_fd:
+                self._clear_wakeup()
+            elif fd in self.readers:
+                self.readers[fd]()
+            elif fd not in channels:
+                self.fork_server.read_messages()
+                self._check_fork_server()
+            else:
+                self._read_messages(channels[fd], now)
+        self._reap()
+        self._kill_stuck(now)
+        self._sample(now)
+
+    def _check_fork_server(self):
+        """
+        Отказывается от умершего шаблона: новый пришлось бы форкать из главного процесса
+        с уже запущенными потоками, так что дальше воркеры запускает spawn_workers
+        """
+        if self.fork_server is None or self.fork_server.is_alive():
+            return
+        logger.error(u'Fork server {} is lost (exit code {}), spawning workers from the main process'.format(
+            self.fork_server.process.pid, self.fork_server.process.exitcode))
+        self.fork_server.read_messages()
+        self.fork_server = None
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        for fd in (self.wakeup_fd, self.wakeup_write_fd):
+            os.close(fd)
+
+    def get_stats(self):
+        return {
+            'workers': len(self),
+            'draining': len(self.workers) - len(self),
+            'in_flight': sum(state.in_flight for state in self.workers.itervalues()),
+            'killed': self.killed,
+            'recycled': self.recycled,
+            'paused': self.paused,
+        }
+
+    def get_rates(self):
+        """
+        :return: сколько задач в секунду завершают воркеры пула и сколько из них оборвались ошибкой
+        """
+        if len(self.samples) < 2 or self.samples[-1][0] <= self.samples[0][0]:
+            return {'tasks': 0.0, 'errors': 0.0}
+        (start, tasks, errors), (end, last_tasks, last_errors) = self.samples[0], self.samples[-1]
+        duration = float(end - start)
+        return {
+            'tasks': round((last_tasks - tasks) / duration, 2),
+            'errors': round((last_errors - errors) / duration, 2),
+        }
+
+    def get_workers(self, now=None):
+        """
+        :return: состояние каждого воркера по его последнему heartbeat, по pid
+        """
+        now = time() if now is None else now
+        workers = []
+        for pid, state in sorted(self.workers.iteritems()):
+            worker = dict(state.status)
+            worker.update({
+                'pid': pid,
+                'in_flight': state.in_flight,
+                'draining': state.drain_deadline is not None,
+                'last_seen': round(max(now - state.last_seen, 0), 1),
+            })
+            workers.append(worker)
+        return workers
+
+    def _send(self, pid, state, command):
+        try:
+            state.channel.send(command)
+        except IOError as e:
+            logger.warning(u'Worker {} did not get {} command: {}'.format(pid, command, e))
+
+    def _send_all(self, command):
+        for pid, state in self.workers.iteritems():
+            if state.drain_deadline is None:
+                self._send(pid, state, command)
+
+    def _clear_wakeup(self):
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _read_messages(self, state, now):
+        try:
+            while state.channel.poll():
+                message = state.channel.recv()
+                if message[0] == HEARTBEAT:
+                    state.last_seen = now
+                    state.in_flight = message[2]
+                    if message[3] and state.drain_deadline is None:
+                        state.drain_deadline = now + self.drain_timeout
+                        self.recycled += 1
+                    if len(message) > 4:
+                        self._update_status(state, message[4])
+        except (IOError, EOFError):
+            # канал закрыт: воркер завершился, его уберет _reap
+            pass
+
+    def _update_status(self, state, status):
+        self.tasks_done += status.get('tasks', 0) - state.status.get('tasks', 0)
+        self.task_errors += status.get('errors', 0) - state.status.get('errors', 0)
+        state.status = status
+
+    def _sample(self, now):
+        """Запоминает счетчики задач не чаще раза в секунду, для скоростей за RATE_WINDOW"""
+        if self.samples and now - self.samples[-1][0] < 1:
+            return
+        self.samples.append((now, self.tasks_done, self.task_errors))
+        while now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+
+    def _reap(self):
+        for pid, state in self.workers.items():
+            if not state.process.is_alive():
+                logger.info(u'Worker {} exited with code {}'.format(pid, state.process.exitcode))
+                state.channel.close()
+                del self.workers[pid]
+
+    def _kill_stuck(self, now):
+        for pid, state in self.workers.iteritems():
+            if state.drain_deadline is not None and now > state.drain_deadline:
+                reason = u'did not drain in {}s'.format(self.drain_timeout)
+            elif now - state.last_seen > self.heartbeat_timeout:
+                reason = u'sent no heartbeat for {:.0f}s'.format(now - state.last_seen)
+            else:
+                continue
+            logger.error(u'Worker {} {}, killing it'.format(pid, reason))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+            # не убивать повторно, пока SIGCHLD не уберет его из пула
+            state.last_seen = state.drain_deadline = float('inf')
+            self.killed += 1
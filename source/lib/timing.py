@@ -0,0 +1,192 @@
+# coding: utf-8
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import os
+import socket
+from time import time
+
+from .latency import LATENCY_BUCKETS
+
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+"""Верхние границы корзин гистограмм размера в байтах"""
+STATSD_PACKET_SIZE = 1432
+"""Сколько байт строк statsd помещается в одну датаграмму без фрагментации"""
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        """
+        :param buckets: верхние границы корзин, за последней - корзина для всего, что больше
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_percentile(self, percentile):
+        """
+        :return: верхняя граница корзины перцентиля, None - значений нет
+        """
+        if not self.count:
+            return None
+        rank = percentile * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        # для последней корзины границы нет, берем вдвое больше предыдущей
+        return self.buckets[bucket] if bucket < len(self.buckets) else self.buckets[-1] * 2
+
+
+class Metrics(object):
+    """
+    Гистограммы таймингов текущего процесса: фазы запросов curl, разбор страниц,
+    вызовы очереди. Копятся между выгрузками (take) и выгружаются экспортерами,
+    агрегация по воркерам - на стороне получателя. Выключенные метрики ничего не
+    измеряют, включаются в воркере (enable).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.buckets = {}
+        self.histograms = {}
+
+    def enable(self, buckets=None):
+        """
+        :param buckets: имя -> границы корзин, остальные гистограммы - по LATENCY_BUCKETS (секунды)
+        """
+        self.enabled = True
+        self.buckets = dict(buckets or {})
+        self.histograms = {}
+
+    def add(self, name, value):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+        histogram.add(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Учитывает в гистограмме name время выполнения блока в секундах"""
+        if not self.enabled:
+            yield
+            return
+        started = time()
+        try:
+            yield
+        finally:
+            self.add(name, time() - started)
+
+    def take(self):
+        """
+        :return: накопленные с прошлого раза гистограммы, имя -> Histogram
+        """
+        histograms, self.histograms = self.histograms, {}
+        return histograms
+
+    def get_stats(self):
+        """Для лога: число значений и перцентили накопленных гистограмм"""
+        return dict((name, {
+            'count': histogram.count,
+            'p50': histogram.get_percentile(0.5),
+            'p99': histogram.get_percentile(0.99),
+        }) for name, histogram in self.histograms.iteritems())
+
+
+def format_bound(bound):
+    return str(bound).replace('.', '_')
+
+
+class StatsdExporter(object):
+    """
+    Выгружает гистограммы счетчиками statsd по UDP: на каждую корзину - число
+    значений не больше ее границы (name.le_0_05), плюс name.le_inf (все значения)
+    и name.sum в единицах гистограммы. Счетчики складываются получателем, так что
+    гистограммы разных воркеров агрегируются без потерь.
+    Недоставленные датаграммы не повторяются.
+    """
+
+    def __init__(self, address, prefix):
+        self.address = address
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.dropped = 0
+
+    def format(self, name, histogram):
+        name = '{}.{}'.format(self.prefix, name)
+        lines = []
+        seen = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            seen += count
+            if seen:
+                lines.append('{}.le_{}:{}|c'.format(name, format_bound(bound), seen))
+        lines.append('{}.le_inf:{}|c'.format(name, histogram.count))
+        lines.append('{}.sum:{:.3f}|c'.format(name, histogram.sum))
+        return lines
+
+    def export(self, histograms):
+        packet = []
+        size = 0
+        for name in sorted(histograms):
+            for line in self.format(name, histograms[name]):
+                if packet and size + len(line) + 1 > STATSD_PACKET_SIZE:
+                    self.send(packet)
+                    packet = []
+                    size = 0
+                packet.append(line)
+                size += len(line) + 1
+        if packet:
+            self.send(packet)
+
+    def send(self, lines):
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            self.dropped += 1
+
+    def close(self):
+        self.socket.close()
+
+
+class FileExporter(object):
+    """
+    Дописывает гистограммы в файл строкой JSON за раз: время, pid воркера,
+    имя -> границы корзин, число значений в корзинах, их сумма.
+    Строка пишется одним write в режиме O_APPEND, воркеры пишут в один файл.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, histograms):
+        if not histograms:
+            return
+        line = json.dumps({
+            'time': time(),
+            'pid': os.getpid(),
+            'histograms': dict((name, {
+                'buckets': histogram.buckets,
+                'counts': histogram.counts,
+                'sum': histogram.sum,
+            }) for name, histogram in histograms.iteritems()),
+        }, sort_keys=True) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        pass
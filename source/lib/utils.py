@@ -1,8 +1,10 @@
 # coding: utf-8
 import argparse
-from multiprocessing import Process
+import errno
+from multiprocessing import Pipe, Process
 import os
 import socket
+import stat
 import urllib2
 
 from tarantool_queue import tarantool_queue
@@ -38,6 +40,21 @@ def create_pidfile(pidfile_path):
         f.write(pid)
 
 
+def create_private_dir(path):
+    """
+    Создает каталог, доступный только текущему пользователю, или проверяет существующий.
+    :raises OSError: это не каталог, он чужой или доступен другим
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+        raise OSError(errno.EPERM, 'Not a private directory of the current user', path)
+
+
 def exec_pyfile(filepath):
     variables = {}
     execfile(filepath, variables)
@@ -63,6 +80,22 @@ def load_config_from_pyfile(filepath):
     return cfg
 
 
+def load_counter_types_from_pyfile(filepath):
+    """
+    Загружает правила счетчиков из py файла.
+
+    Файл должен определять COUNTER_TYPES - последовательность пар
+    (тип счетчика, регулярка вида .*литерал.*).
+
+    :param filepath: путь до py файла с правилами
+    :type filepath: basestring
+
+    :rtype: list
+    """
+    variables = exec_pyfile(filepath)
+    return list(variables['COUNTER_TYPES'])
+
+
 def parse_cmd_args(args, app_description=''):
     """
     Разбирает аргументы командной строки.
@@ -106,6 +139,64 @@ def get_tube(host, port, space, name):
     return queue.tube(name)
 
 
+def take_tasks(tube, count, timeout):
+    """
+    Берет до count задач одним вызовом queue.take_batch (provision/init.lua):
+    первую задачу ждет timeout секунд (0 - не ждет), остальные берет, только если они готовы.
+    :return: список задач
+    """
+    queue = tube.queue
+    response = queue.tnt.call('queue.take_batch', (
+        str(queue.space), str(tube.opt['tube']), str(timeout), str(count)
+    ))
+    return [
+        tarantool_queue.Task(queue, space=queue.space, task_id=row[0], tube=row[1], status=row[2], raw_data=row[3])
+        for row in response
+    ]
+
+
+def put_tasks(tube, tasks):
+    """
+    Кладет задачи в очередь одним вызовом queue.put_batch, ответ приходит после их записи.
+    :param tasks: список (данные, задержка, приоритет), приоритет None - приоритет очереди
+    """
+    if not tasks:
+        return
+    args = [str(tube.queue.space), str(tube.opt['tube'])]
+    for data, delay, pri in tasks:
+        args.extend((
+            str(delay),
+            str(tube.opt['ttl']),
+            str(tube.opt['ttr']),
+            str(tube.opt['pri'] if pri is None else pri),
+            tube.serialize(data)
+        ))
+    tube.queue.tnt.call('queue.put_batch', tuple(args))
+
+
+def ack_tasks(tube, tasks):
+    """
+    Подтверждает задачи одним вызовом queue.ack_batch
+    :return: сколько задач подтверждено
+    """
+    if not tasks:
+        return 0
+    for task in tasks:
+        # иначе задача вернется в очередь при сборке мусора
+        task.modified = True
+    response = tube.queue.tnt.call('queue.ack_batch', tuple(
+        [str(tube.queue.space)] + [task.task_id for task in tasks]
+    ))
+    return response.rowcount
+
+
+def get_tube_stats(tube):
+    """
+    :return: словарь со счетчиками задач трубы по статусам (ready, taken, delayed, ...)
+    """
+    return dict((status, int(count)) for status, count in tube.statistics()['tasks'].iteritems())
+
+
 class Config(object):
     """
     Класс для хранения настроек приложения.
@@ -114,10 +205,19 @@ class Config(object):
 
 
 def spawn_workers(num, target, args, parent_pid):
+    """
+    Запускает num воркеров, у каждого свой канал к родителю (kwargs channel)
+    :return: список пар (процесс, конец канала родителя)
+    """
+    workers = []
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        channel, worker_channel = Pipe()
+        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid, 'channel': worker_channel})
         p.daemon = True
         p.start()
+        worker_channel.close()
+        workers.append((p, channel))
+    return workers
 
 
 def check_network_status(check_url, timeout):
@@ -1,28 +1,59 @@
 # coding: utf-8
 from logging import getLogger
-import os.path
+from math import ceil
+from random import Random
+import signal
+from time import time
 
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
 
-from utils import get_tube
+from . import (to_unicode, curl_pool, dns_cache, hop_cache, suffix_cache, meta_stats, host_breaker, host_latency,
+               init_curl_pool, init_dns_cache, MultiRedirectResolver, set_counter_types, get_url_retry_delay, metrics,
+               init_metrics, reset_connections)
+from timing import StatsdExporter, FileExporter
+from supervisor import init_worker_process, heartbeat, get_private_rss, DRAIN, PAUSE, RESUME, FLUSH, PROFILE
+from utils import get_tube, load_counter_types_from_pyfile, take_tasks, put_tasks, ack_tasks
 
 logger = getLogger('redirect_checker')
 
+reload_counters = False
+drain_requested = False
+preloaded = False
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+
+def is_broken(history_types):
+    """Оборвалась ли цепочка ошибкой или по сроку"""
+    return bool(history_types) and history_types[-1] in ('ERROR', 'DEADLINE')
+
+
+def get_url_from_task(task):
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
         task.task_id, url, task.data["url_id"], is_recheck
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
-    if 'ERROR' in history_types and not is_recheck:
+
+def get_result_from_history(task, history, max_rechecks=1):
+    """
+    Формирует результат задачи по найденной истории редиректов.
+    Оборвавшаяся цепочка перепроверяется до max_rechecks раз, пройденная часть
+    сохраняется в задаче (resume), и перепроверка начинается с упавшего перехода.
+    :return: нужно ли вернуть задачу во входную очередь, данные задачи
+    """
+    history_types, history_urls, counters = history
+    rechecks = task.data.get('rechecks', 1 if task.data.get('recheck') else 0)
+
+    if is_broken(history_types) and rechecks < max_rechecks:
         task.data['recheck'] = True
+        task.data['rechecks'] = rechecks + 1
+        if len(history_types) > 1:
+            # последний урл пройденной части - тот, на котором цепочка оборвалась
+            task.data['resume'] = [history_types[:-1], history_urls[:-1]]
+        else:
+            task.data.pop('resume', None)
         data = task.data
         is_input = True
     else:
@@ -38,7 +69,216 @@ def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=N
     return is_input, data
 
 
-def worker(config, parent_pid):
+def get_recheck_delay(history, config, rechecks=1, random=None):
+    """
+    Задержка перепроверки растет экспоненциально с номером перепроверки, начальная
+    задержка и потолок зависят от класса ошибки (RECHECK_BACKOFF, остальные - RECHECK_DELAY),
+    разброс до RECHECK_JITTER разводит перепроверки упавших вместе цепочек.
+    Перепроверка откладывается, пока отключен хост, на котором цепочка оборвалась ошибкой.
+
+    :param rechecks: номер перепроверки, с 1
+    :param random: источник разброса, по умолчанию новый Random()
+    """
+    history_types, history_urls, _ = history
+    if not is_broken(history_types):
+        return config.RECHECK_DELAY
+    base, cap = config.RECHECK_BACKOFF.get(getattr(history, 'error', None),
+                                           (config.RECHECK_DELAY, config.RECHECK_DELAY))
+    delay = min(cap, base * 2 ** max(rechecks - 1, 0))
+    delay *= 1 - (random or Random()).uniform(0, config.RECHECK_JITTER)
+    if history_types[-1] == 'ERROR':
+        delay = max(delay, get_url_retry_delay(history_urls[-1]))
+    return int(ceil(delay))
+
+
+def finish_tasks(finished, input_tube, output_tube, config):
+    """
+    Кладет результаты задач в нужные очереди и подтверждает задачи, все - пачками.
+    Задачи подтверждаются только после того, как их результаты записаны:
+    если запись не удалась, задачи вернутся в очередь и будут проверены снова.
+
+    :param finished: список (задача, результат, задержка перепроверки)
+    """
+    inputs = []
+    outputs = []
+    for task, result, recheck_delay in finished:
+        if not result:
+            continue
+        is_input, data = result
+        if is_input:
+            inputs.append((data, config.RECHECK_DELAY if recheck_delay is None else recheck_delay,
+                           task.meta()['pri']))
+        else:
+            outputs.append((data, 0, None))
+        logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+    with metrics.timer('queue.put'):
+        put_tasks(output_tube, outputs)
+    with metrics.timer('queue.put'):
+        put_tasks(input_tube, inputs)
+
+    tasks = [task for task, _, _ in finished]
+    try:
+        with metrics.timer('queue.ack'):
+            acked = ack_tasks(input_tube, tasks)
+    except DatabaseError as e:
+        logger.info('Task ack fail')
+        logger.exception(e)
+        return
+    for task in tasks:
+        logger.info(u'Task id={} done'.format(task.task_id))
+    if acked < len(tasks):
+        logger.warning(u'{} of {} tasks are not acked'.format(len(tasks) - acked, len(tasks)))
+
+
+def get_task_limit(config):
+    """
+    Лимит задач воркера с разбросом до RECYCLE_JITTER, чтобы запущенные
+    вместе воркеры не перезапускались тоже все вместе
+    """
+    if not config.MAX_TASKS_PER_WORKER:
+        return 0
+    # Random() берет seed из urandom: состояние модуля random у форков одинаковое
+    return int(config.MAX_TASKS_PER_WORKER * (1 - Random().uniform(0, config.RECYCLE_JITTER)))
+
+
+def get_recycle_reason(tasks_done, task_limit, rss, config):
+    """
+    :param rss: память воркера без общей, см. get_private_rss
+    :return: почему воркер пора перезапустить, None - рано
+    """
+    if task_limit and tasks_done >= task_limit:
+        return u'processed {} tasks, limit is {}'.format(tasks_done, task_limit)
+    if config.MAX_WORKER_RSS and rss > config.MAX_WORKER_RSS:
+        return u'private RSS is {:.1f}MB, limit is {:.1f}MB'.format(rss / 1048576.0,
+                                                                  config.MAX_WORKER_RSS / 1048576.0)
+    return None
+
+
+def release_tasks(tasks):
+    """
+    Возвращает в очередь задачи, проверка которых прервана, без результата
+    """
+    for task in tasks:
+        try:
+            task.release()
+        except DatabaseError as e:
+            logger.info(u'Task id={} release fail'.format(task.task_id))
+            logger.exception(e)
+    if tasks:
+        logger.info(u'Released {} tasks'.format(len(tasks)))
+
+
+def log_stats():
+    logger.info(u'Curl pool stats: {}'.format(curl_pool.get_stats()))
+    logger.info(u'DNS cache stats: {}'.format(dns_cache.get_stats()))
+    logger.info(u'Meta tag search stats: {}'.format(meta_stats))
+    logger.info(u'Hop cache stats: {}'.format(hop_cache.get_stats()))
+    logger.info(u'Chain suffix cache stats: {}'.format(suffix_cache.get_stats()))
+    logger.info(u'Host breaker stats: {}'.format(host_breaker.get_stats()))
+    logger.info(u'Host latency stats: {}'.format(host_latency.get_stats()))
+    if metrics.enabled:
+        logger.info(u'Timing stats: {}'.format(metrics.get_stats()))
+
+
+def get_metrics_exporters(config):
+    """
+    :return: куда выгружать метрики по конфигу, пустой список - метрики выключены
+    """
+    exporters = []
+    if config.METRICS_STATSD_ADDRESS:
+        exporters.append(StatsdExporter(config.METRICS_STATSD_ADDRESS, config.METRICS_PREFIX))
+    if config.METRICS_FILE:
+        exporters.append(FileExporter(config.METRICS_FILE))
+    return exporters
+
+
+def export_metrics(exporters):
+    """Выгружает накопленные метрики, ошибка одного экспортера не мешает остальным"""
+    histograms = metrics.take()
+    for exporter in exporters:
+        try:
+            exporter.export(histograms)
+        except (IOError, OSError) as e:
+            logger.warning(u'Metrics export to {} failed: {}'.format(type(exporter).__name__, e))
+
+
+def get_worker_status(resolver, paused, tasks_done, task_errors):
+    """
+    Состояние воркера для отчета родителю (см. heartbeat): чем он занят между
+    раундами резолвера, к каким хостам идет больше всего запросов, сколько задач
+    он завершил и сколько из них оборвались ошибкой
+    """
+    if drain_requested:
+        state = 'draining'
+    elif paused:
+        state = 'paused'
+    elif len(resolver):
+        state = 'fetching'
+    elif resolver.waiting:
+        state = 'waiting_for_hosts'
+    else:
+        state = 'idle'
+    return {
+        'state': state,
+        'hosts': resolver.get_busy_hosts(),
+        'tasks': tasks_done,
+        'errors': task_errors,
+    }
+
+
+def request_counters_reload(signum, frame):
+    """Обработчик SIGHUP: правила счетчиков перечитываются в основном цикле"""
+    global reload_counters
+    reload_counters = True
+
+
+def request_drain(signum, frame):
+    """
+    Обработчик SIGTERM (его же ядро присылает при смерти родителя):
+    воркер перестает брать задачи, доделывает начатые и выходит
+    """
+    global drain_requested
+    drain_requested = True
+
+
+def load_counter_rules(config):
+    """
+    Загружает правила счетчиков из COUNTER_RULES_FILE.
+    Если файл не загрузился, остаются прежние правила.
+    """
+    if not config.COUNTER_RULES_FILE:
+        return
+    try:
+        count = set_counter_types(load_counter_types_from_pyfile(config.COUNTER_RULES_FILE))
+    except Exception as e:
+        logger.error(u'Counter rules from {} are not loaded'.format(config.COUNTER_RULES_FILE))
+        logger.exception(e)
+    else:
+        logger.info(u'Loaded {} counter rules from {}'.format(count, config.COUNTER_RULES_FILE))
+
+
+def preload_worker(config):
+    """
+    Выполняется один раз в шаблоне воркеров (ForkServer):
+    воркеры получают загруженные правила счетчиков готовыми
+    """
+    global preloaded
+    load_counter_rules(config)
+    preloaded = True
+
+
+def worker(config, parent_pid, channel=None, profiler_class=None):
+    """
+    :param channel: канал к родителю для heartbeat и команд (см. supervisor)
+    :param profiler_class: класс профайлера воркера (profiler.SamplingProfiler, его передает
+        redirect_checker: пакет lib не зависит от модулей рядом с ним), None - без профилирования
+    """
+    global reload_counters, drain_requested
+
+    signal.signal(signal.SIGTERM, request_drain)
+    signal.siginterrupt(signal.SIGTERM, False)
+    drain_requested = not init_worker_process(parent_pid)
+
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -65,35 +305,139 @@ def worker(config, parent_pid):
         name=output_tube.opt['tube']
     ))
 
-    parent_proc = '/proc/{}'.format(parent_pid)
-
-    # run while parent is alive
-    while os.path.exists(parent_proc):
-        task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
-        if task:
-            logger.info(u'Starting task id={}.'.format(task.task_id))
-            result = get_redirect_history_from_task(
-                task,
-                config.HTTP_TIMEOUT,
-                config.MAX_REDIRECTS,
-                config.USER_AGENT
-            )
-            if result:
-                is_input, data = result
-                if is_input:
-                    input_tube.put(
-                        data,
-                        delay=config.RECHECK_DELAY,
-                        pri=task.meta()['pri']
-                    )
-                else:
-                    output_tube.put(data)
-                logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
-            try:
-                task.ack()
-                logger.info(u'Task id={} done'.format(task.task_id))
-            except DatabaseError as e:
-                logger.info('Task ack fail')
-                logger.exception(e)
-    else:
-        logger.info('Parent is dead. exiting')
+    init_curl_pool(config.CURL_POOL_SIZE, config.CURL_POOL_MAX_IDLE_TIME)
+    init_dns_cache(config.DNS_CACHE_TTL)
+    signal.signal(signal.SIGHUP, request_counters_reload)
+    signal.siginterrupt(signal.SIGHUP, False)
+    profiler = None
+    if profiler_class is not None:
+        # SIGUSR2 - снять профиль воркера, файл стеков пишется через PROFILE_DURATION секунд
+        profiler = profiler_class('redirect_checker', config.PROFILE_DIR, config.PROFILE_DURATION,
+                                  config.PROFILE_INTERVAL)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start())
+        signal.siginterrupt(signal.SIGUSR2, False)
+    if not preloaded:
+        load_counter_rules(config)
+    resolver = MultiRedirectResolver(
+        config.HTTP_TIMEOUT,
+        config.MAX_REDIRECTS,
+        config.USER_AGENT,
+        config.MAX_CONTENT_SIZE,
+        config.HOST_CONCURRENCY_LIMITS,
+        config.HOST_CONCURRENCY_DEFAULT,
+        config.HTTP_CONNECT_TIMEOUT,
+        config.TASK_DEADLINE
+    )
+
+    next_stats_time = time() + config.STATS_LOG_INTERVAL
+    exporters = get_metrics_exporters(config)
+    if exporters:
+        init_metrics()
+    next_metrics_time = time() + config.METRICS_INTERVAL
+    next_heartbeat_time = time()
+    # превысивший лимит воркер доделывает задачи и выходит, пул запускает замену
+    task_limit = get_task_limit(config)
+    tasks_done = 0
+    task_errors = 0
+    recycling = False
+    # разброс задержек перепроверки, свой у каждого воркера
+    random = Random()
+    # результаты копятся до RESULT_BATCH_SIZE задач или RESULT_BATCH_LINGER секунд
+    finished = []
+    flush_time = 0
+    # на паузе (нет сети) задачи не берутся, начатые возвращены в очередь
+    paused = False
+
+    # run until drained: parent asked for it, sent SIGTERM or died
+    while not drain_requested or len(resolver):
+        # keep up to MAX_TASKS_IN_FLIGHT tasks in the resolver,
+        # block on the queue only when there is nothing else to do;
+        # tasks waiting for a busy host do not hold back the others
+        while not drain_requested and not paused and len(resolver) < config.MAX_TASKS_IN_FLIGHT \
+                and resolver.waiting < config.MAX_TASKS_WAITING:
+            count = min(config.TAKE_BATCH_SIZE, config.MAX_TASKS_IN_FLIGHT - len(resolver))
+            started = time()
+            tasks = take_tasks(input_tube, count, config.QUEUE_TAKE_TIMEOUT if not len(resolver) else 0)
+            if tasks:
+                # пустой take только ждал задач, его время ничего не говорит об очереди
+                metrics.add('queue.take', time() - started)
+            for task in tasks:
+                logger.info(u'Starting task id={}.'.format(task.task_id))
+                # перепроверка идет мимо кэша переходов, чтобы не повторить ту же ошибку
+                resolver.add(get_url_from_task(task), task, use_cache=not task.data.get('recheck'),
+                             resume=task.data.get('resume'))
+            if len(tasks) < count:
+                break
+
+        for task, history in resolver.perform(config.QUEUE_TAKE_TIMEOUT):
+            if not finished:
+                flush_time = time() + config.RESULT_BATCH_LINGER
+            task_errors += is_broken(history[0])
+            result = get_result_from_history(task, history, config.RECHECK_MAX_ATTEMPTS)
+            finished.append((task, result, get_recheck_delay(history, config, task.data.get('rechecks', 1), random)))
+
+        if finished and (drain_requested or paused or len(finished) >= config.RESULT_BATCH_SIZE
+                         or time() >= flush_time):
+            finish_tasks(finished, input_tube, output_tube, config)
+            tasks_done += len(finished)
+            finished = []
+            reason = None if recycling else get_recycle_reason(tasks_done, task_limit, get_private_rss(), config)
+            if reason is not None:
+                logger.info(u'Recycling worker: {}'.format(reason))
+                recycling = drain_requested = True
+                next_heartbeat_time = 0
+
+        if reload_counters:
+            reload_counters = False
+            load_counter_rules(config)
+
+        # на паузе без задач воркер спит в ожидании команд родителя
+        idle = paused and not len(resolver) and not finished
+        if idle or time() >= next_heartbeat_time:
+            status = get_worker_status(resolver, paused, tasks_done, task_errors)
+            for command in heartbeat(channel, len(resolver), config.WORKER_HEARTBEAT_INTERVAL if idle else 0,
+                                     recycling, status):
+                if command == DRAIN:
+                    logger.info('Got drain command')
+                    drain_requested = True
+                elif command == PAUSE and not paused:
+                    logger.info('Got pause command')
+                    paused = True
+                    release_tasks(resolver.cancel())
+                elif command == RESUME and paused:
+                    logger.info('Got resume command')
+                    paused = False
+                elif command == FLUSH:
+                    logger.info('Got flush command')
+                    reset_connections()
+                elif isinstance(command, tuple) and command[0] == PROFILE:
+                    if profiler is not None:
+                        profiler.start(command[1])
+                    else:
+                        logger.info('Got profile command, but profiling is off')
+            next_heartbeat_time = time() + config.WORKER_HEARTBEAT_INTERVAL
+
+        if profiler is not None:
+            profiler.check()
+        if time() >= next_stats_time:
+            log_stats()
+            next_stats_time = time() + config.STATS_LOG_INTERVAL
+
+        if exporters and time() >= next_metrics_time:
+            export_metrics(exporters)
+            next_metrics_time = time() + config.METRICS_INTERVAL
+
+    release_tasks(resolver.close())
+    if finished:
+        finish_tasks(finished, input_tube, output_tube, config)
+        tasks_done += len(finished)
+    host_latency.flush()
+    if profiler is not None:
+        profiler.stop()
+    log_stats()
+    if exporters:
+        export_metrics(exporters)
+        for exporter in exporters:
+            exporter.close()
+    logger.info(u'Worker is drained. exiting. tasks={} private_rss={:.1f}MB'.format(
+        tasks_done, get_private_rss() / 1048576.0))
@@ -13,13 +13,16 @@ from threading import current_thread
 import gevent
 from gevent import Greenlet
 from gevent import queue as gevent_queue
-from gevent import sleep
+from gevent import getcurrent, sleep
+from gevent.hub import Hub
 from gevent.monkey import patch_all
 from gevent.pool import Pool
 import requests
 import tarantool
 import tarantool_queue
 
+from profiler import SamplingProfiler
+
 SIGNAL_EXIT_CODE_OFFSET = 128
 """Коды выхода рассчитываются как 128 + номер сигнала"""
 
@@ -32,6 +35,26 @@ exit_code = 0
 logger = logging.getLogger('pusher')
 
 
+def get_greenlet_name():
+    """
+    Имя текущего гринлета для стеков профайлера: функция, которую он выполняет,
+    hub - цикл событий gevent, main - основной цикл приложения.
+
+    :rtype: str
+    """
+    current = getcurrent()
+    if isinstance(current, Hub):
+        return 'hub'
+    run = getattr(current, '_run', None)
+    if run is None:
+        return 'main'
+    return getattr(run, '__name__', type(run).__name__)
+
+
+profiler = SamplingProfiler('pusher', get_task_name=get_greenlet_name)
+"""Профайлер по SIGUSR2, стеки подписаны гринлетами, в которых они сняты"""
+
+
 def notification_worker(task, task_queue, *args, **kwargs):
     """
     Обработчик задачи отправки уведомления.
@@ -177,6 +200,8 @@ def main_loop(config):
 
         done_with_processed_tasks(processed_task_queue)
 
+        profiler.check()
+
         sleep(config.SLEEP)
     else:
         logger.info('Stop application loop.')
@@ -283,6 +308,8 @@ def install_signal_handlers():
     for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT):
         gevent.signal(signum, stop_handler, signum)
 
+    gevent.signal(signal.SIGUSR2, profiler.start)
+
 
 def create_pidfile(pidfile_path):
     pid = str(os.getpid())
@@ -315,6 +342,8 @@ def main(argv):
 
     dictConfig(config.LOGGING)
 
+    profiler.configure(config.PROFILE_DIR, config.PROFILE_DURATION, config.PROFILE_INTERVAL)
+
     current_thread().name = 'pusher.main'
 
     install_signal_handlers()
@@ -332,6 +361,8 @@ def main(argv):
     else:
         logger.info('Stop application loop in main.')
 
+    profiler.stop()
+
     return exit_code
 
 
@@ -0,0 +1,126 @@
+# coding: utf-8
+# общий для redirect_checker и notification_pusher, поэтому вне пакета lib:
+# импорт lib тянет pycurl и состояние проверки редиректов
+from logging import getLogger
+import os
+import signal
+from time import time
+
+MAX_DEPTH = 64
+"""Сколько верхних кадров стека учитывать, глубже - обрезается"""
+
+
+def format_code(code):
+    return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    Семплирующий профайлер процесса по запросу (сигнал или команда).
+
+    ITIMER_PROF присылает SIGPROF каждые interval секунд процессорного
+    времени процесса, обработчик запоминает стек прерванного кода -
+    счетчик на кортеж объектов кода, без форматирования. Процесс, который
+    ждет ввода-вывода, не семплируется, так что накладные расходы
+    пропорциональны нагрузке: при interval 10 мс - сотня обходов стека
+    в секунду загруженного процессора. SIGPROF не прерывает системные вызовы.
+
+    Python обрабатывает сигналы в главном потоке, поэтому видны стеки только
+    его кода (в gevent - текущего гринлета, get_task_name подписывает их).
+    Через duration секунд (проверяет check() из основного цикла) стеки
+    пишутся в файл в формате collapsed stacks: "корень;...;лист число",
+    из него flamegraph.pl или speedscope строят flamegraph.
+    """
+
+    def __init__(self, name, directory='/tmp', duration=30, interval=0.01, get_task_name=None):
+        """
+        :param name: начало имени файла: {name}.{pid}.{время}.collapsed, и имя логгера
+        :param get_task_name: функция без аргументов, имя задачи для корня стека (гринлет), None - без него
+        """
+        self.name = name
+        self.logger = getLogger(name)
+        self.get_task_name = get_task_name
+        self.configure(directory, duration, interval)
+        self.deadline = None
+        self.stacks = {}
+        self.samples = 0
+
+    def configure(self, directory, duration=30, interval=0.01):
+        """
+        :param duration: сколько секунд профилировать по умолчанию
+        :param interval: секунд процессорного времени между семплами
+        """
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+
+    @property
+    def running(self):
+        return self.deadline is not None
+
+    def start(self, duration=None, now=None):
+        """
+        :return: False, если профайлер уже запущен
+        """
+        if self.running:
+            return False
+        now = time() if now is None else now
+        self.deadline = now + (self.duration if duration is None else duration)
+        self.stacks = {}
+        self.samples = 0
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.logger.info(u'Profiling process {} for {:.0f}s'.format(os.getpid(), self.deadline - now))
+        return True
+
+    def check(self, now=None):
+        """
+        Останавливает профайлер, если вышел срок
+        :return: путь к файлу стеков, None - профайлер не останавливался
+        """
+        if self.running and (time() if now is None else now) >= self.deadline:
+            return self.stop()
+        return None
+
+    def stop(self):
+        """
+        Останавливает профайлер и пишет стеки в файл
+        :return: путь к файлу, None - профайлер не был запущен
+        """
+        if not self.running:
+            return None
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.deadline = None
+        path = os.path.join(self.directory, '{}.{}.{}.collapsed'.format(self.name, os.getpid(), int(time())))
+        try:
+            with open(path, 'w') as f:
+                f.writelines(self.format_stacks())
+        except IOError as e:
+            self.logger.error(u'Profile is not written to {}: {}'.format(path, e))
+            return None
+        self.logger.info(u'Profile of process {} is written to {}: {} samples'.format(os.getpid(), path, self.samples))
+        return path
+
+    def format_stacks(self):
+        """
+        :return: строки collapsed stacks, по убыванию числа семплов
+        """
+        lines = []
+        for (task, codes), count in sorted(self.stacks.iteritems(), key=lambda item: -item[1]):
+            frames = [format_code(code) for code in reversed(codes)]
+            if task is not None:
+                frames.insert(0, task)
+            # число семплов - после последнего пробела, пробелы в кадрах допустимы
+            lines.append('{} {}\n'.format(';'.join(frames), count))
+        return lines
+
+    def _sample(self, signum, frame):
+        codes = []
+        while frame is not None and len(codes) < MAX_DEPTH:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = (self.get_task_name() if self.get_task_name is not None else None, tuple(codes))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
@@ -2,45 +2,238 @@
 # coding: utf-8
 import logging
 import os
+import signal
 import sys
 from logging.config import dictConfig
 from multiprocessing import active_children
-from time import sleep
+import socket
+from time import time
 
-from lib.utils import (check_network_status, create_pidfile, daemonize,
-                       load_config_from_pyfile, parse_cmd_args, spawn_workers)
-from lib.worker import worker
+from tarantool.error import DatabaseError
+
+from lib import init_hop_cache, init_suffix_cache, init_host_breaker, init_host_latency, host_latency, clear_hop_caches
+from lib.autoscaler import Autoscaler
+from lib.control import ControlServer, ControlError
+from lib.forkserver import ForkServer
+from lib.network_monitor import NetworkMonitor
+from profiler import SamplingProfiler
+from lib.supervisor import WorkerPool
+from lib.utils import (create_pidfile, create_private_dir, daemonize, get_tube, get_tube_stats,
+                       load_config_from_pyfile, parse_cmd_args)
+from lib.worker import worker, preload_worker
 
 logger = logging.getLogger('redirect_checker')
 
 run_checker = True
+# профайлер главного процесса, у воркеров свои, см. lib.worker
+profiler = SamplingProfiler('redirect_checker')
+
+
+def reload_workers(signum, frame):
+    """
+    Передает SIGHUP воркерам, чтобы они перечитали правила счетчиков.
+    Шаблон воркеров перечитывает их сам и передает сигнал своим воркерам.
+    """
+    logger.info('Got SIGHUP. Reloading counter rules in workers')
+    for c in active_children():
+        os.kill(c.pid, signal.SIGHUP)
+
+
+def scale_pool(autoscaler, tube, pool):
+    """
+    Пересчитывает размер пула по входной трубе и загрузке воркеров.
+    Если статистику трубы получить не удалось, размер не меняется.
+    """
+    try:
+        stats = get_tube_stats(tube)
+    except (DatabaseError, socket.error) as e:
+        logger.warning(u'Input queue stats are not available, pool size is kept: {}'.format(e))
+        return
+    size = autoscaler.size
+    if autoscaler.update(stats, pool.get_stats()['in_flight'], time()) != size:
+        logger.info(u'Scaling worker pool from {} to {}. queue: {} pool: {}'.format(
+            size, autoscaler.size, stats, autoscaler.get_stats()
+        ))
+
+
+class CheckerControl(object):
+    """
+    Команды сокета управления главного процесса (CONTROL_SOCKET, см. lib.control.ControlServer):
+
+    - status - воркеры (чем заняты, к каким хостам идут), скорости задач и ошибок, пул и автоскейлер
+    - config - текущие настройки
+    - resize N - закрепить размер пула, resize auto - вернуть автоскейлер
+    - pause / resume - перестать брать задачи и продолжить, как без сети
+    - flush - очистить кэши переходов и хвостов, воркеры закрывают соединения и забывают DNS
+    - profile [секунд] - снять профиль главного процесса и всех воркеров в PROFILE_DIR
+    """
+
+    def __init__(self, config, pool, autoscaler, monitor):
+        self.config = config
+        self.pool = pool
+        self.autoscaler = autoscaler
+        self.monitor = monitor
+        self.paused = False
+
+    def get_commands(self):
+        return {
+            'status': self.status,
+            'config': self.get_config,
+            'resize': self.resize,
+            'pause': self.pause,
+            'resume': self.resume,
+            'flush': self.flush,
+            'profile': self.profile,
+        }
+
+    def status(self):
+        autoscaler = self.autoscaler.get_stats()
+        autoscaler.update(min_size=self.autoscaler.min_size, max_size=self.autoscaler.max_size)
+        return {
+            'pool': self.pool.get_stats(),
+            'rates': self.pool.get_rates(),
+            'autoscaler': autoscaler,
+            'network_up': self.monitor.is_up,
+            'paused_by_command': self.paused,
+            'workers': self.pool.get_workers(),
+        }
+
+    def get_config(self):
+        return dict((name, value) for name, value in vars(self.config).iteritems() if name.isupper())
+
+    def resize(self, size):
+        if size == 'auto':
+            self.autoscaler.min_size = self.config.WORKER_POOL_MIN_SIZE
+            self.autoscaler.max_size = self.config.WORKER_POOL_MAX_SIZE
+            size = self.autoscaler.clamp(self.autoscaler.size)
+        else:
+            try:
+                size = int(size)
+            except ValueError:
+                raise ControlError(u'pool size must be a number or auto, got {}'.format(size))
+            if size < 1:
+                raise ControlError(u'pool size must be positive, use pause to stop taking tasks')
+            # с равными границами автоскейлер выключен
+            self.autoscaler.min_size = self.autoscaler.max_size = size
+        self.autoscaler.resize(size, time())
+        logger.info(u'Worker pool is resized to {} ({}-{}) by control command'.format(
+            size, self.autoscaler.min_size, self.autoscaler.max_size))
+        return self.autoscaler.get_stats()
+
+    def pause(self):
+        self.paused = True
+        return {'paused': True}
+
+    def resume(self):
+        self.paused = False
+        return {'paused': not self.monitor.is_up}
+
+    def flush(self):
+        clear_hop_caches()
+        self.pool.flush()
+        logger.info('Hop caches are cleared, workers drop connections by control command')
+        return {'flushed': ['hop_cache', 'suffix_cache', 'connections', 'dns']}
+
+    def profile(self, duration=None):
+        if duration is None:
+            duration = self.config.PROFILE_DURATION
+        else:
+            try:
+                duration = float(duration)
+            except ValueError:
+                raise ControlError(u'profile duration must be a number of seconds, got {}'.format(duration))
+            if duration <= 0:
+                raise ControlError(u'profile duration must be positive')
+        if not profiler.start(duration):
+            raise ControlError(u'profiler is already running')
+        self.pool.profile(duration)
+        return {'duration': duration, 'directory': self.config.PROFILE_DIR, 'workers': len(self.pool)}
+
+
+def run_worker(config, parent_pid, channel=None):
+    """Воркер пула со своим профайлером"""
+    worker(config, parent_pid, channel, SamplingProfiler)
 
 
 def main_loop(config):
     logger.info(
-        u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
-            config.WORKER_POOL_SIZE, config.SLEEP
+        u'Run main loop. Worker pool size={} ({}-{}). Network check interval is {}.'.format(
+            config.WORKER_POOL_SIZE, config.WORKER_POOL_MIN_SIZE, config.WORKER_POOL_MAX_SIZE, config.SLEEP
         ))
+    # размеры пула проверяются до запуска шаблона и монитора
+    autoscaler = Autoscaler(config.WORKER_POOL_MIN_SIZE, config.WORKER_POOL_MAX_SIZE, config.MAX_TASKS_IN_FLIGHT,
+                            config.WORKER_POOL_SIZE, config.AUTOSCALE_TARGET_UTILIZATION,
+                            config.AUTOSCALE_DOWN_MARGIN, config.AUTOSCALE_COOLDOWN)
     parent_pid = os.getpid()
-    while run_checker:
-        if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-            required_workers_count = config.WORKER_POOL_SIZE - len(
-                active_children())
-            if required_workers_count > 0:
-                logger.info(
-                    'Spawning {} workers'.format(required_workers_count))
-                spawn_workers(
-                    num=required_workers_count,
-                    target=worker,
-                    args=(config,),
-                    parent_pid=parent_pid
-                )
+    fork_server = None
+    if config.WORKER_FORK_SERVER:
+        # шаблон форкается до запуска потока монитора сети
+        fork_server = ForkServer(run_worker, (config,), preload=lambda: preload_worker(config))
+        fork_server.start()
+    pool = WorkerPool(run_worker, (config,), config.WORKER_HEARTBEAT_TIMEOUT, config.WORKER_DRAIN_TIMEOUT, fork_server)
+    pool.install_signal_handlers()
+    # монитор будит wait(), когда сеть падает или поднимается
+    monitor = NetworkMonitor(config.CHECK_URLS, config.HTTP_TIMEOUT, config.SLEEP, config.NETWORK_DOWN_THRESHOLD,
+                             config.NETWORK_UP_THRESHOLD, on_change=pool.wake_up)
+    monitor.start()
+    input_tube = get_tube(
+        host=config.INPUT_QUEUE_HOST,
+        port=config.INPUT_QUEUE_PORT,
+        space=config.INPUT_QUEUE_SPACE,
+        name=config.INPUT_QUEUE_TUBE
+    )
+    control = CheckerControl(config, pool, autoscaler, monitor)
+    control_server = None
+    if config.CONTROL_SOCKET:
+        # команды выполняются внутри pool.wait(), следующая итерация сразу их применяет
+        control_server = ControlServer(config.CONTROL_SOCKET, control.get_commands())
+        try:
+            control_server.start()
+        except socket.error as e:
+            logger.error(u'Running without control socket: {}'.format(e))
+            control_server = None
         else:
-            logger.critical('Network is down. stopping workers')
-            for c in active_children():
-                c.terminate()
+            pool.watch(control_server, control_server.handle)
+    next_scale_time = time() + config.AUTOSCALE_INTERVAL
+    while run_checker:
+        # без сети воркеры не убиваются, а встают на паузу и сохраняют кэши
+        if (monitor.is_up and not control.paused) == pool.paused:
+            if pool.paused:
+                logger.info('Network is up. resuming workers')
+                pool.resume()
+            elif control.paused:
+                logger.info('Pausing workers by control command')
+                pool.pause()
+            else:
+                logger.critical('Network is down. pausing workers')
+                pool.pause()
+
+        if time() >= next_scale_time:
+            # на паузе воркеры простаивают, их загрузка ничего не говорит
+            if autoscaler.enabled and not pool.paused:
+                scale_pool(autoscaler, input_tube, pool)
+            next_scale_time = time() + config.AUTOSCALE_INTERVAL
+        if len(pool) > autoscaler.size:
+            logger.info('Draining {} workers'.format(len(pool) - autoscaler.size))
+            pool.drain(len(pool) - autoscaler.size)
+
+        required_workers_count = autoscaler.size - len(pool)
+        if required_workers_count > 0:
+            logger.info(
+                'Spawning {} workers'.format(required_workers_count))
+            pool.spawn(required_workers_count, parent_pid)
 
-        sleep(config.SLEEP)
+        # просыпается от heartbeat воркеров, от SIGCHLD и от монитора сети,
+        # так что место завершившегося воркера занимается сразу
+        pool.wait(min(next_scale_time - time(), config.WORKER_HEARTBEAT_TIMEOUT))
+        profiler.check()
+    profiler.stop()
+    if control_server is not None:
+        control_server.close()
+    monitor.stop()
+    pool.close()
+    if fork_server is not None:
+        fork_server.stop()
 
 
 def main(argv):
@@ -56,7 +249,25 @@ def main(argv):
         os.path.realpath(os.path.expanduser(args.config))
     )
     dictConfig(config.LOGGING)
+    if config.STATE_DIR:
+        create_private_dir(config.STATE_DIR)
+    # до запуска воркеров, чтобы кэши и таблица хостов были у них общими
+    init_hop_cache(config.HOP_CACHE_SIZE, config.HOP_CACHE_SLOT_SIZE, config.HOP_CACHE_TTL)
+    init_suffix_cache(config.SUFFIX_CACHE_SIZE, config.SUFFIX_CACHE_SLOT_SIZE, config.SUFFIX_CACHE_TTL,
+                      config.SUFFIX_CACHE_PATH)
+    init_host_breaker(config.HOST_BREAKER_SIZE, config.HOST_BREAKER_THRESHOLD, config.HOST_BREAKER_COOL_DOWN,
+                      config.HOST_BREAKER_MAX_COOL_DOWN)
+    init_host_latency(config.HOST_LATENCY_SIZE, config.HOST_LATENCY_PATH, config.HOST_LATENCY_PERCENTILE,
+                      config.HOST_LATENCY_MARGIN, config.HOST_LATENCY_MIN_SAMPLES, config.HOST_TIMEOUT_BOUNDS,
+                      config.HOST_CONNECT_TIMEOUT_BOUNDS)
+    signal.signal(signal.SIGHUP, reload_workers)
+    signal.siginterrupt(signal.SIGHUP, False)
+    # SIGUSR2 - снять профиль главного процесса, воркерам сигнал шлется отдельно или команда profile
+    profiler.configure(config.PROFILE_DIR, config.PROFILE_DURATION, config.PROFILE_INTERVAL)
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start())
+    signal.siginterrupt(signal.SIGUSR2, False)
     main_loop(config)
+    host_latency.flush()
 
     return config.EXIT_CODE
 
@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+Сравнение get_counters с прежним поиском восемью re.match по страницам от 10KB до 2MB.
+
+Запуск из корня репозитория:
+    python -m source.tests.benchmarks.bench_counters
+"""
+import random
+import re
+import timeit
+
+from source.lib import COUNTER_TYPES, get_counters
+
+PAGE_SIZES = (10 * 1024, 100 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024)
+REPEAT = 5
+CHUNKS = (
+    '<div class="item"><a href="/catalog/item?id=42">Item</a></div>\n',
+    '<p>Top news from mail.ru and google, counters and analytics</p>\n',
+    '<script src="//cdn.example.com/js/app.js"></script>\n',
+    '<img src="http://static.example.com/i/pixel.gif" width="1" height="1">\n',
+)
+COUNTERS_HTML = (
+    '<script src="http://mc.yandex.ru/metrika/watch.js"></script>\n'
+    '<img src="http://counter.rambler.ru/top100.cnt?264737">\n'
+)
+
+
+def get_counters_regexp(content):
+    """Прежняя реализация get_counters"""
+    counters = []
+    for counter_name, regexp in COUNTER_TYPES:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+def make_page(size, seed=0):
+    rnd = random.Random(seed)
+    chunks = []
+    length = 0
+    while length < size:
+        chunk = rnd.choice(CHUNKS)
+        chunks.append(chunk)
+        length += len(chunk)
+    # счетчики обычно стоят в конце страницы
+    return ''.join(chunks) + COUNTERS_HTML
+
+
+def main():
+    print '{:>10} {:>12} {:>12} {:>8}'.format('size', 'regexp, ms', 'find, ms', 'speedup')
+    for size in PAGE_SIZES:
+        page = make_page(size)
+        assert get_counters(page) == get_counters_regexp(page)
+        old = min(timeit.repeat(lambda: get_counters_regexp(page), number=1, repeat=REPEAT))
+        new = min(timeit.repeat(lambda: get_counters(page), number=1, repeat=REPEAT))
+        print '{:>10} {:>12.3f} {:>12.3f} {:>8.1f}'.format(size, old * 1000, new * 1000, old / new)
+
+
+if __name__ == '__main__':
+    main()
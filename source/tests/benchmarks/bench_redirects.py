@@ -0,0 +1,546 @@
+# coding: utf-8
+"""
+Сквозной бенчмарк проверки цепочек против локального HTTP-сервера.
+
+Сервер (отдельный процесс) отдает цепочки по пути урла:
+
+    /http/{код}/{n}   - n http-редиректов с кодом 301/302/303/307
+    /meta/{n}         - n мета-редиректов (refresh)
+    /market           - редирект на market://, он ведет на /play/ того же сервера
+    /loop/{a}/{b}     - бесконечный цикл редиректов, до MAX_REDIRECTS
+    /large/{KB}       - большая страница, длиннее MAX_CONTENT_SIZE по умолчанию
+    /counters/{KB}    - страница со всеми счетчиками из COUNTER_TYPES в конце
+
+Хосты - адреса 127.0.0.1..127.0.0.{HOSTS} (у каждого свой лимит запросов
+воркера), последний хост медленный: отвечает с задержкой --slow-delay.
+У каждой задачи свой урл (?t=номер), так что кэши переходов не помогают.
+
+Режимы (каждый в своих процессах, CPU и пиковый RSS - их собственные):
+
+    history - get_redirect_history по одной задаче, первые --history-tasks задач
+    worker  - настоящий цикл lib.worker.worker (config/checker_config.py),
+              вместо tarantool - очередь multiprocessing
+
+Итог - задач в секунду, перцентили задержки задачи (от take до ack) и перехода
+(гистограмма hop.total, верхние границы корзин), CPU на задачу и RSS -
+печатается и сохраняется в JSON (--output), --compare сравнивает с прошлым
+запуском. Только Linux: остальные адреса 127.0.0.0/8 и ru_maxrss в KB.
+
+Запуск из корня репозитория:
+    python -m source.tests.benchmarks.bench_redirects --tasks 2000 --workers 2 --compare old.json
+"""
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+import json
+import logging
+from multiprocessing import Pipe, Process, Queue
+import os
+import platform
+from Queue import Empty
+import random
+import resource
+from SocketServer import ThreadingMixIn
+import tempfile
+import threading
+from time import sleep, time
+
+import mock
+
+from source.lib import get_redirect_history, init_curl_pool, init_dns_cache, init_metrics, metrics
+from source.lib import worker
+from source.lib.supervisor import WorkerPool
+from source.lib.timing import Histogram
+from source.lib.utils import load_config_from_pyfile
+from source.tests.benchmarks.bench_counters import make_page
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'checker_config.py')
+HOSTS = 5
+HTTP_CODES = (301, 302, 303, 307)
+SCENARIOS = (
+    ('http', 4),
+    ('meta', 2),
+    ('market', 1),
+    ('loop', 1),
+    ('slow', 1),
+    ('large', 1),
+    ('counters', 2),
+)
+"""Сценарии и их веса по умолчанию, --mix задает свои"""
+PERCENTILES = (0.5, 0.9, 0.99)
+RESULT_TIMEOUT = 10
+"""Сколько секунд ждать отчетов процессов после их завершения"""
+
+FINAL_PAGE = '<html><head><title>Final</title></head><body>ok</body></html>'
+META_PAGE = '<html><head><meta http-equiv="refresh" content="0; url={}"></head><body></body></html>'
+COUNTERS_HTML = (
+    '<script src="http://www.google-analytics.com/ga.js"></script>\n'
+    '<script src="http://mc.yandex.ru/metrika/watch.js"></script>\n'
+    '<img src="http://top-fwz1.mail.ru/counter?id=1">\n'
+    '<script src="//googleads.g.doubleclick.net/pagead/viewthroughconversion/1/"></script>\n'
+    '<script src="//a1.vdna-assets.com/analytics.js"></script>\n'
+    '<img src="//counter.yadro.ru/hit?r">\n'
+    '<img src="http://counter.rambler.ru/top100.cnt?264737">\n'
+)
+
+result_queue = Queue()
+"""Отчеты процессов режимов: ('tasks', [(номер задачи, исход, переходов, задержка)]) и ('usage', {...})"""
+task_queue = Queue()
+"""Задачи режима worker: (номер, урл), None - воркеру пора заканчивать"""
+outcomes = {}
+"""Исходы задач воркера между put_tasks и ack_tasks: номер -> (исход, переходов)"""
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, delay):
+        HTTPServer.__init__(self, address, ChainHandler)
+        self.delay = delay
+        self.bodies = {}
+
+    def get_body(self, kind, size):
+        body = self.bodies.get((kind, size))
+        if body is None:
+            body = make_page(size * 1024) + (COUNTERS_HTML if kind == 'counters' else '')
+            self.bodies[(kind, size)] = body
+        return body
+
+    def handle_error(self, request, client_address):
+        # checker обрывает соединения сам: дочитывать тело ему незачем
+        pass
+
+
+class ChainHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        suffix = '?' + query if query else ''
+        parts = path.strip('/').split('/')
+        if self.server.delay:
+            sleep(self.server.delay)
+        if parts[0] == 'http' and int(parts[2]) > 0:
+            self.send_redirect(int(parts[1]), '/http/{}/{}{}'.format(parts[1], int(parts[2]) - 1, suffix))
+        elif parts[0] == 'meta' and int(parts[1]) > 0:
+            self.send_page(META_PAGE.format('/meta/{}{}'.format(int(parts[1]) - 1, suffix)))
+        elif parts[0] == 'market':
+            self.send_redirect(302, 'market://details?id=ru.mail.bench' + ('&' + query if query else ''))
+        elif parts[0] == 'loop':
+            self.send_redirect(302, '/loop/{}/{}{}'.format(parts[2], parts[1], suffix))
+        elif parts[0] in ('large', 'counters'):
+            self.send_page(self.server.get_body(parts[0], int(parts[1])))
+        else:
+            self.send_page(FINAL_PAGE)
+
+    def send_redirect(self, code, location):
+        self.send_response(code)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_page(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(delays, channel):
+    """
+    Процесс сервера: по серверу на хост, адреса отправляются в channel,
+    работает, пока его не остановят
+    """
+    servers = [ThreadingServer(('127.0.0.{}'.format(number + 1), 0), delay) for number, delay in enumerate(delays)]
+    threads = [threading.Thread(target=server.serve_forever) for server in servers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    channel.send(['http://{}:{}'.format(*server.server_address) for server in servers])
+    for thread in threads:
+        thread.join()
+
+
+def start_server(slow_delay):
+    """
+    :return: процесс сервера и адреса хостов, последний - медленный
+    """
+    channel, server_channel = Pipe(duplex=False)
+    process = Process(target=serve, args=([0] * (HOSTS - 1) + [slow_delay], server_channel))
+    process.daemon = True
+    process.start()
+    return process, channel.recv()
+
+
+def parse_mix(mix):
+    """
+    :param mix: "имя=вес,..." или None - все сценарии с весами по умолчанию
+    :return: список (сценарий, вес)
+    """
+    if mix is None:
+        return list(SCENARIOS)
+    scenarios = []
+    known = dict(SCENARIOS)
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in known:
+            raise ValueError(u'unknown scenario {}, known are {}'.format(name, ', '.join(sorted(known))))
+        scenarios.append((name, int(weight or 1)))
+    return scenarios
+
+
+def make_url(scenario, hosts, options, rnd):
+    if scenario == 'slow':
+        return '{}/http/302/{}'.format(hosts[-1], options.hops)
+    host = rnd.choice(hosts[:-1])
+    if scenario == 'http':
+        return '{}/http/{}/{}'.format(host, rnd.choice(HTTP_CODES), options.hops)
+    if scenario == 'meta':
+        return '{}/meta/{}'.format(host, options.hops)
+    if scenario == 'market':
+        return '{}/market'.format(host)
+    if scenario == 'loop':
+        return '{}/loop/a/b'.format(host)
+    if scenario == 'large':
+        return '{}/large/{}'.format(host, options.body_size)
+    return '{}/counters/{}'.format(host, options.page_size)
+
+
+def make_tasks(hosts, options):
+    """
+    :return: список (сценарий, урл), сценарии вперемешку в пропорции весов
+    """
+    rnd = random.Random(options.seed)
+    scenarios = parse_mix(options.mix)
+    names = [name for name, weight in scenarios for _ in xrange(weight)]
+    tasks = []
+    for number in xrange(options.tasks):
+        scenario = rnd.choice(names)
+        tasks.append((scenario, '{}?t={}'.format(make_url(scenario, hosts, options, rnd), number)))
+    return tasks
+
+
+def get_outcome(history_types):
+    return 'error' if worker.is_broken(history_types) else 'ok'
+
+
+def get_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'cpu': usage.ru_utime + usage.ru_stime, 'max_rss': usage.ru_maxrss * 1024}
+
+
+def dump_histograms(histograms):
+    """Гистограммы в виде строки FileExporter"""
+    return dict((name, {'buckets': histogram.buckets, 'counts': histogram.counts, 'sum': histogram.sum})
+                for name, histogram in histograms.iteritems())
+
+
+def merge_histograms(dumps):
+    """
+    :param dumps: гистограммы процессов в виде dump_histograms
+    :return: имя -> Histogram, сумма по процессам
+    """
+    histograms = {}
+    for dump in dumps:
+        for name, data in dump.iteritems():
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram(tuple(data['buckets']))
+            histogram.counts = [a + b for a, b in zip(histogram.counts, data['counts'])]
+            histogram.count += sum(data['counts'])
+            histogram.sum += data['sum']
+    return histograms
+
+
+class FakeQueue(object):
+    host = 'localhost'
+    port = 33013
+    space = 0
+
+
+class FakeTube(object):
+    queue = FakeQueue()
+
+    def __init__(self, name):
+        self.opt = {'tube': name}
+
+
+class FakeTask(object):
+    def __init__(self, number, url):
+        self.task_id = number
+        self.data = {'url': url, 'url_id': number}
+        self.taken = time()
+
+    def meta(self):
+        return {'pri': 0}
+
+    def release(self):
+        result_queue.put(('tasks', [(self.task_id, 'released', 0, time() - self.taken)]))
+
+
+def get_tube(host, port, space, name):
+    return FakeTube(name)
+
+
+def take_tasks(tube, count, timeout):
+    tasks = []
+    while len(tasks) < count:
+        try:
+            item = task_queue.get(timeout=timeout) if not tasks else task_queue.get_nowait()
+        except Empty:
+            break
+        if item is None:
+            worker.drain_requested = True
+            break
+        tasks.append(FakeTask(*item))
+    return tasks
+
+
+def put_tasks(tube, tasks):
+    for data, _, _ in tasks:
+        if 'result' not in data:
+            # задача вернулась во входную очередь на перепроверку
+            outcomes[data['url_id']] = ('recheck', len(data.get('resume', [[]])[0]))
+        else:
+            history_types = data['result'][0]
+            outcomes[data['url_id']] = (get_outcome(history_types), len(history_types))
+
+
+def ack_tasks(tube, tasks):
+    now = time()
+    records = []
+    for task in tasks:
+        outcome, hops = outcomes.pop(task.task_id, ('lost', 0))
+        records.append((task.task_id, outcome, hops, now - task.taken))
+    result_queue.put(('tasks', records))
+    return len(tasks)
+
+
+def run_worker(config, parent_pid, channel=None):
+    worker.worker(config, parent_pid, channel)
+    result_queue.put(('usage', get_usage()))
+
+
+def run_history(config, tasks):
+    """Процесс режима history: цепочки по одной"""
+    init_curl_pool(config.CURL_POOL_SIZE, config.CURL_POOL_MAX_IDLE_TIME)
+    init_dns_cache(config.DNS_CACHE_TTL)
+    worker.load_counter_rules(config)
+    init_metrics()
+    for number, (_, url) in enumerate(tasks):
+        started = time()
+        history_types, _, _ = get_redirect_history(
+            url.decode('ascii'), config.HTTP_TIMEOUT, config.MAX_REDIRECTS, config.USER_AGENT,
+            config.MAX_CONTENT_SIZE, connect_timeout=config.HTTP_CONNECT_TIMEOUT, deadline=config.TASK_DEADLINE
+        )
+        result_queue.put(('tasks', [(number, get_outcome(history_types), len(history_types), time() - started)]))
+    usage = get_usage()
+    usage['histograms'] = dump_histograms(metrics.take())
+    result_queue.put(('usage', usage))
+
+
+def collect_reports(records, usages, processes, is_running):
+    """
+    Забирает отчеты процессов, пока is_running() или пока не пришли отчеты всех processes
+    """
+    while True:
+        running = is_running()
+        if not running and len(usages) >= processes:
+            return
+        try:
+            kind, report = result_queue.get(timeout=0.1 if running else RESULT_TIMEOUT)
+        except Empty:
+            if running:
+                continue
+            return
+        if kind == 'tasks':
+            records.extend(report)
+        else:
+            usages.append(report)
+
+
+def bench_history(config, tasks):
+    records = []
+    usages = []
+    started = time()
+    process = Process(target=run_history, args=(config, tasks))
+    process.start()
+    collect_reports(records, usages, 1, process.is_alive)
+    process.join()
+    return time() - started, records, usages, [usage.pop('histograms') for usage in usages]
+
+
+def bench_worker(config, tasks, workers):
+    for item in enumerate(url for _, url in tasks):
+        task_queue.put(item)
+    for _ in xrange(workers):
+        task_queue.put(None)
+    fd, metrics_path = tempfile.mkstemp(prefix='bench_redirects.', suffix='.metrics')
+    os.close(fd)
+    config.METRICS_FILE = metrics_path
+    config.METRICS_STATSD_ADDRESS = None
+    config.METRICS_INTERVAL = 3600
+    records = []
+    usages = []
+    with mock.patch('source.lib.worker.get_tube', get_tube),\
+            mock.patch('source.lib.worker.take_tasks', take_tasks),\
+            mock.patch('source.lib.worker.put_tasks', put_tasks),\
+            mock.patch('source.lib.worker.ack_tasks', ack_tasks):
+        pool = WorkerPool(run_worker, (config,), config.WORKER_HEARTBEAT_TIMEOUT, config.WORKER_DRAIN_TIMEOUT)
+        pool.install_signal_handlers()
+        started = time()
+        pool.spawn(workers, os.getpid())
+
+        def is_running():
+            pool.wait(0)
+            return bool(pool.workers)
+
+        collect_reports(records, usages, workers, is_running)
+        seconds = time() - started
+        pool.close()
+    with open(metrics_path) as f:
+        histograms = [json.loads(line)['histograms'] for line in f]
+    os.unlink(metrics_path)
+    return seconds, records, usages, histograms
+
+
+def get_percentiles(values):
+    """
+    :param values: значения по возрастанию
+    """
+    if not values:
+        return {}
+    stats = dict(('p{:g}'.format(percentile * 100), values[int(percentile * (len(values) - 1))])
+                 for percentile in PERCENTILES)
+    stats['max'] = values[-1]
+    return stats
+
+
+def summarize(tasks, seconds, records, usages, histograms):
+    latencies = sorted(latency for _, _, _, latency in records)
+    hop_latency = merge_histograms(histograms).get('hop.total')
+    cpu = sum(usage['cpu'] for usage in usages)
+    by_scenario = {}
+    for number, outcome, _, latency in records:
+        by_scenario.setdefault(tasks[number][0], []).append((latency, outcome))
+    scenarios = {}
+    for name, results in by_scenario.iteritems():
+        scenario_latencies = sorted(latency for latency, _ in results)
+        scenarios[name] = dict(get_percentiles(scenario_latencies), tasks=len(results),
+                               outcomes=dict(Counter(outcome for _, outcome in results)))
+    return {
+        'tasks': len(records),
+        'seconds': seconds,
+        'tasks_per_sec': len(records) / seconds,
+        'redirects': sum(hops for _, _, hops, _ in records),
+        'outcomes': dict(Counter(outcome for _, outcome, _, _ in records)),
+        'task_latency': get_percentiles(latencies),
+        'hop_latency': dict(
+            ('p{:g}'.format(percentile * 100), hop_latency.get_percentile(percentile)) for percentile in PERCENTILES
+        ) if hop_latency else {},
+        'hops': hop_latency.count if hop_latency else 0,
+        'cpu_seconds': cpu,
+        'cpu_ms_per_task': cpu * 1000 / len(records) if records else None,
+        'max_rss_mb': max(usage['max_rss'] for usage in usages) / 1048576.0 if usages else None,
+        'processes': len(usages),
+        'scenarios': scenarios,
+    }
+
+
+REPORT_COLUMNS = (
+    ('tasks/s', lambda mode: mode['tasks_per_sec']),
+    ('task p50, ms', lambda mode: mode['task_latency'].get('p50', 0) * 1000),
+    ('task p99, ms', lambda mode: mode['task_latency'].get('p99', 0) * 1000),
+    ('hop p50, ms', lambda mode: (mode['hop_latency'].get('p50') or 0) * 1000),
+    ('hop p99, ms', lambda mode: (mode['hop_latency'].get('p99') or 0) * 1000),
+    ('cpu/task, ms', lambda mode: mode['cpu_ms_per_task'] or 0),
+    ('max rss, MB', lambda mode: mode['max_rss_mb'] or 0),
+)
+
+
+def print_report(results, baseline=None):
+    print '{:>8} {:>7}'.format('mode', 'tasks') + ''.join(' {:>13}'.format(title) for title, _ in REPORT_COLUMNS)
+    for name, mode in sorted(results['modes'].iteritems()):
+        print '{:>8} {:>7}'.format(name, mode['tasks']) + ''.join(
+            ' {:>13.1f}'.format(get(mode)) for _, get in REPORT_COLUMNS)
+        old = (baseline or {}).get('modes', {}).get(name)
+        if old:
+            print '{:>8} {:>7}'.format('change', '') + ''.join(
+                ' {:>+12.1f}%'.format((get(mode) - get(old)) * 100.0 / get(old)) if get(old) else ' {:>13}'.format('-')
+                for _, get in REPORT_COLUMNS)
+        print '{:>8} {}'.format('', ' '.join('{}={}'.format(outcome, count)
+                                             for outcome, count in sorted(mode['outcomes'].iteritems())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end redirect checker benchmark against a local server.')
+    parser.add_argument('--config', default=os.path.realpath(CONFIG_PATH), help='Checker configuration file.')
+    parser.add_argument('--modes', default='history,worker', help='Comma separated: history, worker.')
+    parser.add_argument('--tasks', type=int, default=1000, help='Tasks for the worker mode.')
+    parser.add_argument('--history-tasks', type=int, default=200, help='First tasks checked one by one.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes.')
+    parser.add_argument('--in-flight', type=int, help='MAX_TASKS_IN_FLIGHT of a worker, config value by default.')
+    parser.add_argument('--mix', help='Scenario weights, e.g. http=4,meta=1; all of {} by default.'.format(
+        ', '.join(name for name, _ in SCENARIOS)))
+    parser.add_argument('--hops', type=int, default=5, help='Redirects in http, meta and slow chains.')
+    parser.add_argument('--slow-delay', type=float, default=0.2, help='Seconds the slow host waits per response.')
+    parser.add_argument('--body-size', type=int, default=2048, help='KB in large pages.')
+    parser.add_argument('--page-size', type=int, default=100, help='KB in pages with counters.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the scenario mix.')
+    parser.add_argument('--output', default='bench_redirects.json', help='JSON file for the results.')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with.')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    logging.getLogger('redirect_checker').addHandler(logging.NullHandler())
+    config = load_config_from_pyfile(options.config)
+    config.MAX_TASKS_PER_WORKER = 0
+    config.MAX_WORKER_RSS = 0
+    if options.in_flight:
+        config.MAX_TASKS_IN_FLIGHT = options.in_flight
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    server, hosts = start_server(options.slow_delay)
+    tasks = make_tasks(hosts, options)
+    results = {
+        'time': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'options': vars(options),
+        'config': {'MAX_TASKS_IN_FLIGHT': config.MAX_TASKS_IN_FLIGHT,
+                   'HOST_CONCURRENCY_DEFAULT': config.HOST_CONCURRENCY_DEFAULT,
+                   'HTTP_TIMEOUT': config.HTTP_TIMEOUT,
+                   'MAX_REDIRECTS': config.MAX_REDIRECTS,
+                   'MAX_CONTENT_SIZE': config.MAX_CONTENT_SIZE},
+        'modes': {},
+    }
+    modes = options.modes.split(',')
+    # market:// ведет в Google Play, здесь - на первый хост сервера
+    with mock.patch('source.lib.GOOGLE_PLAY_PREFIX', hosts[0] + '/play/'):
+        if 'history' in modes:
+            history_tasks = tasks[:options.history_tasks]
+            results['modes']['history'] = summarize(history_tasks, *bench_history(config, history_tasks))
+        if 'worker' in modes:
+            results['modes']['worker'] = summarize(tasks, *bench_worker(config, tasks, options.workers))
+    server.terminate()
+    server.join()
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print_report(results, baseline)
+    print 'results are saved to {}'.format(options.output)
+
+
+if __name__ == '__main__':
+    main()
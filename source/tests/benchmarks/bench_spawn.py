@@ -0,0 +1,97 @@
+# coding: utf-8
+"""
+Задержка от запроса на запуск воркеров до первого take_tasks в каждом из них:
+запуск из главного процесса (spawn_workers) против шаблона (ForkServer).
+
+Воркеры настоящие (lib.worker.worker с config/checker_config.py), вместо
+очереди - заглушка: первый take_tasks сообщает время и останавливает воркер.
+
+Запуск из корня репозитория:
+    python -m source.tests.benchmarks.bench_spawn
+"""
+import logging
+from multiprocessing import Pipe
+import os
+from time import time
+
+import mock
+
+from source.lib import worker
+from source.lib.forkserver import ForkServer
+from source.lib.supervisor import WorkerPool
+from source.lib.utils import load_config_from_pyfile
+
+POOL_SIZE = 10
+ROUNDS = 5
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'checker_config.py')
+
+reports, report_channel = Pipe(duplex=False)
+
+
+class FakeQueue(object):
+    host = 'localhost'
+    port = 33013
+    space = 0
+
+
+class FakeTube(object):
+    queue = FakeQueue()
+
+    def __init__(self, name):
+        self.opt = {'tube': name}
+
+
+def get_tube(host, port, space, name):
+    return FakeTube(name)
+
+
+def take_first_task(tube, count, timeout):
+    report_channel.send(time())
+    worker.drain_requested = True
+    return []
+
+
+def run_round(pool):
+    """
+    :return: задержки первого take у воркеров в секундах, по возрастанию
+    """
+    started = time()
+    pool.spawn(POOL_SIZE, os.getpid())
+    latencies = sorted(reports.recv() - started for _ in xrange(POOL_SIZE))
+    while pool.workers:
+        pool.wait(1)
+    return latencies
+
+
+def bench(pool):
+    rounds = [run_round(pool) for _ in xrange(ROUNDS)]
+    median = sorted(latencies[len(latencies) // 2] for latencies in rounds)[ROUNDS // 2]
+    last = sorted(latencies[-1] for latencies in rounds)[ROUNDS // 2]
+    return median, last
+
+
+def main():
+    logging.getLogger('redirect_checker').addHandler(logging.NullHandler())
+    config = load_config_from_pyfile(os.path.realpath(CONFIG_PATH))
+
+    print '{:>14} {:>18} {:>18}'.format('mode', 'median first, ms', 'last first, ms')
+    with mock.patch('source.lib.worker.get_tube', get_tube),\
+            mock.patch('source.lib.worker.take_tasks', take_first_task):
+        pool = WorkerPool(worker.worker, (config,), 60, 60)
+        pool.install_signal_handlers()
+        median, last = bench(pool)
+        print '{:>14} {:>18.1f} {:>18.1f}'.format('main process', median * 1000, last * 1000)
+        pool.close()
+
+        fork_server = ForkServer(worker.worker, (config,), preload=lambda: worker.preload_worker(config))
+        fork_server.start()
+        pool = WorkerPool(worker.worker, (config,), 60, 60, fork_server)
+        pool.install_signal_handlers()
+        median, last = bench(pool)
+        print '{:>14} {:>18.1f} {:>18.1f}'.format('fork server', median * 1000, last * 1000)
+        pool.close()
+        fork_server.stop()
+
+
+if __name__ == '__main__':
+    main()
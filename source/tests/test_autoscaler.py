@@ -0,0 +1,43 @@
+import unittest
+
+from source.lib.autoscaler import Autoscaler
+
+
+class AutoscalerTestCase(unittest.TestCase):
+    def make_autoscaler(self, size=4):
+        return Autoscaler(2, 10, worker_capacity=10, size=size, target_utilization=0.5, down_margin=0.3, cooldown=60)
+
+    def test_grows_when_workers_are_busy(self):
+        autoscaler = self.make_autoscaler()
+        self.assertEqual(7, autoscaler.update({'ready': 15, 'taken': 20, 'delayed': 1000}, 30, 100))
+        self.assertEqual(10, autoscaler.update({'ready': 500, 'taken': 20}, 50, 101))
+        self.assertEqual({'size': 10, 'desired': 10, 'utilization': 0.71}, autoscaler.get_stats())
+
+    def test_does_not_grow_with_idle_workers(self):
+        """
+        new workers have not taken their tasks yet, the backlog is not theirs to blame
+        """
+        autoscaler = self.make_autoscaler()
+        self.assertEqual(4, autoscaler.update({'ready': 50, 'taken': 20}, 10, 100))
+
+    def test_shrinks_with_hysteresis_and_cooldown(self):
+        autoscaler = self.make_autoscaler(size=10)
+        autoscaler.update({'ready': 500, 'taken': 20}, 100, 100)
+        # 8 workers are enough, but less than 30% fewer
+        self.assertEqual(10, autoscaler.update({'ready': 0, 'taken': 40}, 40, 200))
+        # cooldown after the last change has not passed
+        autoscaler.resize(10, 190)
+        self.assertEqual(10, autoscaler.update({'ready': 0, 'taken': 5}, 5, 200))
+        self.assertEqual(2, autoscaler.update({'ready': 0, 'taken': 5}, 5, 250))
+
+    def test_bounds(self):
+        autoscaler = Autoscaler(3, 3, worker_capacity=10, size=8)
+        self.assertFalse(autoscaler.enabled)
+        self.assertEqual(3, autoscaler.size)
+        self.assertTrue(self.make_autoscaler().enabled)
+
+    def test_empty_pool_rejected(self):
+        """
+        a pool scaled down to no workers would never take tasks again
+        """
+        self.assertRaises(ValueError, Autoscaler, 0, 10, worker_capacity=10)
@@ -0,0 +1,75 @@
+import unittest
+import pycurl
+
+from source.lib.breaker import HostBreaker, HOST_FAILURE_ERRORS
+
+HOST = 'http://a.ru'
+
+
+class HostBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = HostBreaker(64 * 1024, threshold=2, cool_down=10, max_cool_down=25)
+
+    def test_opens_after_threshold(self):
+        """
+        host is rejected after threshold failures in a row
+        """
+        self.breaker.failure(HOST, now=100)
+        self.assertTrue(self.breaker.allow(HOST, now=101))
+        self.assertEqual(0, self.breaker.get_retry_delay(HOST, now=101))
+        self.breaker.failure(HOST, now=101)
+        self.assertFalse(self.breaker.allow(HOST, now=102))
+        self.assertEqual(9, self.breaker.get_retry_delay(HOST, now=102))
+        self.assertTrue(self.breaker.allow('http://b.ru', now=102))
+        self.assertEqual(1, self.breaker.get_stats()['rejected'])
+
+    def test_success_resets_failures(self):
+        """
+        only consecutive failures open the breaker
+        """
+        self.breaker.failure(HOST, now=100)
+        self.breaker.success(HOST, now=101)
+        self.breaker.failure(HOST, now=102)
+        self.assertTrue(self.breaker.allow(HOST, now=103))
+
+    def test_failures_forgotten(self):
+        """
+        failures older than cool_down are forgotten
+        """
+        self.breaker.failure(HOST, now=100)
+        self.breaker.failure(HOST, now=111)
+        self.assertTrue(self.breaker.allow(HOST, now=112))
+
+    def test_half_open(self):
+        """
+        after cool down one probe is allowed, failed probe doubles cool down up to max
+        """
+        self.breaker.failure(HOST, now=100)
+        self.breaker.failure(HOST, now=100)
+        self.assertTrue(self.breaker.allow(HOST, now=110))
+        self.assertFalse(self.breaker.allow(HOST, now=111))
+        self.breaker.failure(HOST, now=112)
+        self.assertEqual(20, self.breaker.get_retry_delay(HOST, now=112))
+        self.assertTrue(self.breaker.allow(HOST, now=132))
+        self.breaker.failure(HOST, now=133)
+        self.assertEqual(25, self.breaker.get_retry_delay(HOST, now=133))
+        self.assertTrue(self.breaker.allow(HOST, now=158))
+        self.breaker.success(HOST, now=159)
+        self.assertTrue(self.breaker.allow(HOST, now=159))
+        self.assertEqual(0, self.breaker.get_retry_delay(HOST, now=159))
+
+    def test_disabled(self):
+        """
+        breaker without memory never rejects
+        """
+        breaker = HostBreaker(threshold=1)
+        breaker.failure(HOST)
+        self.assertTrue(breaker.allow(HOST))
+
+    def test_failure_errors(self):
+        """
+        connection errors count as host failures, http ones do not
+        """
+        self.assertIn(pycurl.E_OPERATION_TIMEOUTED, HOST_FAILURE_ERRORS)
+        self.assertNotIn(pycurl.E_TOO_MANY_REDIRECTS, HOST_FAILURE_ERRORS)
+        self.assertNotIn(pycurl.E_WRITE_ERROR, HOST_FAILURE_ERRORS)
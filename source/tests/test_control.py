@@ -0,0 +1,109 @@
+import errno
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+
+import mock
+
+from source.lib.control import ControlServer, ControlError
+
+
+class ControlServerTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'control.sock')
+
+    def make_server(self, commands):
+        server = ControlServer(self.path, commands, timeout=1)
+        server.start()
+        self.addCleanup(server.close)
+        return server
+
+    def request(self, server, line):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.sendall(line)
+        client.shutdown(socket.SHUT_WR)
+        server.handle()
+        response = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+        return json.loads(response)
+
+    def test_command_with_arguments(self):
+        calls = []
+
+        def resize(size, pause=None):
+            calls.append((size, pause))
+            return {'size': 5}
+
+        server = self.make_server({'resize': resize})
+        self.assertEqual({'result': {'size': 5}}, self.request(server, 'resize 5\n'))
+        self.assertEqual([('5', None)], calls)
+        self.assertEqual({'error': u'resize takes 1-2 arguments, got 0'}, self.request(server, 'resize\n'))
+        self.assertEqual({'error': u'resize takes 1-2 arguments, got 3'}, self.request(server, 'resize 1 2 3\n'))
+        self.assertEqual([('5', None)], calls)
+
+    def test_errors(self):
+        """
+        unknown commands, wrong arguments and command errors are reported to the client
+        """
+        def resize(size):
+            raise ControlError(u'bad size')
+
+        def status():
+            return {}['state']
+
+        server = self.make_server({'resize': resize, 'status': status})
+        self.assertEqual({'error': u'bad size'}, self.request(server, 'resize x\n'))
+        self.assertEqual({'error': u'status takes 0 arguments, got 1'}, self.request(server, 'status now\n'))
+        with mock.patch('source.lib.control.logger') as logger:
+            self.assertEqual({'error': u"status failed: 'state'"}, self.request(server, 'status\n'))
+        self.assertTrue(logger.exception.called)
+        self.assertEqual({'error': u'unknown command stop', 'commands': ['resize', 'status']},
+                         self.request(server, 'stop\n'))
+        self.assertEqual('empty command', self.request(server, '')['error'])
+
+    def test_no_clients(self):
+        server = self.make_server({})
+        server.handle()
+
+    def test_stale_socket_replaced(self):
+        """
+        socket file left by a killed process does not stop the next start, close removes it
+        """
+        open(self.path, 'w').close()
+        server = self.make_server({'status': lambda: 'ok'})
+        self.assertEqual({'result': 'ok'}, self.request(server, 'status\n'))
+        server.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_socket_in_use(self):
+        """
+        socket of a running process is not taken over
+        """
+        server = self.make_server({'status': lambda: 'ok'})
+        other = ControlServer(self.path, {}, timeout=1)
+        with self.assertRaises(socket.error) as context:
+            other.start()
+        self.assertEqual(errno.EADDRINUSE, context.exception.args[0])
+        self.assertEqual({'result': 'ok'}, self.request(server, 'status\n'))
+
+    def test_socket_mode(self):
+        """
+        socket is created accessible to the owner only, umask of the process is kept
+        """
+        umask = os.umask(0o022)
+        self.addCleanup(os.umask, umask)
+        self.make_server({})
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(0o022, os.umask(0o022))
@@ -0,0 +1,57 @@
+import unittest
+import mock
+import pycurl
+
+from source.lib.curl_share import DnsCache
+
+
+class DnsCacheTestCase(unittest.TestCase):
+    def test_create_handle_shares_one_cache(self):
+        """
+        all handles of the process use the same CurlShare
+        """
+        cache = DnsCache()
+        with mock.patch('source.lib.curl_share.pycurl.CurlShare', mock.Mock()) as curl_share,\
+             mock.patch('source.lib.curl_share.pycurl.Curl', mock.Mock(side_effect=[mock.Mock(), mock.Mock()])):
+            cache.create_handle()
+            curl = cache.create_handle()
+        self.assertEqual(1, curl_share.call_count)
+        curl_share().setopt.assert_any_call(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        curl_share().setopt.assert_any_call(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        curl.setopt.assert_called_once_with(pycurl.SHARE, cache.share)
+
+    def test_create_handle_after_fork(self):
+        """
+        forked process gets its own CurlShare
+        """
+        cache = DnsCache()
+        with mock.patch('source.lib.curl_share.pycurl.CurlShare', mock.Mock()) as curl_share,\
+             mock.patch('source.lib.curl_share.pycurl.Curl', mock.Mock()):
+            cache.create_handle()
+            with mock.patch('source.lib.curl_share.os.getpid', mock.Mock(return_value=cache.pid + 1)):
+                cache.create_handle()
+        self.assertEqual(2, curl_share.call_count)
+
+    def test_setup(self):
+        """
+        ttl is set on every request
+        """
+        curl = mock.Mock()
+        DnsCache(ttl=300).setup(curl)
+        curl.setopt.assert_called_once_with(pycurl.DNS_CACHE_TIMEOUT, 300)
+
+    def test_account(self):
+        """
+        fast name lookups on new connections count as hits
+        """
+        cache = DnsCache()
+        infos = [
+            {pycurl.NUM_CONNECTS: 0, pycurl.NAMELOOKUP_TIME: 0.0},
+            {pycurl.NUM_CONNECTS: 1, pycurl.NAMELOOKUP_TIME: 0.0001},
+            {pycurl.NUM_CONNECTS: 1, pycurl.NAMELOOKUP_TIME: 0.2},
+        ]
+        for info in infos:
+            curl = mock.Mock()
+            curl.getinfo.side_effect = info.get
+            cache.account(curl)
+        self.assertEqual({'ttl': 60, 'hits': 1, 'misses': 1}, cache.get_stats())
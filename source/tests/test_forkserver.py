@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+
+from source.lib import supervisor
+from source.lib.forkserver import ForkServer, ForkedProcess, get_exitcode, is_running
+from source.lib.supervisor import WorkerPool, DRAIN
+
+preloaded_in = []
+
+
+def heartbeat_worker(parent_pid, channel=None):
+    """Sends heartbeats until drained, exits with the number of preloads it has seen"""
+    # like the real worker, drains at once if the template died before the death signal was set
+    drain = not supervisor.init_worker_process(parent_pid)
+    while not drain and DRAIN not in supervisor.heartbeat(channel, 0):
+        time.sleep(0.01)
+    raise SystemExit(len(preloaded_in))
+
+
+def preload():
+    preloaded_in.append(os.getpid())
+
+
+class ForkServerTestCase(unittest.TestCase):
+    def make_pool(self):
+        fork_server = ForkServer(heartbeat_worker, (), preload=preload)
+        fork_server.start()
+        pool = WorkerPool(heartbeat_worker, (), 10, 10, fork_server)
+        pool.install_signal_handlers()
+        self.addCleanup(signal.signal, signal.SIGCHLD, signal.SIG_DFL)
+        self.addCleanup(self.stop, pool, fork_server)
+        return pool, fork_server
+
+    @staticmethod
+    def stop(pool, fork_server):
+        for pid in pool.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        pool.close()
+        if not fork_server.control.closed:
+            fork_server.stop()
+
+    def wait_for(self, pool, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            pool.wait(0.05)
+        self.assertTrue(condition())
+
+    def test_spawn_and_drain(self):
+        """
+        workers forked by the template report to the pool, their exit codes come from the template
+        """
+        pool, fork_server = self.make_pool()
+        pool.spawn(2, os.getpid())
+        self.assertEqual(2, len(pool))
+        self.assertNotIn(fork_server.process.pid, pool.workers)
+        processes = [state.process for state in pool.workers.values()]
+        pool.wait(0.2)
+        self.assertTrue(all(state.in_flight == 0 for state in pool.workers.values()))
+        pool.drain()
+        self.wait_for(pool, lambda: not pool.workers)
+        # preload ran once in the template, not in the main process
+        self.assertEqual([], preloaded_in)
+        self.assertEqual([1, 1], [process.exitcode for process in processes])
+        self.assertEqual({}, fork_server.workers)
+
+    def test_killed_worker(self):
+        pool, _ = self.make_pool()
+        pool.spawn(1, os.getpid())
+        process = pool.workers.values()[0].process
+        os.kill(process.pid, signal.SIGKILL)
+        self.wait_for(pool, lambda: not pool.workers)
+        self.assertEqual(-signal.SIGKILL, process.exitcode)
+
+    def test_dead_template_is_not_restarted(self):
+        """
+        workers of a dead template are left to die on their own, the next ones are spawned by the main process
+        """
+        pool, fork_server = self.make_pool()
+        pool.spawn(1, os.getpid())
+        old_template = fork_server.process
+        os.kill(old_template.pid, signal.SIGKILL)
+        old_template.join()
+        pool.spawn(1, os.getpid())
+        self.assertIsNone(pool.fork_server)
+        self.assertIs(old_template, fork_server.process)
+        self.assertEqual(2, len(pool))
+        # the orphan gets SIGTERM from the kernel (PR_SET_PDEATHSIG) and drains
+        self.wait_for(pool, lambda: len(pool.workers) == 1)
+        process = pool.workers.values()[0].process
+        self.assertIsInstance(process, multiprocessing.Process)
+        pool.drain()
+        self.wait_for(pool, lambda: not pool.workers)
+        # the main process never ran preload, its worker saw none
+        self.assertEqual(0, process.exitcode)
+
+    def test_lost_template_noticed_while_waiting(self):
+        pool, fork_server = self.make_pool()
+        os.kill(fork_server.process.pid, signal.SIGKILL)
+        self.wait_for(pool, lambda: pool.fork_server is None)
+        self.assertFalse(fork_server.is_alive())
+
+    def test_orphaned_process(self):
+        process = ForkedProcess(os.getpid())
+        process.orphaned = True
+        self.assertTrue(process.is_alive())
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        process = ForkedProcess(pid)
+        process.orphaned = True
+        self.assertFalse(process.is_alive())
+
+    def test_orphaned_zombie(self):
+        """
+        an exited worker nobody has reaped yet is not alive
+        """
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        self.addCleanup(os.waitpid, pid, 0)
+        deadline = time.time() + 5
+        while is_running(pid) and time.time() < deadline:
+            time.sleep(0.01)
+        process = ForkedProcess(pid)
+        process.orphaned = True
+        self.assertFalse(process.is_alive())
+        self.assertTrue(is_running(os.getpid()))
+
+    def test_get_exitcode(self):
+        self.assertEqual(3, get_exitcode(3 << 8))
+        self.assertEqual(-signal.SIGKILL, get_exitcode(signal.SIGKILL))
@@ -0,0 +1,93 @@
+import unittest
+import mock
+
+from source.lib.handle_pool import CurlPool
+
+
+class CurlPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        curl_patcher = mock.patch('source.lib.handle_pool.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock()))
+        curl_patcher.start()
+        self.addCleanup(curl_patcher.stop)
+
+    def test_acquire_miss_then_hit(self):
+        """
+        released handle is reset and reused for the same host
+        """
+        pool = CurlPool()
+        curl = pool.acquire('http://a.ru')
+        pool.release('http://a.ru', curl)
+        self.assertIs(curl, pool.acquire('http://a.ru'))
+        curl.reset.assert_called_once_with()
+        self.assertEqual({'size': 0, 'hosts': 0, 'hits': 1, 'misses': 1}, pool.get_stats())
+
+    def test_acquire_uses_factory(self):
+        """
+        new handles are created by the factory
+        """
+        curl = mock.Mock()
+        pool = CurlPool(factory=mock.Mock(return_value=curl))
+        self.assertIs(curl, pool.acquire('http://a.ru'))
+
+    def test_acquire_other_host(self):
+        """
+        handles are not shared between hosts
+        """
+        pool = CurlPool()
+        curl = pool.acquire('http://a.ru')
+        pool.release('http://a.ru', curl)
+        self.assertIsNot(curl, pool.acquire('http://b.ru'))
+        self.assertEqual(2, pool.misses)
+
+    def test_release_over_max_size(self):
+        """
+        the longest idle handle is closed when the pool is full
+        """
+        pool = CurlPool(max_size=1)
+        first, second = pool.acquire('http://a.ru'), pool.acquire('http://b.ru')
+        with mock.patch('source.lib.handle_pool.time.time', mock.Mock(side_effect=[1, 2])):
+            pool.release('http://a.ru', first)
+            pool.release('http://b.ru', second)
+        first.close.assert_called_once_with()
+        self.assertEqual({'http://b.ru': [(2, second)]}, pool.idle)
+
+    def test_release_pool_disabled(self):
+        """
+        max_size=0 disables pooling
+        """
+        pool = CurlPool(max_size=0)
+        curl = pool.acquire('http://a.ru')
+        pool.release('http://a.ru', curl)
+        curl.close.assert_called_once_with()
+        self.assertEqual(0, pool.size)
+
+    def test_acquire_expires_idle(self):
+        """
+        handles idle for longer than max_idle_time are closed
+        """
+        pool = CurlPool(max_idle_time=10)
+        curl = pool.acquire('http://a.ru')
+        with mock.patch('source.lib.handle_pool.time.time', mock.Mock(side_effect=[100, 111])):
+            pool.release('http://a.ru', curl)
+            self.assertIsNot(curl, pool.acquire('http://a.ru'))
+        curl.close.assert_called_once_with()
+        self.assertEqual(0, pool.size)
+
+    def test_forked_process_drops_inherited_handles(self):
+        """
+        handles inherited from the parent process are not reused
+        """
+        pool = CurlPool()
+        curl = pool.acquire('http://a.ru')
+        pool.release('http://a.ru', curl)
+        with mock.patch('source.lib.handle_pool.os.getpid', mock.Mock(return_value=pool.pid + 1)):
+            self.assertIsNot(curl, pool.acquire('http://a.ru'))
+        self.assertFalse(curl.close.called)
+
+    def test_close(self):
+        pool = CurlPool()
+        curl = pool.acquire('http://a.ru')
+        pool.release('http://a.ru', curl)
+        pool.close()
+        curl.close.assert_called_once_with()
+        self.assertEqual(0, pool.size)
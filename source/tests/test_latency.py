@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from source.lib.latency import HostLatency
+
+HOST = 'http://a.ru'
+
+
+class HostLatencyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.latency = HostLatency(64 * 1024, percentile=0.9, margin=2, min_samples=10, window=100,
+                                   timeout_bounds=(0.5, 10), connect_timeout_bounds=(0.2, 3))
+
+    def add_samples(self, count, connect, total):
+        for _ in xrange(count):
+            self.latency.add(HOST, 0.001, connect, total, now=100)
+
+    def test_defaults_until_enough_samples(self):
+        """
+        hosts with few requests keep the passed timeouts
+        """
+        self.add_samples(9, 0.02, 0.2)
+        self.assertEqual((3, 1), self.latency.get_timeouts(HOST, 3, 1, now=100))
+        self.add_samples(1, 0.02, 0.2)
+        self.assertEqual((0.5, 0.2), self.latency.get_timeouts(HOST, 3, 1, now=100))
+        self.assertEqual({'percentile': 0.9, 'adapted': 1, 'defaulted': 1}, self.latency.get_stats())
+
+    def test_percentile_bucket(self):
+        """
+        timeout is the upper bound of the percentile bucket times margin, clamped
+        """
+        self.add_samples(9, 0.3, 0.9)
+        self.add_samples(1, 0.3, 3)
+        self.assertEqual((2, 1), self.latency.get_timeouts(HOST, 3, 1, now=100))
+        self.add_samples(10, 100, 100)
+        self.assertEqual((10, 3), self.latency.get_timeouts(HOST, 3, 1, now=100))
+
+    def test_missing_connect_time(self):
+        """
+        requests without connect time do not change the connect timeout
+        """
+        self.add_samples(10, None, 0.2)
+        self.assertEqual((0.5, 1), self.latency.get_timeouts(HOST, 3, 1, now=100))
+
+    def test_window_forgets_old_samples(self):
+        """
+        histogram is halved when it outgrows the window
+        """
+        self.add_samples(100, 0.02, 8)
+        self.add_samples(60, 0.02, 0.2)
+        self.assertEqual(10, self.latency.get_timeouts(HOST, 3, 1, now=100)[0])
+        self.add_samples(300, 0.02, 0.2)
+        self.assertEqual(0.5, self.latency.get_timeouts(HOST, 3, 1, now=100)[0])
+
+    def test_disabled(self):
+        """
+        zero size disables the histograms
+        """
+        latency = HostLatency()
+        latency.add(HOST, 0.001, 0.02, 0.2)
+        self.assertFalse(latency.enabled)
+        self.assertEqual((3, None), latency.get_timeouts(HOST, 3, None))
+
+    def test_file_survives_restart(self):
+        """
+        histograms flushed to the file are loaded by the next process
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'latency.cache')
+        latency = HostLatency(64 * 1024, path, min_samples=1)
+        latency.add(HOST, 0.001, 0.02, 0.2, now=100)
+        latency.flush()
+        self.assertEqual((0.5, 0.2), HostLatency(64 * 1024, path, min_samples=1).get_timeouts(HOST, 3, 1, now=100))
+
+    def test_planted_file_rejected(self):
+        """
+        a file others can write would let them set host timeouts, it is not loaded
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'latency.cache')
+        open(path, 'w').close()
+        os.chmod(path, 0666)
+        self.assertRaises(OSError, HostLatency, 64 * 1024, path)
+        link = os.path.join(directory, 'link.cache')
+        os.symlink(path, link)
+        self.assertRaises(OSError, HostLatency, 64 * 1024, link)
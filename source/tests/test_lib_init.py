@@ -1,16 +1,106 @@
 from bs4 import BeautifulSoup
+import glob
+import itertools
+import os
+import random
 import unittest
+from urllib import quote, quote_plus
+from urlparse import urlparse, urlunparse
 import mock
 import re
 
 from source.lib import to_unicode, to_str, get_counters, check_for_meta, GOOGLE_MARKET_PREFIX, GOOGLE_PLAY_PREFIX, \
-    fix_market_url, make_pycurl_request, get_url, REDIRECT_META, REDIRECT_HTTP, get_redirect_history, prepare_url
+    fix_market_url, make_pycurl_request, get_url, REDIRECT_META, REDIRECT_HTTP, get_redirect_history, prepare_url, \
+    RedirectChain, MultiRedirectResolver, get_redirect_histories, ResponseBuffer, check_for_meta_soup, find_first_meta, \
+    COUNTER_TYPES, get_counter_matchers, setup_curl, REDIRECT_DEADLINE, get_error_class
+import pycurl
+
+import source.lib
+from source.lib.curl_share import DnsCache
+from source.lib.handle_pool import CurlPool
+from source.lib.shared_cache import SharedCache
+from source.lib.breaker import HostBreaker, HostUnavailableError
+from source.lib.latency import HostLatency
+from source.lib.memo import MemoCache
+from source.lib.timing import Metrics
 
 
 __author__ = 'warprobot'
 
 
+def prepare_url_reference(url):
+    """prepare_url before memoization"""
+    if url is None:
+        return url
+    scheme, netloc, path, qs, anchor, fragments = urlparse(
+        to_unicode(url),
+        allow_fragments=False
+    )
+    try:
+        netloc = netloc.encode('idna')
+    except UnicodeError:
+        pass
+    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+
+
+def get_url_corpus():
+    schemes = [u'http://', u'https://', u'HTTP://', u'market://', u'', u'//']
+    netlocs = [u'example.com', u'WWW.Example.COM:8080', u'user:pass@a.ru', u'\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444',
+               u'xn--e1afmkfd.xn--p1ai', u'\u041f\u0420\u0418\u041c\u0415\u0420.\u0420\u0424:81', u'a..b', u'',
+               u'x' * 64 + u'.com', u'\u00e9.fr', u'127.0.0.1']
+    paths = [u'', u'/', u'/a b/c', u'/%D0%BF%20x', u'/\u043f\u0443\u0442\u044c', u'/p;params', u'/a/../b/',
+             u'/~user/%zz', u"/!$*'(),+", u'/a#frag', u'/a\\b']
+    queries = [u'', u'?', u'?a=1&b=2', u'?q=a b+c', u'?q=\u0444&x=%20', u'?u=http://b.ru/?c=1#f', u'?a=1;b=2',
+               u'?%zz=\u00e9']
+    corpus = [u''.join(parts) for parts in itertools.product(schemes, netlocs, paths, queries)]
+    corpus += [url.encode('utf8') for url in corpus[::7]]
+    rnd = random.Random(12)
+    alphabet = u'aZ09/:?#&=%+ ;.@~\u0444\u00e9\u4e2d'
+    corpus += [u'http://' + u''.join(rnd.choice(alphabet) for _ in xrange(rnd.randint(1, 40)))
+               for _ in xrange(2000)]
+    return corpus
+
+META_PAGES_DIR = os.path.join(os.path.dirname(__file__), 'data', 'meta_pages')
+
+
 class InitTestCase(unittest.TestCase):
+    def setUp(self):
+        pool_patcher = mock.patch('source.lib.curl_pool', CurlPool())
+        pool_patcher.start()
+        self.addCleanup(pool_patcher.stop)
+        dns_cache_patcher = mock.patch('source.lib.dns_cache', DnsCache())
+        dns_cache_patcher.start()
+        self.addCleanup(dns_cache_patcher.stop)
+        hop_cache_patcher = mock.patch('source.lib.hop_cache', SharedCache())
+        hop_cache_patcher.start()
+        self.addCleanup(hop_cache_patcher.stop)
+        hop_cache_ttl_patcher = mock.patch.dict('source.lib.hop_cache_ttl', clear=True)
+        hop_cache_ttl_patcher.start()
+        self.addCleanup(hop_cache_ttl_patcher.stop)
+        suffix_cache_patcher = mock.patch('source.lib.suffix_cache', SharedCache())
+        suffix_cache_patcher.start()
+        self.addCleanup(suffix_cache_patcher.stop)
+        suffix_cache_ttl_patcher = mock.patch('source.lib.suffix_cache_ttl', 0)
+        suffix_cache_ttl_patcher.start()
+        self.addCleanup(suffix_cache_ttl_patcher.stop)
+        host_breaker_patcher = mock.patch('source.lib.host_breaker', HostBreaker())
+        host_breaker_patcher.start()
+        self.addCleanup(host_breaker_patcher.stop)
+        host_latency_patcher = mock.patch('source.lib.host_latency', HostLatency())
+        host_latency_patcher.start()
+        self.addCleanup(host_latency_patcher.stop)
+        metrics_patcher = mock.patch('source.lib.metrics', Metrics())
+        metrics_patcher.start()
+        self.addCleanup(metrics_patcher.stop)
+        prepared_urls_patcher = mock.patch('source.lib.prepared_urls', MemoCache())
+        prepared_urls_patcher.start()
+        self.addCleanup(prepared_urls_patcher.stop)
+        idna_netlocs_patcher = mock.patch('source.lib.idna_netlocs', MemoCache())
+        idna_netlocs_patcher.start()
+        self.addCleanup(idna_netlocs_patcher.stop)
+
     def test_to_unicode_with_unicode(self):
         """
         Test to_unicode with already unicode string in input.
@@ -53,6 +143,44 @@ class InitTestCase(unittest.TestCase):
                   + "left:-10000px;\" /></body></html>"
         self.assertEquals(get_counters(content), [counter_name])
 
+    def test_get_counters_same_as_regexp(self):
+        """
+        Counters are found like with the original .*literal.* regexps, in COUNTER_TYPES order
+        """
+        contents = [
+            '<script src="//A1.VDNA-assets.com/analytics.js"></script>' +
+            '<a href="http://top.mail.ru/jump?from=1"></a><img src="//top-fwz1.mail.ru/counter?id=1">' +
+            '<script>var s = "https://ssl.google-analytics.com/ga.js";</script>',
+            'top.mail.ru/jump?from' + 'x' * 10000 + 'mc.yandex.ru/metrika/watch.js\n',
+            'counter.rambler.ru/top10 counter.yadro.ru/hit top.mail.ru/jump?fro',
+            u'<img src="//counter.yadro.ru/hit?r=\u0444">',
+            u'<script src="//googleads.g.doubleclic\u212a.net/pagead/viewthroughconversion/1">',
+            '',
+        ]
+        for content in contents:
+            expected = [counter_name for counter_name, regexp in COUNTER_TYPES if re.match(regexp, content)]
+            self.assertEqual(expected, get_counters(content))
+
+    def test_get_counter_matchers_not_literal(self):
+        """
+        Counter regexps must be .*literal.*
+        """
+        for pattern in (r'.*a+b.*', r'abc.*', r'.*ab\w.*', r'.*(ab).*'):
+            self.assertRaises(ValueError, get_counter_matchers, [('BAD', re.compile(pattern, re.I+re.S))])
+
+    def test_set_counter_types(self):
+        """
+        New counter rules replace the current ones, broken rules are not applied
+        """
+        content = '<img src="//counter.example.com/hit"><img src="http://counter.rambler.ru/top100.cnt">'
+        with mock.patch('source.lib.COUNTER_MATCHERS', source.lib.COUNTER_MATCHERS):
+            self.assertEqual(1, source.lib.set_counter_types([('EXAMPLE', r'.*COUNTER\.example\.com/hit.*')]))
+            self.assertEqual(['EXAMPLE'], get_counters(content))
+            self.assertRaises(ValueError, source.lib.set_counter_types, [('RAMBLER_TOP100', r'.*counter\.rambler.*'),
+                                                                         ('BAD', r'.*a|b.*')])
+            self.assertEqual(['EXAMPLE'], get_counters(content))
+        self.assertEqual(['RAMBLER_TOP100'], get_counters(content))
+
     def test_get_counters_dummy_content(self):
         """
         Content doesn't contain counters // for more branch coverage
@@ -72,7 +200,7 @@ class InitTestCase(unittest.TestCase):
         url = 'example.com/hell.php?what=123'
         result.__getitem__ = mock.Mock(return_value=result.attrs["content"] + url)
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
-            check = check_for_meta("content", "url")
+            check = check_for_meta_soup("content", "url")
             self.assertEquals(check, url)
 
     def test_check_for_meta_no_meta(self):
@@ -81,7 +209,7 @@ class InitTestCase(unittest.TestCase):
         """
         result = None
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
-            self.assertIsNone(check_for_meta("content", "url"))
+            self.assertIsNone(check_for_meta_soup("content", "url"))
 
     def test_check_for_meta_no_content(self):
         """
@@ -92,7 +220,7 @@ class InitTestCase(unittest.TestCase):
             "abc": "contentDummy",
         }
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
-            self.assertIsNone(check_for_meta("content", "url"))
+            self.assertIsNone(check_for_meta_soup("content", "url"))
 
 
     def test_check_for_meta_no_http_equiv(self):
@@ -104,7 +232,7 @@ class InitTestCase(unittest.TestCase):
             "content": "contentDummy",
         }
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
-            self.assertIsNone(check_for_meta("content", "url"))
+            self.assertIsNone(check_for_meta_soup("content", "url"))
 
     def test_check_for_meta_wrong_length(self):
         """
@@ -117,7 +245,7 @@ class InitTestCase(unittest.TestCase):
         }
         result.__getitem__ = mock.Mock(return_value=result.attrs["content"])
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
-            self.assertIsNone(check_for_meta("content", "url"))
+            self.assertIsNone(check_for_meta_soup("content", "url"))
 
     @mock.patch.object(re, 'search', mock.Mock(return_value=None))
     def test_check_for_meta_wrong_search(self):
@@ -134,7 +262,62 @@ class InitTestCase(unittest.TestCase):
 
         with mock.patch.object(BeautifulSoup, "find", return_value=result):
             with mock.patch("source.lib.urljoin", mock.Mock()):
-                self.assertIsNone(check_for_meta("content", "url"))
+                self.assertIsNone(check_for_meta_soup("content", "url"))
+
+    def test_check_for_meta_matches_soup_on_saved_pages(self):
+        """
+        fast meta search gives the same result as BeautifulSoup
+        """
+        pages = glob.glob(os.path.join(META_PAGES_DIR, '*.html'))
+        self.assertTrue(pages)
+        for page in pages:
+            with open(page) as f:
+                content = f.read()
+            url = 'http://example.com/dir/page.html'
+            self.assertEqual(check_for_meta_soup(content, url), check_for_meta(content, url), page)
+
+    def test_check_for_meta_fast(self):
+        """
+        first meta tag is found without BeautifulSoup
+        """
+        content = '<html><head><!-- <meta http-equiv="refresh" content="0; url=/a"> -->' \
+                  '<meta http-equiv="Refresh" content="0; URL=/b?x=1&amp;y=2"></head></html>'
+        with mock.patch('source.lib.check_for_meta_soup', mock.Mock()) as check_for_meta_soup_mock:
+            self.assertEqual(u'http://a.ru/b?x=1&y=2', check_for_meta(content, 'http://a.ru/c'))
+        self.assertFalse(check_for_meta_soup_mock.called)
+
+    def test_check_for_meta_not_refresh(self):
+        """
+        only the first meta tag is checked
+        """
+        content = '<meta charset="utf-8"><meta http-equiv="refresh" content="0; url=/b">'
+        self.assertIsNone(check_for_meta(content, 'http://a.ru/'))
+
+    def test_check_for_meta_fallback_counted(self):
+        """
+        pages that need decoding go to BeautifulSoup and are counted
+        """
+        content = u'<meta http-equiv="refresh" content="0; url=/\u0444">'.encode('utf-16')
+        with mock.patch('source.lib.meta_stats', {'fast': 0, 'soup': 0}) as meta_stats,\
+             mock.patch('source.lib.check_for_meta_soup', mock.Mock(return_value='url')):
+            self.assertEqual('url', check_for_meta(content, 'http://a.ru/'))
+            self.assertEqual('url', check_for_meta('<meta http-equiv="refresh" content="0; url=/\xd1\x84">',
+                                                   'http://a.ru/'))
+            self.assertIsNone(check_for_meta('<html></html>', 'http://a.ru/'))
+        self.assertEqual({'fast': 1, 'soup': 2}, meta_stats)
+
+    def test_find_first_meta_split_tag(self):
+        """
+        '>' inside an attribute value does not cut the tag
+        """
+        content = '<meta name="a>b" content="x"><p>text</p>'
+        self.assertEqual({'name': 'a>b', 'content': 'x'}, find_first_meta(content))
+
+    def test_find_first_meta_empty_attribute(self):
+        """
+        attributes without value are empty strings, as in BeautifulSoup
+        """
+        self.assertEqual({'http-equiv': '', 'content': 'x'}, find_first_meta('<meta http-equiv content=x>'))
 
     def test_fix_market_url(self):
         """
@@ -181,6 +364,170 @@ class InitTestCase(unittest.TestCase):
             self.assertEquals(make_pycurl_request(url="url", timeout=1),
                               (content, None))
 
+    def test_pycurl_request_reuses_handle(self):
+        """
+        handle goes back to the pool after the request
+        """
+        my_curl = mock.Mock()
+        my_curl.getinfo.return_value = None
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=my_curl)):
+            make_pycurl_request(url='http://example.com/', timeout=1)
+            make_pycurl_request(url='http://example.com/page', timeout=1)
+        self.assertEqual({'size': 1, 'hosts': 1, 'hits': 1, 'misses': 1}, source.lib.curl_pool.get_stats())
+        self.assertFalse(my_curl.close.called)
+
+    def test_pycurl_request_error_closes_handle(self):
+        """
+        handle is not reused after a failed request
+        """
+        my_curl = mock.Mock()
+        my_curl.perform.side_effect = pycurl.error(pycurl.E_COULDNT_CONNECT, 'error')
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=my_curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, url='http://example.com/', timeout=1)
+        my_curl.close.assert_called_once_with()
+        self.assertEqual(0, source.lib.curl_pool.size)
+
+    def test_pycurl_request_aborted_redirect(self):
+        """
+        body of a redirect is not downloaded, Location is resolved by hand
+        """
+        my_curl = mock.Mock()
+        my_curl.getinfo.side_effect = {my_curl.REDIRECT_URL: None, my_curl.EFFECTIVE_URL: 'http://a.ru/x/y'}.get
+
+        def perform():
+            buff = dict(c[0] for c in my_curl.setopt.call_args_list)[my_curl.WRITEFUNCTION].im_self
+            buff.header('HTTP/1.1 302 Found\r\n')
+            buff.header('Location: ../z\r\n')
+            buff.write('<html>')
+            raise pycurl.error(pycurl.E_WRITE_ERROR, 'Failure writing output to destination')
+
+        my_curl.perform.side_effect = perform
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=my_curl)):
+            self.assertEqual(('', u'http://a.ru/z'), make_pycurl_request(url='http://a.ru/x/y', timeout=1))
+        self.assertFalse(my_curl.close.called)
+
+    def test_pycurl_request_location_of_not_redirect(self):
+        """
+        Location of a 2xx response is not a redirect even if the body is skipped
+        """
+        my_curl = mock.Mock()
+        my_curl.getinfo.side_effect = {my_curl.REDIRECT_URL: None, my_curl.EFFECTIVE_URL: 'http://a.ru/x/y'}.get
+
+        def perform():
+            buff = dict(c[0] for c in my_curl.setopt.call_args_list)[my_curl.WRITEFUNCTION].im_self
+            buff.header('HTTP/1.1 201 Created\r\n')
+            buff.header('Location: /elsewhere\r\n')
+            buff.header('Content-Type: application/json\r\n')
+            buff.write('{}')
+            raise pycurl.error(pycurl.E_WRITE_ERROR, 'Failure writing output to destination')
+
+        my_curl.perform.side_effect = perform
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=my_curl)):
+            self.assertEqual(('', None), make_pycurl_request(url='http://a.ru/x/y', timeout=1))
+
+    def test_response_buffer_headers(self):
+        """
+        headers of the last response are kept
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        buff.header('HTTP/1.1 100 Continue\r\n')
+        buff.header('Content-Type: text/plain\r\n')
+        buff.header('HTTP/1.1 301 Moved Permanently\r\n')
+        buff.header('Location: http://b.ru/\r\n')
+        buff.header('\r\n')
+        self.assertEqual((301, 'http://b.ru/', None), (buff.status, buff.location, buff.content_type))
+
+    def test_response_buffer_skips_not_html(self):
+        """
+        body of a non-html response is not downloaded
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        buff.header('HTTP/1.1 200 OK\r\n')
+        buff.header('Content-Type: application/vnd.android.package-archive\r\n')
+        self.assertEqual(0, buff.write('PK\x03\x04'))
+        self.assertTrue(buff.aborted)
+        self.assertFalse(buff.redirect_aborted)
+        self.assertEqual('', buff.getvalue())
+        self.assertTrue(buff.is_abort_error(pycurl.error(pycurl.E_WRITE_ERROR, 'error')))
+        self.assertFalse(buff.is_abort_error(pycurl.error(pycurl.E_OPERATION_TIMEOUTED, 'error')))
+
+    def test_response_buffer_skips_redirect_body(self):
+        """
+        body of a http redirect is not downloaded
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: http://b.ru/\r\n')
+        self.assertEqual(0, buff.write('<html>'))
+        self.assertTrue(buff.redirect_aborted)
+
+    def test_response_buffer_keeps_ok_login_redirect_body(self):
+        """
+        ok login redirect is ignored, so its body may be the final page
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: http://odnoklassniki.ru/dk?st.redirect=1\r\n')
+        self.assertIsNone(buff.write('<html>'))
+        self.assertEqual('<html>', buff.getvalue())
+
+    def test_response_buffer_max_size(self):
+        """
+        body is cut after max_size bytes
+        """
+        buff = ResponseBuffer('http://a.ru/', max_size=5)
+        self.assertIsNone(buff.write('<ht'))
+        self.assertEqual(0, buff.write('ml>'))
+        self.assertEqual('<html', buff.getvalue())
+        self.assertTrue(buff.aborted)
+
+    def test_response_buffer_stops_after_head_with_meta(self):
+        """
+        page with meta redirect in <head> is read only up to </head>
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        buff.header('HTTP/1.1 200 OK\r\n')
+        buff.header('Content-Type: text/html\r\n')
+        self.assertIsNone(buff.write('<html><head><meta http-equiv="refresh" content="0; url=/b"></he'))
+        self.assertEqual(0, buff.write('ad><body>'))
+        self.assertTrue(buff.aborted)
+        self.assertEqual(u'http://a.ru/b', buff.meta_url)
+
+    def test_get_url_reuses_meta_from_head(self):
+        """
+        meta redirect found while reading <head> is not searched again,
+        counters are not taken from the page read only up to </head>
+        """
+        my_curl = mock.Mock()
+        my_curl.getinfo.side_effect = {my_curl.REDIRECT_URL: None}.get
+
+        def perform():
+            buff = dict(c[0] for c in my_curl.setopt.call_args_list)[my_curl.WRITEFUNCTION].im_self
+            buff.header('HTTP/1.1 200 OK\r\n')
+            buff.header('Content-Type: text/html\r\n')
+            buff.write('<html><head><meta http-equiv="refresh" content="0; url=/b">'
+                       '<script src="http://mc.yandex.ru/metrika/watch.js"></script></head>')
+            buff.write('<body></body>')
+            raise pycurl.error(pycurl.E_WRITE_ERROR, 'Failure writing output to destination')
+
+        my_curl.perform.side_effect = perform
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=my_curl)),\
+             mock.patch('source.lib.check_for_meta', mock.Mock(wraps=source.lib.check_for_meta)) as check_for_meta:
+            self.assertEqual((u'http://a.ru/b', REDIRECT_META, None), get_url('http://a.ru/', timeout=1))
+        self.assertEqual(1, check_for_meta.call_count)
+
+    def test_response_buffer_reads_final_page(self):
+        """
+        page without meta redirect is read completely
+        """
+        buff = ResponseBuffer('http://a.ru/')
+        with mock.patch('source.lib.check_for_meta', mock.Mock(return_value=None)) as check_for_meta:
+            self.assertIsNone(buff.write('<html><head></head>'))
+            self.assertIsNone(buff.write('<body></body></html>'))
+        check_for_meta.assert_called_once_with('<html><head></head>', 'http://a.ru/')
+        self.assertEqual('<html><head></head><body></body></html>', buff.getvalue())
+        self.assertFalse(buff.aborted)
+
     def test_get_url_ignore_ok_login_redirects(self):
         """
         ignoring ok login redirects
@@ -284,6 +631,18 @@ class InitTestCase(unittest.TestCase):
              mock.patch("source.lib.get_url", mock.Mock(return_value=(redirect_url, redirect_type, content))):
             self.assertEquals((history_types, history_urls, counters), get_redirect_history(url=url, timeout=1))
 
+    def test_get_redirect_history_error_class(self):
+        """
+        chain broken by a failed request keeps the error class
+        """
+        curl = mock.Mock()
+        curl.perform.side_effect = pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused')
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            history = get_redirect_history(u'http://a.ru/', timeout=1)
+            self.assertEqual(source.lib.ERROR_CONNECT, get_url(u'http://a.ru/', 1).error)
+        self.assertEqual((['ERROR'], [u'http://a.ru/', u'http://a.ru/'], []), history)
+        self.assertEqual(source.lib.ERROR_CONNECT, history.error)
+
     def test_get_redirect_history_max_redirect_break(self):
         """
         only 1 redirect
@@ -310,6 +669,324 @@ class InitTestCase(unittest.TestCase):
                               [u'http://example.com/', 'http://example2.com/', 'http://example2.com/'], []),
                              get_redirect_history(url='http://example.com/', timeout=1))
 
+    def test_get_redirect_history_uses_hop_cache(self):
+        """
+        Cached hops are not requested again, the final page is
+        """
+        source.lib.init_hop_cache(64 * 1024, 1024, {REDIRECT_HTTP: 60})
+        hops = {
+            u'http://a.ru/': (u'http://b.ru/', REDIRECT_HTTP, ''),
+            u'http://b.ru/': (None, None, 'final'),
+        }
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=lambda url, **kwargs: hops[url])) as get_url:
+            first = get_redirect_history(u'http://a.ru/', timeout=1, user_agent='ua')
+            second = get_redirect_history(u'http://a.ru/', timeout=1, user_agent='ua')
+            self.assertEqual(first, second)
+            self.assertEqual(3, get_url.call_count)
+            get_redirect_history(u'http://a.ru/', timeout=1, user_agent='other')
+            self.assertEqual(5, get_url.call_count)
+            get_redirect_history(u'http://a.ru/', timeout=1, user_agent='ua', use_cache=False)
+            self.assertEqual(7, get_url.call_count)
+        self.assertEqual(1, source.lib.hop_cache.get_stats()['hits'])
+
+    def test_cache_hop_keeps_counters(self):
+        """
+        Counters of a cached meta redirect page are kept without the page
+        """
+        source.lib.init_hop_cache(64 * 1024, 1024, {REDIRECT_META: 60})
+        content = '<meta http-equiv="refresh" content="0; url=/b"><img src="http://counter.rambler.ru/top100.cnt">'
+        source.lib.cache_hop(u'http://a.ru/', None, (u'http://a.ru/b', REDIRECT_META, content))
+        source.lib.cache_hop(u'http://a.ru/c', None, (u'http://a.ru/d', REDIRECT_HTTP, ''))
+        source.lib.cache_hop(u'http://a.ru/e', None, (u'http://a.ru/e', 'ERROR', None))
+        self.assertEqual((u'http://a.ru/b', REDIRECT_META, None, ['RAMBLER_TOP100']),
+                         source.lib.get_cached_hop(u'http://a.ru/', None))
+        self.assertIsNone(source.lib.get_cached_hop(u'http://a.ru/c', None))
+        self.assertIsNone(source.lib.get_cached_hop(u'http://a.ru/e', None))
+
+        chain = RedirectChain(u'http://a.ru/', max_redirects=1)
+        self.assertTrue(chain.add_hop(*source.lib.get_cached_hop(u'http://a.ru/', None)))
+        self.assertEqual(([REDIRECT_META], [u'http://a.ru/', u'http://a.ru/b'], ['RAMBLER_TOP100']),
+                         chain.get_result())
+
+    def test_multi_resolver_uses_hop_cache(self):
+        """
+        Cached hops are passed without requests, new ones are cached
+        """
+        source.lib.init_hop_cache(64 * 1024, 1024, {REDIRECT_HTTP: 60})
+        source.lib.cache_hop(u'http://a.ru/', None, (u'http://b.ru/', REDIRECT_HTTP, ''))
+        curl = mock.Mock()
+        curl.getinfo.return_value = 'http://c.ru/'
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.return_value = (0, [curl], [])
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            resolver = MultiRedirectResolver(timeout=1, max_redirects=2)
+            resolver.add(u'http://a.ru/', 'tag')
+            result = resolver.perform()
+        self.assertEqual([('tag', ([REDIRECT_HTTP, REDIRECT_HTTP],
+                                   [u'http://a.ru/', u'http://b.ru/', u'http://c.ru/'], []))], result)
+        multi.add_handle.assert_called_once_with(curl)
+        self.assertEqual((u'http://c.ru/', REDIRECT_HTTP, None, []), source.lib.get_cached_hop(u'http://b.ru/', None))
+
+    def test_get_redirect_history_splices_suffix(self):
+        """
+        Chain reaching a resolved url takes its tail without requests
+        """
+        source.lib.init_suffix_cache(64 * 1024, 4096, 60, None)
+        hops = {
+            u'http://a.ru/': (u'http://b.ru/', REDIRECT_HTTP, ''),
+            u'http://x.ru/': (u'http://b.ru/', REDIRECT_HTTP, ''),
+            u'http://b.ru/': (u'http://c.ru/', REDIRECT_META, 'meta'),
+            u'http://c.ru/': (None, None, '<img src="http://counter.rambler.ru/top100.cnt">'),
+        }
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=lambda url, **kwargs: hops[url])) as get_url:
+            self.assertEqual(([REDIRECT_HTTP, REDIRECT_META], [u'http://a.ru/', u'http://b.ru/', u'http://c.ru/'],
+                              ['RAMBLER_TOP100']), get_redirect_history(u'http://a.ru/', timeout=1))
+            self.assertEqual(3, get_url.call_count)
+            self.assertEqual(([REDIRECT_HTTP, REDIRECT_META], [u'http://x.ru/', u'http://b.ru/', u'http://c.ru/'],
+                              ['RAMBLER_TOP100']), get_redirect_history(u'http://x.ru/', timeout=1))
+            self.assertEqual(4, get_url.call_count)
+            self.assertEqual(([REDIRECT_HTTP], [u'http://x.ru/', u'http://b.ru/'], []),
+                             get_redirect_history(u'http://x.ru/', timeout=1, max_redirects=1))
+            self.assertEqual(5, get_url.call_count)
+
+    def test_redirect_chain_add_suffix_not_walked(self):
+        """
+        Tail is not spliced if the walk would stop before the final page
+        """
+        chain = RedirectChain(u'http://a.ru/', max_redirects=3)
+        chain.add_hop(u'http://b.ru/', REDIRECT_HTTP, None)
+        self.assertFalse(chain.add_suffix([REDIRECT_HTTP, REDIRECT_HTTP], [u'http://c.ru/', u'http://a.ru/'], [], 0))
+        self.assertFalse(chain.add_suffix([REDIRECT_HTTP] * 2, [u'http://c.ru/', u'http://d.ru/'], [], 0))
+        self.assertEqual([u'http://a.ru/', u'http://b.ru/'], chain.history_urls)
+        self.assertTrue(chain.add_suffix([REDIRECT_HTTP], [u'http://c.ru/'], ['LI_RU'], 0))
+        self.assertEqual(([REDIRECT_HTTP] * 2, [u'http://a.ru/', u'http://b.ru/', u'http://c.ru/'], ['LI_RU']),
+                         chain.get_result())
+
+    def test_cache_suffixes_not_prolonged(self):
+        """
+        Tails built on a cached tail expire with it
+        """
+        source.lib.init_suffix_cache(64 * 1024, 4096, 60, None)
+        chain = RedirectChain(u'http://a.ru/')
+        chain.add_suffix([REDIRECT_HTTP], [u'http://b.ru/'], [], 1000)
+        with mock.patch('source.lib.suffix_cache', mock.Mock()) as suffix_cache:
+            with mock.patch('source.lib.time', mock.Mock(return_value=1050)):
+                source.lib.cache_suffixes(chain, None)
+            with mock.patch('source.lib.time', mock.Mock(return_value=1060)):
+                source.lib.cache_suffixes(chain, None)
+            source.lib.cache_suffixes(RedirectChain(u'http://a.ru/'), None)
+        self.assertEqual([mock.call(u'http://a.ru/\n', ([REDIRECT_HTTP], [u'http://b.ru/'], [], 1000), 10),
+                          mock.call(u'http://b.ru/\n', ([], [], [], 1000), 10)],
+                         suffix_cache.set.call_args_list)
+
+    def test_multi_resolver_splices_suffix(self):
+        """
+        Known tail finishes the chain without requests
+        """
+        source.lib.init_suffix_cache(64 * 1024, 4096, 60, None)
+        chain = RedirectChain(u'http://a.ru/')
+        chain.add_hop(u'http://b.ru/', REDIRECT_HTTP, None)
+        chain.add_hop(None, None, None)
+        source.lib.cache_suffixes(chain, None)
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            self.assertEqual([('tag', ([REDIRECT_HTTP], [u'http://a.ru/', u'http://b.ru/'], []))],
+                             resolver.perform())
+        self.assertFalse(multi.add_handle.called)
+
+    def test_make_pycurl_request_host_unavailable(self):
+        """
+        Requests to a host with open breaker fail without a handle
+        """
+        source.lib.init_host_breaker(64 * 1024, 2, 60, 60)
+        curl = mock.Mock()
+        curl.perform.side_effect = pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused')
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)) as curl_class:
+            for _ in xrange(2):
+                self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/x', 1)
+            self.assertRaises(HostUnavailableError, make_pycurl_request, u'http://a.ru/y', 1)
+            self.assertEqual(2, curl_class.call_count)
+            url, redirect_type, content = get_url(u'http://a.ru/z', 1)
+        self.assertEqual('ERROR', redirect_type)
+        self.assertTrue(source.lib.get_url_retry_delay(u'http://a.ru/') > 59)
+        self.assertEqual(0, source.lib.get_url_retry_delay(u'http://b.ru/'))
+
+    def test_make_pycurl_request_http_error_not_host_failure(self):
+        """
+        Only connection errors count against the host, a response resets them
+        """
+        source.lib.init_host_breaker(64 * 1024, 2, 60, 60)
+        curl = mock.Mock()
+        curl.perform.side_effect = [pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused'),
+                                    pycurl.error(pycurl.E_TOO_MANY_REDIRECTS, 'redirects'), None,
+                                    pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused')]
+        curl.getinfo.return_value = None
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 1)
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 1)
+            make_pycurl_request(u'http://a.ru/', 1)
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 1)
+        self.assertTrue(source.lib.host_breaker.allow(u'http://a.ru'))
+
+    def test_make_pycurl_request_cut_timeout_not_host_failure(self):
+        """
+        Timeout cut by the chain deadline neither opens the breaker nor goes to the host latency
+        """
+        source.lib.init_host_breaker(64 * 1024, 1, 60, 60)
+        source.lib.init_host_latency(64 * 1024, None, 0.99, 2, 1, (0.5, 10), (0.2, 3))
+        curl = mock.Mock()
+        curl.perform.side_effect = pycurl.error(pycurl.E_OPERATION_TIMEOUTED, 'timeout')
+        curl.getinfo.return_value = 0.1
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 0.1, timeout_cut=True)
+            self.assertEqual('ERROR', get_url(u'http://a.ru/', 0.1, timeout_cut=True)[1])
+        self.assertTrue(source.lib.host_breaker.allow(u'http://a.ru'))
+        self.assertEqual((3, 1), source.lib.get_url_timeouts(u'http://a.ru/x', 3, 1))
+
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 0.1)
+        self.assertFalse(source.lib.host_breaker.allow(u'http://a.ru'))
+
+    def test_get_redirect_history_cut_timeout(self):
+        """
+        Hop timeout cut by the chain deadline is marked for the error accounting
+        """
+        with mock.patch('source.lib.get_url_timeouts', mock.Mock(return_value=(8, 2))), \
+             mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, None))) as get_url_mock:
+            get_redirect_history(u'http://a.ru/', timeout=3, deadline=5)
+            self.assertTrue(get_url_mock.call_args[1]['timeout_cut'])
+            get_redirect_history(u'http://a.ru/', timeout=3, deadline=10)
+            self.assertFalse(get_url_mock.call_args[1]['timeout_cut'])
+
+    def test_multi_resolver_cut_timeout_not_host_failure(self):
+        """
+        Hop timed out on the timeout cut by the chain deadline does not open the breaker
+        """
+        source.lib.init_host_breaker(64 * 1024, 1, 60, 60)
+        curl = mock.Mock()
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.return_value = (0, [], [(curl, pycurl.E_OPERATION_TIMEOUTED, 'timeout')])
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            resolver = MultiRedirectResolver(timeout=10, deadline=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            result = resolver.perform()
+        self.assertEqual(source.lib.ERROR_TIMEOUT, result[0][1].error)
+        self.assertTrue(source.lib.host_breaker.allow(u'http://a.ru'))
+
+    def test_multi_resolver_host_unavailable(self):
+        """
+        Hop to a host with open breaker is an ERROR without a request
+        """
+        source.lib.init_host_breaker(64 * 1024, 1, 60, 60)
+        source.lib.host_breaker.failure('http://a.ru')
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            self.assertEqual([('tag', (['ERROR'], [u'http://a.ru/', u'http://a.ru/'], []))], resolver.perform())
+        self.assertFalse(multi.add_handle.called)
+
+    def test_host_latency_recorded(self):
+        """
+        Answered and timed out requests go to the host histograms, reused connections give no connect time
+        """
+        source.lib.init_host_latency(64 * 1024, None, 0.99, 2, 1, (0.5, 10), (0.2, 3))
+        info = {pycurl.NAMELOOKUP_TIME: 0.01, pycurl.CONNECT_TIME: 0.02, pycurl.TOTAL_TIME: 0.2,
+                pycurl.NUM_CONNECTS: 1, pycurl.REDIRECT_URL: None}
+        curl = mock.Mock()
+        curl.getinfo.side_effect = info.get
+        for name in ('NAMELOOKUP_TIME', 'CONNECT_TIME', 'TOTAL_TIME', 'NUM_CONNECTS', 'REDIRECT_URL'):
+            setattr(curl, name, getattr(pycurl, name))
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            make_pycurl_request(u'http://a.ru/', 1)
+        self.assertEqual((0.5, 0.2), source.lib.get_url_timeouts(u'http://a.ru/x', 3, 1))
+
+        info.update({pycurl.CONNECT_TIME: 0, pycurl.TOTAL_TIME: 3})
+        curl.perform.side_effect = pycurl.error(pycurl.E_OPERATION_TIMEOUTED, 'timeout')
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 1)
+        self.assertEqual((8, 3), source.lib.get_url_timeouts(u'http://a.ru/x', 3, 1))
+        self.assertEqual((3, 1), source.lib.get_url_timeouts(u'http://b.ru/', 3, 1))
+
+    def test_hop_metrics_recorded(self):
+        """
+        Curl phases of answered and failed hops go to the metrics, phases that did not happen are skipped
+        """
+        source.lib.init_metrics()
+        info = {pycurl.NAMELOOKUP_TIME: 0.01, pycurl.CONNECT_TIME: 0.02, pycurl.APPCONNECT_TIME: 0,
+                pycurl.STARTTRANSFER_TIME: 0.15, pycurl.TOTAL_TIME: 0.2, pycurl.SIZE_DOWNLOAD: 2000,
+                pycurl.NUM_CONNECTS: 0, pycurl.REDIRECT_URL: None}
+        curl = mock.Mock()
+        curl.getinfo.side_effect = info.get
+        for name in ('NAMELOOKUP_TIME', 'CONNECT_TIME', 'APPCONNECT_TIME', 'STARTTRANSFER_TIME', 'TOTAL_TIME',
+                     'SIZE_DOWNLOAD', 'NUM_CONNECTS', 'REDIRECT_URL'):
+            setattr(curl, name, getattr(pycurl, name))
+        with mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            make_pycurl_request(u'http://a.ru/', 1)
+            curl.perform.side_effect = pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused')
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://a.ru/', 1)
+        stats = source.lib.metrics.get_stats()
+        self.assertEqual(['hop.namelookup', 'hop.size_download', 'hop.starttransfer', 'hop.total'], sorted(stats))
+        self.assertEqual(2, stats['hop.total']['count'])
+        self.assertEqual(4096, stats['hop.size_download']['p50'])
+
+    def test_get_redirect_history_host_timeouts(self):
+        """
+        Hop timeouts come from the host latency, cut by the chain deadline
+        """
+        with mock.patch('source.lib.get_url_timeouts', mock.Mock(return_value=(8, 2))), \
+             mock.patch('source.lib.get_url', mock.Mock(return_value=(None, None, None))) as get_url_mock:
+            get_redirect_history(u'http://a.ru/', timeout=3, connect_timeout=1, deadline=5)
+        _, kwargs = get_url_mock.call_args
+        self.assertTrue(4.9 < kwargs['timeout'] <= 5)
+        self.assertEqual(2, kwargs['connect_timeout'])
+
+    def test_prepare_url_same_as_reference(self):
+        """
+        Memoized prepare_url gives the same values and types as before, also for its own results
+        """
+        for url in get_url_corpus() * 2:
+            expected = prepare_url_reference(url)
+            prepared = prepare_url(url)
+            self.assertEqual((type(expected), expected), (type(prepared), prepared), repr(url))
+            expected = prepare_url_reference(prepared)
+            prepared_again = prepare_url(prepared)
+            self.assertEqual((type(expected), expected), (type(prepared_again), prepared_again), repr(url))
+            if prepared.startswith(('http://', 'https://')):
+                self.assertEqual(prepared, expected, repr(url))
+
+    def test_prepare_url_memoized(self):
+        """
+        Already prepared url and known netloc are not normalized again
+        """
+        self.assertEqual(u'a.ru:80', prepare_url(u'a.ru:80?'))
+        self.assertEqual(u'a.ru%3A80', prepare_url(u'a.ru:80'))
+        prepared = prepare_url(u'http://\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444/a b')
+        with mock.patch('source.lib.urlparse', mock.Mock()) as urlparse_mock:
+            self.assertEqual(prepared, prepare_url(prepared))
+            self.assertEqual(prepared, prepare_url(u'http://\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444/a b'))
+        self.assertFalse(urlparse_mock.called)
+        hits = source.lib.idna_netlocs.get_stats()['hits']
+        self.assertEqual('xn--e1afmkfd.xn--p1ai', source.lib.encode_netloc(u'\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444'))
+        self.assertEqual(hits + 1, source.lib.idna_netlocs.get_stats()['hits'])
+
+    def test_encode_netloc_error_logged(self):
+        """
+        Netloc without IDNA form is kept and logged every time
+        """
+        with mock.patch('source.lib.logger', mock.Mock()) as logger:
+            self.assertEqual(u'a..b', source.lib.encode_netloc(u'a..b'))
+            self.assertEqual(u'a..b', source.lib.encode_netloc(u'a..b'))
+        self.assertEqual(2, logger.error.call_count)
+
     def test_prepare_url_none_url(self):
         """
         Url is None
@@ -326,3 +1003,317 @@ class InitTestCase(unittest.TestCase):
                 mock.patch('source.lib.logger', mock.MagicMock()) as logger:
             prepare_url('url')
             assert logger.error.called
+
+    def test_redirect_chain_ignores_ok_url(self):
+        """
+        ok urls are not checked at all
+        """
+        chain = RedirectChain(u'http://odnoklassniki.ru/group')
+        self.assertTrue(chain.done)
+        self.assertEqual(([], [u'http://odnoklassniki.ru/group'], []), chain.get_result())
+
+    def test_redirect_chain_add_hop(self):
+        """
+        chain follows redirects until the final page
+        """
+        chain = RedirectChain(u'http://a.ru/')
+        self.assertFalse(chain.add_hop(u'http://b.ru/', REDIRECT_HTTP, None))
+        self.assertEqual(u'http://b.ru/', chain.url)
+        self.assertTrue(chain.add_hop(None, None, 'content'))
+        with mock.patch('source.lib.get_counters', mock.Mock(return_value=['YA_METRICA'])) as get_counters:
+            self.assertEqual(([REDIRECT_HTTP], [u'http://a.ru/', u'http://b.ru/'], ['YA_METRICA']),
+                             chain.get_result())
+        get_counters.assert_called_once_with('content')
+
+    def test_redirect_chain_error_stops(self):
+        """
+        ERROR hop finishes the chain
+        """
+        chain = RedirectChain(u'http://a.ru/')
+        self.assertTrue(chain.add_hop(u'http://a.ru/', 'ERROR', None))
+        self.assertEqual((['ERROR'], [u'http://a.ru/', u'http://a.ru/'], []), chain.get_result())
+
+    def test_setup_curl_timeouts(self):
+        """
+        fractional timeouts go in milliseconds, connect timeout is cut to the hop timeout
+        """
+        curl = mock.Mock()
+        setup_curl(curl, u'http://a.ru/', 0.5, None, mock.Mock(), connect_timeout=1)
+        curl.setopt.assert_any_call(curl.TIMEOUT_MS, 500)
+        curl.setopt.assert_any_call(curl.CONNECTTIMEOUT_MS, 500)
+
+        curl = mock.Mock()
+        setup_curl(curl, u'http://a.ru/', 0.0001, None, mock.Mock())
+        curl.setopt.assert_any_call(curl.TIMEOUT_MS, 1)
+        self.assertNotIn(curl.CONNECTTIMEOUT_MS, [c[0][0] for c in curl.setopt.call_args_list])
+
+    def test_redirect_chain_hop_timeout(self):
+        """
+        hops share the chain deadline
+        """
+        with mock.patch('source.lib.time', mock.Mock(return_value=1000)):
+            chain = RedirectChain(u'http://a.ru/', deadline=5)
+            self.assertEqual(3, chain.get_hop_timeout(3))
+        with mock.patch('source.lib.time', mock.Mock(return_value=1003)):
+            self.assertEqual(2, chain.get_hop_timeout(3))
+        with mock.patch('source.lib.time', mock.Mock(return_value=1006)):
+            self.assertEqual(0, chain.get_hop_timeout(3))
+        self.assertEqual(3, RedirectChain(u'http://a.ru/').get_hop_timeout(3))
+
+    def test_redirect_chain_error_after_deadline(self):
+        """
+        ERROR of a hop cut by the deadline is reported as DEADLINE
+        """
+        with mock.patch('source.lib.time', mock.Mock(return_value=1000)):
+            chain = RedirectChain(u'http://a.ru/', deadline=5)
+        with mock.patch('source.lib.time', mock.Mock(return_value=1005)):
+            self.assertTrue(chain.add_hop(u'http://a.ru/', 'ERROR', None))
+        self.assertEqual(([REDIRECT_DEADLINE], [u'http://a.ru/', u'http://a.ru/'], []), chain.get_result())
+        self.assertEqual(source.lib.ERROR_TIMEOUT, chain.get_result().error)
+
+    def test_get_redirect_history_deadline(self):
+        """
+        no request is made when the chain deadline is over
+        """
+        clock = [1000]
+
+        def slow_get_url(**kwargs):
+            clock[0] = 1006
+            return u'http://b.ru/', REDIRECT_HTTP, None
+
+        with mock.patch('source.lib.get_url', mock.Mock(side_effect=slow_get_url)) as get_url_mock, \
+             mock.patch('source.lib.time', mock.Mock(side_effect=lambda: clock[0])):
+            self.assertEqual(([REDIRECT_HTTP, REDIRECT_DEADLINE], [u'http://a.ru/', u'http://b.ru/', u'http://b.ru/'], []),
+                             get_redirect_history(u'http://a.ru/', timeout=3, connect_timeout=1, deadline=5))
+        get_url_mock.assert_called_once_with(url=u'http://a.ru/', timeout=3, user_agent=None,
+                                             max_content_size=source.lib.MAX_CONTENT_SIZE, connect_timeout=1,
+                                             timeout_cut=False)
+
+    def test_multi_resolver_deadline(self):
+        """
+        chain past its deadline is finished without a request
+        """
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)):
+            resolver = MultiRedirectResolver(timeout=1, deadline=5)
+        chain = RedirectChain(u'http://a.ru/')
+        chain.deadline_at = 0
+        resolver._start_hop('tag', chain)
+        self.assertEqual([('tag', ([REDIRECT_DEADLINE], [u'http://a.ru/', u'http://a.ru/'], []))], resolver.perform())
+        self.assertFalse(multi.add_handle.called)
+
+    def test_multi_resolver_ok_url_finished_at_once(self):
+        """
+        chains that need no requests are returned by the next perform
+        """
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'https://my.mail.ru/apps/1', 'tag')
+            self.assertEqual(0, len(resolver))
+            self.assertEqual([('tag', ([], [u'https://my.mail.ru/apps/1'], []))], resolver.perform())
+        self.assertFalse(multi.add_handle.called)
+        self.assertFalse(multi.perform.called)
+
+    def test_multi_resolver_setup_error(self):
+        """
+        bad url fails the chain without touching the multi handle
+        """
+        multi = mock.MagicMock()
+        curl = mock.Mock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)),\
+             mock.patch('source.lib.setup_curl', mock.Mock(side_effect=ValueError('bad url'))):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            self.assertEqual([('tag', (['ERROR'], [u'http://a.ru/', u'http://a.ru/'], []))], resolver.perform())
+        self.assertFalse(multi.add_handle.called)
+        curl.close.assert_called_once_with()
+
+    def test_multi_resolver_follows_redirects(self):
+        """
+        next hop is started as soon as the previous one is done
+        """
+        first_curl, second_curl = mock.Mock(), mock.Mock()
+        first_curl.getinfo.return_value = 'http://b.ru/'
+        second_curl.getinfo.return_value = None
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 1)
+        multi.timeout.return_value = -1
+        multi.info_read.side_effect = [(0, [first_curl], []), (0, [second_curl], [])]
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(side_effect=[first_curl, second_curl])),\
+             mock.patch('source.lib.check_for_meta', mock.Mock(return_value=None)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            self.assertEqual(1, len(resolver))
+            result = resolver.perform(timeout=0.5)
+        self.assertEqual([('tag', ([REDIRECT_HTTP], [u'http://a.ru/', u'http://b.ru/'], []))], result)
+        self.assertEqual([mock.call(first_curl), mock.call(second_curl)], multi.add_handle.call_args_list)
+        multi.select.assert_called_once_with(0.5)
+        self.assertEqual(0, len(resolver))
+
+    def test_multi_resolver_request_error(self):
+        """
+        failed request gives ERROR hop
+        """
+        curl = mock.Mock()
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.return_value = (0, [], [(curl, pycurl.E_OPERATION_TIMEOUTED, 'timeout')])
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag')
+            result = resolver.perform()
+        self.assertEqual([('tag', (['ERROR'], [u'http://a.ru/', u'http://a.ru/'], []))], result)
+        self.assertEqual(source.lib.ERROR_TIMEOUT, result[0][1].error)
+        self.assertFalse(multi.select.called)
+        curl.close.assert_called_once_with()
+
+    def test_multi_resolver_resume(self):
+        """
+        resumed chain starts from the last url passed and keeps the hops before it
+        """
+        curl = mock.Mock()
+        curl.getinfo.return_value = None
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.return_value = (0, [curl], [])
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)),\
+             mock.patch('source.lib.setup_curl', mock.Mock()) as setup_curl,\
+             mock.patch('source.lib.check_for_meta', mock.Mock(return_value=None)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/', 'tag', resume=[[REDIRECT_HTTP], [u'http://a.ru/', u'http://b.ru/']])
+            result = resolver.perform()
+        self.assertEqual(u'http://b.ru/', setup_curl.call_args[0][1])
+        self.assertEqual([('tag', ([REDIRECT_HTTP], [u'http://a.ru/', u'http://b.ru/'], []))], result)
+        self.assertIsNone(result[0][1].error)
+
+    def test_multi_resolver_busy_hosts(self):
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(side_effect=lambda: mock.Mock())):
+            resolver = MultiRedirectResolver(timeout=1)
+            for url in (u'http://a.ru/1', u'http://b.ru/', u'http://a.ru/2'):
+                resolver.add(url)
+        self.assertEqual([(u'http://a.ru', 2), (u'http://b.ru', 1)], resolver.get_busy_hosts())
+        self.assertEqual([(u'http://a.ru', 2)], resolver.get_busy_hosts(1))
+
+    def test_get_error_class(self):
+        self.assertEqual(source.lib.ERROR_DNS, get_error_class(pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, '')))
+        self.assertEqual(source.lib.ERROR_CONNECT, get_error_class(pycurl.error(pycurl.E_COULDNT_CONNECT, '')))
+        self.assertEqual(source.lib.ERROR_UNAVAILABLE, get_error_class(HostUnavailableError('down')))
+        self.assertEqual(source.lib.ERROR_OTHER, get_error_class(ValueError('bad url')))
+
+    def test_multi_resolver_close(self):
+        """
+        close drops unfinished requests
+        """
+        curl = mock.Mock()
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            resolver = MultiRedirectResolver(timeout=1)
+            resolver.add(u'http://a.ru/')
+            resolver.close()
+        multi.remove_handle.assert_called_once_with(curl)
+        curl.close.assert_called_once_with()
+        multi.close.assert_called_once_with()
+        self.assertEqual(0, len(resolver))
+
+    def test_multi_resolver_host_limit(self):
+        """
+        Requests over the host limit wait for a free slot, other hosts are not held back
+        """
+        curls = [mock.Mock(name='curl{}'.format(i)) for i in xrange(4)]
+        for curl in curls:
+            curl.getinfo.return_value = None
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.side_effect = [(0, [curls[0]], []), (0, [], [])]
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(side_effect=curls)),\
+             mock.patch('source.lib.check_for_meta', mock.Mock(return_value=None)):
+            resolver = MultiRedirectResolver(timeout=1, host_limits=[(r'(^|\.)a\.ru$', 1)], default_host_limit=2)
+            resolver.add(u'http://a.ru/1', 1)
+            resolver.add(u'http://www.a.ru/2', 2)
+            resolver.add(u'http://www.a.ru/3', 3)
+            resolver.add(u'http://b.ru/4', 4)
+            self.assertEqual([mock.call(curls[0]), mock.call(curls[1])], multi.add_handle.call_args_list)
+            self.assertEqual((2, 2), (len(resolver), resolver.waiting))
+            self.assertEqual([(1, ([], [u'http://a.ru/1'], []))], resolver.perform())
+            self.assertEqual(mock.call(curls[2]), multi.add_handle.call_args)
+            self.assertEqual((2, 1), (len(resolver), resolver.waiting))
+            self.assertEqual([2, 3, 4], sorted(resolver.close()))
+        self.assertEqual({}, resolver.host_queues)
+
+    def test_multi_resolver_host_limit_cached_hops(self):
+        """
+        Waiting chains that pass the host from the cache do not keep its freed slot, the next ones take it
+        """
+        source.lib.init_hop_cache(64 * 1024, 1024, {REDIRECT_HTTP: 60})
+        curl = mock.Mock()
+        curl.getinfo.return_value = 'http://c.ru/'
+        multi = mock.MagicMock()
+        multi.perform.return_value = (pycurl.E_MULTI_OK, 0)
+        multi.timeout.return_value = 0
+        multi.info_read.return_value = (0, [curl], [])
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)):
+            resolver = MultiRedirectResolver(timeout=1, max_redirects=1, default_host_limit=1)
+            for tag in xrange(4):
+                resolver.add(u'http://a.ru/', tag)
+            finished = []
+            for _ in xrange(4):
+                finished.extend(tag for tag, _ in resolver.perform())
+        self.assertEqual([0, 1, 2, 3], sorted(finished))
+        self.assertEqual((0, 0), (len(resolver), resolver.waiting))
+        self.assertEqual(({}, {}), (resolver.host_requests, resolver.host_queues))
+        # the third and the fourth chains took the hop from the cache
+        self.assertEqual(2, multi.add_handle.call_count)
+
+    def test_multi_resolver_cancel(self):
+        """
+        cancel returns tags of running and waiting chains, resolver stays usable
+        """
+        curls = [mock.Mock(name='curl{}'.format(i)) for i in xrange(3)]
+        multi = mock.MagicMock()
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.Mock(return_value=multi)),\
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(side_effect=curls)):
+            resolver = MultiRedirectResolver(timeout=1, default_host_limit=1)
+            resolver.add(u'http://a.ru/1', 1)
+            resolver.add(u'http://a.ru/2', 2)
+            self.assertEqual([1, 2], sorted(resolver.cancel()))
+            self.assertEqual((0, 0), (len(resolver), resolver.waiting))
+            curls[0].close.assert_called_once_with()
+            resolver.add(u'http://a.ru/3', 3)
+            self.assertEqual(mock.call(curls[1]), multi.add_handle.call_args)
+        self.assertFalse(multi.close.called)
+
+    def test_multi_resolver_get_host_limit(self):
+        """
+        First matching pattern sets the host limit
+        """
+        with mock.patch('source.lib.pycurl.CurlMulti', mock.MagicMock()):
+            resolver = MultiRedirectResolver(timeout=1, host_limits=[(r'(^|\.)bit\.ly$', 4), (r'\.ly$', 2)],
+                                             default_host_limit=8)
+        self.assertEqual((r'(^|\.)bit\.ly$', 4), resolver.get_host_limit(u'http://bit.ly'))
+        self.assertEqual((r'(^|\.)bit\.ly$', 4), resolver.get_host_limit(u'https://www.bit.ly:443'))
+        self.assertEqual((r'\.ly$', 2), resolver.get_host_limit(u'http://notbit.ly'))
+        self.assertEqual(('a.ru', 8), resolver.get_host_limit(u'http://A.ru:8080'))
+
+    def test_get_redirect_histories_keeps_order(self):
+        """
+        results are returned in the order of input urls
+        """
+        resolver = mock.Mock()
+        resolver.perform.side_effect = [[(1, 'second')], [(0, 'first')]]
+        with mock.patch('source.lib.MultiRedirectResolver', mock.Mock(return_value=resolver)):
+            self.assertEqual(['first', 'second'], get_redirect_histories(['a', 'b'], timeout=1))
+        self.assertEqual([mock.call('a', 0), mock.call('b', 1)], resolver.add.call_args_list)
+        resolver.close.assert_called_once_with()
@@ -0,0 +1,46 @@
+import unittest
+
+from source.lib.memo import MemoCache
+
+
+class MemoCacheTestCase(unittest.TestCase):
+    def test_get_set(self):
+        cache = MemoCache(4)
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('default', cache.get('b', 'default'))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 2}, cache.get_stats())
+
+    def test_bounded(self):
+        """
+        cache keeps no more than max_size entries
+        """
+        cache = MemoCache(4)
+        for i in xrange(100):
+            cache.set(i, i)
+            self.assertTrue(len(cache) <= 4)
+        self.assertEqual(99, cache.get(99))
+        self.assertIsNone(cache.get(0))
+
+    def test_used_entries_kept(self):
+        """
+        entry found in the old generation survives the next one
+        """
+        cache = MemoCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('d', 4)
+        cache.set('e', 5)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_clear(self):
+        cache = MemoCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        cache.clear()
+        self.assertEqual(0, len(cache))
@@ -0,0 +1,46 @@
+import time
+import unittest
+
+import mock
+
+from source.lib.network_monitor import NetworkMonitor
+
+
+class NetworkMonitorTestCase(unittest.TestCase):
+    def test_probe_any_url(self):
+        """
+        probe succeeds if any url answers, the rest are not requested
+        """
+        monitor = NetworkMonitor(['a', 'b', 'c'], 1, 10)
+        with mock.patch('source.lib.network_monitor.check_network_status',
+                        mock.Mock(side_effect=[False, True])) as check:
+            self.assertTrue(monitor.probe())
+        self.assertEqual([mock.call('a', 1), mock.call('b', 1)], check.call_args_list)
+
+    def test_hysteresis(self):
+        """
+        state changes only after enough probes in a row
+        """
+        monitor = NetworkMonitor(['a'], 1, 10, down_threshold=3, up_threshold=2)
+        changes = [monitor.update(ok) for ok in (False, False, True, False, False, False, True, False, True, True)]
+        self.assertEqual([False, False, False, False, False, True, False, False, False, True], changes)
+        self.assertTrue(monitor.is_up)
+
+    def test_background_probes(self):
+        """
+        monitor thread reports state changes through on_change
+        """
+        on_change = mock.Mock()
+        monitor = NetworkMonitor(['a'], 1, 0.01, down_threshold=2, up_threshold=1, on_change=on_change)
+        statuses = [True]
+        with mock.patch('source.lib.network_monitor.check_network_status',
+                        mock.Mock(side_effect=lambda url, timeout: statuses and statuses.pop())):
+            monitor.start()
+            self.assertTrue(monitor.is_up)
+            deadline = time.time() + 5
+            while not on_change.called and time.time() < deadline:
+                time.sleep(0.01)
+            monitor.stop()
+        self.assertFalse(monitor.thread.is_alive())
+        on_change.assert_called_with()
+        self.assertFalse(monitor.is_up)
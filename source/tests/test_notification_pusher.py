@@ -1,4 +1,7 @@
+import signal
 import unittest
+
+import gevent
 import mock
 from mock import patch, Mock, MagicMock
 import notification_pusher
@@ -20,6 +23,9 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.SLEEP = 0.1
         config.SLEEP_ON_FAIL = 10
         config.WORKER_POOL_SIZE = 10
+        config.PROFILE_DIR = '/tmp'
+        config.PROFILE_DURATION = 30
+        config.PROFILE_INTERVAL = 0.01
         return config
 
     def test_create_pidfile_example(self):
@@ -226,8 +232,18 @@ class NotificationPusherTestCase(unittest.TestCase):
 
 
     def test_install_signal_handlers(self):
-        with patch('gevent.signal', Mock()):
+        with patch('gevent.signal', Mock()) as gevent_signal:
             notification_pusher.install_signal_handlers()
+        gevent_signal.assert_any_call(signal.SIGUSR2, notification_pusher.profiler.start)
+
+    def test_get_greenlet_name(self):
+        """
+        stacks are labelled with the function run by the greenlet, the gevent hub and the main greenlet by name
+        """
+        self.assertEqual('main', notification_pusher.get_greenlet_name())
+        self.assertEqual('get_greenlet_name', gevent.spawn(notification_pusher.get_greenlet_name).get())
+        with patch('notification_pusher.getcurrent', Mock(return_value=gevent.get_hub())):
+            self.assertEqual('hub', notification_pusher.get_greenlet_name())
 
     @patch('source.notification_pusher.logger.info', Mock())
     @patch('source.notification_pusher.patch_all', Mock())
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from source.profiler import SamplingProfiler
+
+
+def burn(seconds):
+    start = os.times()[0]
+    while os.times()[0] - start < seconds:
+        sum(xrange(1000))
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_profiler(self, **kwargs):
+        profiler = SamplingProfiler('test', self.directory, duration=10, interval=0.005, **kwargs)
+        self.addCleanup(profiler.stop)
+        return profiler
+
+    def test_collapsed_stacks(self):
+        """
+        CPU-bound code is sampled and written as collapsed stacks, root first and the sample count last
+        """
+        profiler = self.make_profiler()
+        self.assertTrue(profiler.start())
+        self.assertFalse(profiler.start())
+        burn(0.2)
+        path = profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertEqual(os.path.join(self.directory, 'test.{}.'.format(os.getpid())),
+                         path[:path.rindex('.', 0, -len('.collapsed')) + 1])
+        with open(path) as f:
+            lines = f.readlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        frames = stack.split(';')
+        self.assertTrue(frames[-1].startswith('burn ('))
+        self.assertTrue(frames[-2].startswith('test_collapsed_stacks ('))
+        self.assertEqual(profiler.samples, sum(int(line.rsplit(' ', 1)[1]) for line in lines))
+
+    def test_task_name(self):
+        profiler = self.make_profiler(get_task_name=lambda: 'worker')
+        profiler.start()
+        burn(0.1)
+        profiler.stop()
+        self.assertTrue(all(line.startswith('worker;') for line in profiler.format_stacks()))
+
+    def test_check_deadline(self):
+        profiler = self.make_profiler()
+        profiler.start(duration=5, now=100)
+        self.assertIsNone(profiler.check(now=104))
+        self.assertTrue(profiler.running)
+        self.assertTrue(profiler.check(now=105).endswith('.collapsed'))
+        self.assertFalse(profiler.running)
+        self.assertIsNone(profiler.check(now=200))
+        self.assertIsNone(profiler.stop())
+
+    def test_unwritable_directory(self):
+        profiler = self.make_profiler()
+        profiler.start()
+        with mock.patch('source.profiler.open', mock.Mock(side_effect=IOError('read-only')), create=True):
+            self.assertIsNone(profiler.stop())
+        self.assertFalse(profiler.running)
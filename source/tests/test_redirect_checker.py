@@ -1,96 +1,297 @@
+import errno
+import signal
+import socket
 import unittest
 import mock
+from tarantool.error import DatabaseError
+from source.lib.autoscaler import Autoscaler
+from source.lib.control import ControlError
 from source.lib.utils import Config
 from source import redirect_checker
 
-class TestChildren:
-    child = mock.Mock()
-
-    def __init__(self, length):
-        self.children = [self.child] * length
+class FakePool(object):
+    def __init__(self, size=0):
+        self.size = size
+        self.spawned = []
+        self.drained = 0
+        self.paused = False
+        self.pauses = []
+        self.in_flight = 0
+        self.waits = []
+        self.watched = None
 
     def __len__(self):
-        return len(self.children)
+        return self.size
+
+    def install_signal_handlers(self):
+        pass
+
+    def spawn(self, num, parent_pid):
+        self.spawned.append((num, parent_pid))
+        self.size += num
+
+    def drain(self, num=None):
+        self.drained += 1
+        self.size = 0 if num is None else self.size - num
+
+    def get_stats(self):
+        return {'in_flight': self.in_flight}
 
-    def __call__(self):
-        return self.children
+    def pause(self):
+        self.pauses.append('pause')
+        self.paused = True
 
-    def __iter__(self):
-        return iter(self.children)
+    def resume(self):
+        self.pauses.append('resume')
+        self.paused = False
 
+    def wake_up(self):
+        pass
 
-def stop_loop(self):
-            redirect_checker.run_checker = False
+    def watch(self, fileobj, callback):
+        self.watched = (fileobj, callback)
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        redirect_checker.run_checker = False
+
+    def close(self):
+        pass
 
 
 class RedirectCheckerTestCase(unittest.TestCase):
+    def run_main_loop(self, pool, network_status=True, pool_size=50, fork_server=None, max_pool_size=None,
+                      tube_stats=None, min_pool_size=None, control_socket=None):
+        config = Config()
+        config.SLEEP = 8
+        config.CHECK_URLS = ('url', 'other_url')
+        config.NETWORK_DOWN_THRESHOLD = 3
+        config.NETWORK_UP_THRESHOLD = 2
+        config.HTTP_TIMEOUT = 1
+        config.WORKER_POOL_SIZE = pool_size
+        config.WORKER_POOL_MIN_SIZE = min_pool_size or pool_size
+        config.WORKER_POOL_MAX_SIZE = max_pool_size or pool_size
+        config.MAX_TASKS_IN_FLIGHT = 10
+        config.AUTOSCALE_INTERVAL = 0
+        config.AUTOSCALE_TARGET_UTILIZATION = 0.5
+        config.AUTOSCALE_DOWN_MARGIN = 0.3
+        config.AUTOSCALE_COOLDOWN = 120
+        config.INPUT_QUEUE_HOST = 'localhost'
+        config.INPUT_QUEUE_PORT = 33013
+        config.INPUT_QUEUE_SPACE = 0
+        config.INPUT_QUEUE_TUBE = 'url.queue'
+        config.WORKER_HEARTBEAT_TIMEOUT = 60
+        config.WORKER_DRAIN_TIMEOUT = 60
+        config.WORKER_FORK_SERVER = fork_server is not None
+        config.CONTROL_SOCKET = control_socket
+        self.addCleanup(setattr, redirect_checker, 'run_checker', True)
+        self.monitor = mock.Mock(is_up=network_status)
+        with mock.patch('source.redirect_checker.NetworkMonitor', mock.Mock(return_value=self.monitor)) as monitor,\
+             mock.patch('os.getpid', mock.Mock(return_value=42)),\
+             mock.patch('source.redirect_checker.ForkServer', mock.Mock(return_value=fork_server)),\
+             mock.patch('source.redirect_checker.get_tube', mock.Mock(return_value='tube')),\
+             mock.patch('source.redirect_checker.get_tube_stats', mock.Mock(return_value=tube_stats)) as get_stats,\
+             mock.patch('source.redirect_checker.WorkerPool', mock.Mock(return_value=pool)) as pool_class:
+            redirect_checker.main_loop(config)
+        pool_class.assert_called_once_with(redirect_checker.run_worker, (config,), 60, 60, fork_server)
+        monitor.assert_called_once_with(('url', 'other_url'), 1, 8, 3, 2, on_change=pool.wake_up)
+        self.monitor.start.assert_called_once_with()
+        self.monitor.stop.assert_called_once_with()
+        if max_pool_size is None:
+            self.assertFalse(get_stats.called)
+        return config
+
     def test_main_loop_dfs(self):
         """
-        try to go deeper
+        missing workers are spawned, then the pool waits for workers or the network monitor
         """
-        pid = 42
-        config = Config()
-        config.SLEEP = 1
-        config.CHECK_URL = 'url'
-        config.HTTP_TIMEOUT = 1
-        config.WORKER_POOL_SIZE = 50
-        mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=True)
-
-        children = TestChildren(1)
-        count = config.WORKER_POOL_SIZE - len(children())
-        mock_sleep = mock.Mock(side_effect=stop_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
-             mock.patch('os.getpid', mock.Mock(return_value=pid)),\
-             mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
-             mock.patch('source.redirect_checker.active_children', children),\
-             mock.patch('source.redirect_checker.sleep', mock_sleep):
-                            redirect_checker.main_loop(config)
-        assert mock_spawn_workers.call_args[1]['num'] == count
-        assert mock_spawn_workers.call_args[1]['parent_pid'] == pid
-        redirect_checker.run_checker = True
+        pool = FakePool(1)
+        config = self.run_main_loop(pool)
+        self.assertEqual([(config.WORKER_POOL_SIZE - 1, 42)], pool.spawned)
+        self.assertEqual(1, len(pool.waits))
+        self.assertLessEqual(pool.waits[0], 0)
+        self.assertEqual([], pool.pauses)
+
+    def test_run_worker(self):
+        """
+        pool workers get the sampling profiler, the lib package does not import it
+        """
+        with mock.patch('source.redirect_checker.worker', mock.Mock()) as worker:
+            redirect_checker.run_worker('config', 42, 'channel')
+        worker.assert_called_once_with('config', 42, 'channel', redirect_checker.SamplingProfiler)
 
     def test_main_loop_no_workers(self):
-        pid = 42
-        config = Config()
-        config.SLEEP = 8
-        config.CHECK_URL = 'url'
-        config.HTTP_TIMEOUT = 1
-        config.WORKER_POOL_SIZE = 2
-        active_children = TestChildren(2)
-        mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=True)
-        mock_sleep = mock.Mock(side_effect=stop_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
-             mock.patch('os.getpid', mock.Mock(return_value=pid)),\
-             mock.patch('source.redirect_checker.active_children', active_children),\
-             mock.patch('source.redirect_checker.spawn_workers', mock_spawn_workers),\
-             mock.patch('source.redirect_checker.sleep', mock_sleep):
-            redirect_checker.main_loop(config)
-            self.assertEqual(mock_spawn_workers.call_count, 0)
-            mock_sleep.assert_called_once_with(config.SLEEP)
-            redirect_checker.run_checker = True
+        """
+        full pool spawns nothing
+        """
+        pool = FakePool(2)
+        self.run_main_loop(pool, pool_size=2)
+        self.assertEqual([], pool.spawned)
 
     def test_main_loop_network_status_is_not_fine(self):
-        pid = 42
+        """
+        workers are paused instead of terminated when the network is down
+        """
+        pool = FakePool(2)
+        self.run_main_loop(pool, network_status=False, pool_size=2)
+        self.assertEqual([], pool.spawned)
+        self.assertEqual(['pause'], pool.pauses)
+        self.assertEqual(0, pool.drained)
+
+    def test_main_loop_network_is_back(self):
+        """
+        paused workers are resumed once the monitor sees the network again
+        """
+        pool = FakePool(2)
+        wakeups = [lambda: setattr(self.monitor, 'is_up', True),
+                   lambda: None,
+                   lambda: setattr(redirect_checker, 'run_checker', False)]
+        pool.wait = lambda timeout: wakeups.pop(0)()
+        self.run_main_loop(pool, network_status=False, pool_size=2)
+        self.assertEqual(['pause', 'resume'], pool.pauses)
+        self.assertEqual([], pool.spawned)
+
+    def test_main_loop_scales_up(self):
+        """
+        busy workers with a backlog get more workers, up to the maximum size
+        """
+        pool = FakePool(2)
+        pool.in_flight = 20
+        self.run_main_loop(pool, pool_size=2, max_pool_size=6, tube_stats={'ready': 100, 'taken': 20})
+        self.assertEqual([(4, 42)], pool.spawned)
+
+    def test_main_loop_scales_down(self):
+        """
+        idle workers over the needed size are drained
+        """
+        pool = FakePool(6)
+        self.run_main_loop(pool, pool_size=6, min_pool_size=2, max_pool_size=10, tube_stats={'ready': 0, 'taken': 5})
+        self.assertEqual(1, pool.drained)
+        self.assertEqual(2, len(pool))
+
+    def test_scale_pool_without_stats(self):
+        """
+        pool size is kept when the queue does not answer
+        """
+        autoscaler = mock.Mock(size=3)
+        with mock.patch('source.redirect_checker.get_tube_stats',
+                        mock.Mock(side_effect=DatabaseError('no queue'))):
+            redirect_checker.scale_pool(autoscaler, 'tube', FakePool(3))
+        self.assertFalse(autoscaler.update.called)
+
+    def test_main_loop_fork_server(self):
+        """
+        workers are forked by the fork server, which is stopped with the loop
+        """
+        pool = FakePool(2)
+        fork_server = mock.Mock()
+        self.run_main_loop(pool, pool_size=2, fork_server=fork_server)
+        fork_server.start.assert_called_once_with()
+        fork_server.stop.assert_called_once_with()
+
+    def test_main_loop_respawns_on_wakeup(self):
+        """
+        a worker that exits is replaced as soon as the pool wakes up
+        """
+        pool = FakePool(2)
+        wakeups = [lambda: setattr(pool, 'size', 1), lambda: setattr(redirect_checker, 'run_checker', False)]
+        pool.wait = lambda timeout: wakeups.pop(0)()
+        self.run_main_loop(pool, pool_size=2)
+        self.assertEqual([(1, 42)], pool.spawned)
+
+    def test_main_loop_control_commands(self):
+        """
+        control commands run inside wait, the loop applies a pause and a pinned pool size at once
+        """
+        pool = FakePool(2)
+        server = mock.Mock()
+        steps = [lambda commands: commands['pause'](),
+                 lambda commands: commands['resize']('4'),
+                 lambda commands: commands['resume'](),
+                 lambda commands: setattr(redirect_checker, 'run_checker', False)]
+        with mock.patch('source.redirect_checker.ControlServer', mock.Mock(return_value=server)) as server_class:
+            pool.wait = lambda timeout: steps.pop(0)(server_class.call_args[0][1])
+            self.run_main_loop(pool, pool_size=2, control_socket='/tmp/checker.sock')
+        self.assertEqual('/tmp/checker.sock', server_class.call_args[0][0])
+        server.start.assert_called_once_with()
+        self.assertEqual((server, server.handle), pool.watched)
+        server.close.assert_called_once_with()
+        self.assertEqual(['pause', 'resume'], pool.pauses)
+        self.assertEqual([(2, 42)], pool.spawned)
+
+    def test_main_loop_control_socket_in_use(self):
+        """
+        the checker runs without control socket if another process listens on it
+        """
+        pool = FakePool(2)
+        pool.wait = lambda timeout: setattr(redirect_checker, 'run_checker', False)
+        server = mock.Mock()
+        server.start.side_effect = socket.error(errno.EADDRINUSE, 'in use')
+        with mock.patch('source.redirect_checker.ControlServer', mock.Mock(return_value=server)):
+            self.run_main_loop(pool, pool_size=2, control_socket='/tmp/checker.sock')
+        self.assertIsNone(pool.watched)
+        self.assertFalse(server.close.called)
+
+    def make_control(self):
         config = Config()
-        config.SLEEP = 8
-        config.CHECK_URL = 'url'
-        config.HTTP_TIMEOUT = 1
-        config.WORKER_POOL_SIZE = 2
-        mock_spawn_workers = mock.Mock()
-        mock_check_network_status = mock.Mock(return_value=False)
-        test_active_children = mock.Mock()
-        mock_sleep = mock.Mock(side_effect=stop_loop)
-        with mock.patch('source.redirect_checker.check_network_status', mock_check_network_status),\
-             mock.patch('os.getpid', mock.Mock(return_value=pid)),\
-             mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=[test_active_children])),\
-             mock.patch('source.redirect_checker.sleep', mock_sleep):
-            redirect_checker.main_loop(config)
-            self.assertEqual(mock_spawn_workers.call_count, 0)
-            test_active_children.terminate.assert_called_once()
-            mock_sleep.assert_called_once_with(config.SLEEP)
-            redirect_checker.run_checker = True
+        config.WORKER_POOL_MIN_SIZE = 2
+        config.WORKER_POOL_MAX_SIZE = 10
+        config.lowercase = 'skipped'
+        pool = mock.Mock()
+        return redirect_checker.CheckerControl(config, pool, Autoscaler(2, 10, 10, 4), mock.Mock(is_up=True))
+
+    def test_control_resize(self):
+        """
+        resize pins the pool size, resize auto gives the size back to the autoscaler
+        """
+        control = self.make_control()
+        control.resize('20')
+        self.assertEqual((20, 20, 20, False), (control.autoscaler.size, control.autoscaler.min_size,
+                                               control.autoscaler.max_size, control.autoscaler.enabled))
+        control.resize('auto')
+        self.assertEqual((10, 2, 10, True), (control.autoscaler.size, control.autoscaler.min_size,
+                                             control.autoscaler.max_size, control.autoscaler.enabled))
+        self.assertRaises(ControlError, control.resize, 'many')
+        self.assertRaises(ControlError, control.resize, '0')
+
+    def test_control_status_and_config(self):
+        control = self.make_control()
+        control.pool.get_stats.return_value = {'workers': 4}
+        control.pool.get_rates.return_value = {'tasks': 1.5, 'errors': 0.0}
+        control.pool.get_workers.return_value = [{'pid': 1, 'state': 'idle'}]
+        status = control.status()
+        self.assertEqual({'workers': 4}, status['pool'])
+        self.assertEqual({'tasks': 1.5, 'errors': 0.0}, status['rates'])
+        self.assertEqual([{'pid': 1, 'state': 'idle'}], status['workers'])
+        self.assertEqual((4, 2, 10), (status['autoscaler']['size'], status['autoscaler']['min_size'],
+                                      status['autoscaler']['max_size']))
+        self.assertEqual({'WORKER_POOL_MIN_SIZE': 2, 'WORKER_POOL_MAX_SIZE': 10}, control.get_config())
+
+    def test_control_flush(self):
+        control = self.make_control()
+        with mock.patch('source.redirect_checker.clear_hop_caches', mock.Mock()) as clear_hop_caches:
+            control.flush()
+        clear_hop_caches.assert_called_once_with()
+        control.pool.flush.assert_called_once_with()
+
+    def test_control_profile(self):
+        """
+        profile starts the main process profiler and asks the workers for theirs
+        """
+        control = self.make_control()
+        control.config.PROFILE_DURATION = 30
+        control.config.PROFILE_DIR = '/tmp'
+        control.pool.__len__ = mock.Mock(return_value=4)
+        profiler = mock.Mock()
+        profiler.start.side_effect = [True, True, False]
+        with mock.patch('source.redirect_checker.profiler', profiler):
+            self.assertEqual({'duration': 30, 'directory': '/tmp', 'workers': 4}, control.profile())
+            self.assertEqual(2.5, control.profile('2.5')['duration'])
+            self.assertRaises(ControlError, control.profile)
+            self.assertRaises(ControlError, control.profile, 'long')
+            self.assertRaises(ControlError, control.profile, '0')
+        self.assertEqual([mock.call(30), mock.call(2.5), mock.call(30)], profiler.start.call_args_list)
+        self.assertEqual([mock.call(30), mock.call(2.5)], control.pool.profile.call_args_list)
 
     def test_main_daemon_pidfile(self):
         """
@@ -100,6 +301,28 @@ class RedirectCheckerTestCase(unittest.TestCase):
         config = Config()
         config.LOGGING = mock.Mock()
         config.EXIT_CODE = 0
+        config.HOP_CACHE_SIZE = 0
+        config.HOP_CACHE_SLOT_SIZE = 1024
+        config.HOP_CACHE_TTL = {}
+        config.SUFFIX_CACHE_SIZE = 0
+        config.SUFFIX_CACHE_SLOT_SIZE = 4096
+        config.SUFFIX_CACHE_TTL = 0
+        config.STATE_DIR = '/state'
+        config.SUFFIX_CACHE_PATH = None
+        config.HOST_BREAKER_SIZE = 0
+        config.HOST_BREAKER_THRESHOLD = 5
+        config.HOST_BREAKER_COOL_DOWN = 60
+        config.HOST_BREAKER_MAX_COOL_DOWN = 900
+        config.HOST_LATENCY_SIZE = 0
+        config.HOST_LATENCY_PATH = None
+        config.HOST_LATENCY_PERCENTILE = 0.99
+        config.HOST_LATENCY_MARGIN = 2
+        config.HOST_LATENCY_MIN_SAMPLES = 20
+        config.HOST_TIMEOUT_BOUNDS = (0.5, 10)
+        config.HOST_CONNECT_TIMEOUT_BOUNDS = (0.2, 3)
+        config.PROFILE_DIR = '/tmp'
+        config.PROFILE_DURATION = 30
+        config.PROFILE_INTERVAL = 0.01
         with mock.patch('source.redirect_checker.daemonize', mock.Mock()) as daemonize:
             with mock.patch('source.redirect_checker.parse_cmd_args', mock.Mock()):
                 with mock.patch('source.redirect_checker.dictConfig', mock.Mock()):
@@ -110,10 +333,12 @@ class RedirectCheckerTestCase(unittest.TestCase):
                                         mock.Mock()):
                                 with mock.patch('source.redirect_checker.os.path.expanduser',
                                         mock.Mock()):
-                                    with mock.patch('source.redirect_checker.create_pidfile', mock.Mock()) as create_pid:
+                                    with mock.patch('source.redirect_checker.create_pidfile', mock.Mock()) as create_pid,\
+                                         mock.patch('source.redirect_checker.create_private_dir', mock.Mock()) as mkdir:
                                         daemonize.assert_called()
                                         create_pid.assert_called()
                                         self.assertEqual(config.EXIT_CODE, redirect_checker.main(args))
+                                        mkdir.assert_called_once_with('/state')
 
     def test_main_no_daemon_no_pidfile(self):
         """
@@ -125,6 +350,28 @@ class RedirectCheckerTestCase(unittest.TestCase):
         config = Config()
         config.LOGGING = mock.Mock()
         config.EXIT_CODE = 0
+        config.HOP_CACHE_SIZE = 0
+        config.HOP_CACHE_SLOT_SIZE = 1024
+        config.HOP_CACHE_TTL = {}
+        config.SUFFIX_CACHE_SIZE = 0
+        config.SUFFIX_CACHE_SLOT_SIZE = 4096
+        config.SUFFIX_CACHE_TTL = 0
+        config.STATE_DIR = None
+        config.SUFFIX_CACHE_PATH = None
+        config.HOST_BREAKER_SIZE = 0
+        config.HOST_BREAKER_THRESHOLD = 5
+        config.HOST_BREAKER_COOL_DOWN = 60
+        config.HOST_BREAKER_MAX_COOL_DOWN = 900
+        config.HOST_LATENCY_SIZE = 0
+        config.HOST_LATENCY_PATH = None
+        config.HOST_LATENCY_PERCENTILE = 0.99
+        config.HOST_LATENCY_MARGIN = 2
+        config.HOST_LATENCY_MIN_SAMPLES = 20
+        config.HOST_TIMEOUT_BOUNDS = (0.5, 10)
+        config.HOST_CONNECT_TIMEOUT_BOUNDS = (0.2, 3)
+        config.PROFILE_DIR = '/tmp'
+        config.PROFILE_DURATION = 30
+        config.PROFILE_INTERVAL = 0.01
         with mock.patch('source.redirect_checker.parse_cmd_args', mock.MagicMock(return_value=args)):
             with mock.patch('source.redirect_checker.daemonize', mock.Mock()) as daemonize:
                 with mock.patch('source.redirect_checker.dictConfig', mock.Mock()):
@@ -138,4 +385,14 @@ class RedirectCheckerTestCase(unittest.TestCase):
                                     with mock.patch('source.redirect_checker.create_pidfile', mock.Mock()) as create_pid:
                                         self.assertFalse(daemonize.called)
                                         self.assertFalse(create_pid.called)
-                                        self.assertEqual(config.EXIT_CODE, redirect_checker.main(args))
\ No newline at end of file
+                                        self.assertEqual(config.EXIT_CODE, redirect_checker.main(args))
+
+    def test_reload_workers(self):
+        """
+        SIGHUP is passed to every worker
+        """
+        children = [mock.Mock(pid=1), mock.Mock(pid=2)]
+        with mock.patch('source.redirect_checker.active_children', mock.Mock(return_value=children)),\
+             mock.patch('source.redirect_checker.os.kill', mock.Mock()) as kill:
+            redirect_checker.reload_workers(signal.SIGHUP, None)
+        self.assertEqual([mock.call(1, signal.SIGHUP), mock.call(2, signal.SIGHUP)], kill.call_args_list)
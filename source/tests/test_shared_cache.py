@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from source.lib import shared_cache
+from source.lib.shared_cache import SharedCache
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def test_set_get(self):
+        """
+        stored value is returned until it expires
+        """
+        cache = SharedCache(64 * 1024, 256)
+        cache.set('key', (u'http://a.ru/', 'http_status', []), 10, now=100)
+        self.assertEqual((u'http://a.ru/', 'http_status', []), cache.get('key', now=105))
+        self.assertIsNone(cache.get('key', now=110))
+        self.assertIsNone(cache.get('other', now=105))
+        self.assertEqual({'size': 64 * 1024, 'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3.0, 'skipped': 0},
+                         cache.get_stats())
+
+    def test_disabled(self):
+        """
+        zero size cache stores nothing
+        """
+        cache = SharedCache()
+        cache.set('key', 'value', 10)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(0, cache.get_stats()['size'])
+
+    def test_clear(self):
+        cache = SharedCache(64 * 1024, 256)
+        cache.set('key', 'value', 10, now=100)
+        cache.clear()
+        self.assertIsNone(cache.get('key', now=100))
+        cache.set('key', 'value', 10, now=100)
+        self.assertEqual('value', cache.get('key', now=100))
+        SharedCache().clear()
+
+    def test_too_big_value_skipped(self):
+        """
+        values longer than a slot are not cached
+        """
+        cache = SharedCache(64 * 1024, 256)
+        cache.set('key', 'x' * 256, 10)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(1, cache.get_stats()['skipped'])
+
+    def test_lru_eviction(self):
+        """
+        full set evicts the least recently used slot
+        """
+        cache = SharedCache(256 * shared_cache.WAYS, 256)
+        keys = ['key{}'.format(i) for i in xrange(shared_cache.WAYS)]
+        for now, key in enumerate(keys):
+            cache.set(key, key, 100, now=now)
+        cache.get(keys[0], now=50)
+        cache.set('new', 'new', 100, now=51)
+        self.assertEqual('new', cache.get('new', now=52))
+        self.assertEqual(keys[0], cache.get(keys[0], now=52))
+        self.assertIsNone(cache.get(keys[1], now=52))
+
+    def test_overwrite(self):
+        """
+        same key reuses its slot
+        """
+        cache = SharedCache(256 * shared_cache.WAYS, 256)
+        for i in xrange(shared_cache.WAYS + 1):
+            cache.set('key', i, 100, now=i)
+        cache.set('other', 'other', 100, now=20)
+        self.assertEqual(shared_cache.WAYS, cache.get('key', now=21))
+        self.assertEqual('other', cache.get('other', now=21))
+
+    def test_corrupted_slot_is_miss(self):
+        """
+        torn or broken slot fails crc check
+        """
+        cache = SharedCache(256 * shared_cache.WAYS, 256)
+        cache.set('key', 'value', 100, now=0)
+        data = cache.memory[:]
+        offset = data.index('value')
+        cache.memory[offset:offset + 1] = 'V'
+        self.assertIsNone(cache.get('key', now=1))
+
+    def test_shared_with_child_process(self):
+        """
+        value stored by a forked child is seen by the parent
+        """
+        cache = SharedCache(64 * 1024, 256)
+        pid = os.fork()
+        if not pid:
+            cache.set('key', 'from child', 100)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual('from child', cache.get('key'))
+
+    def test_file_survives_reopen(self):
+        """
+        file backed cache keeps entries for the next process
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'cache')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        SharedCache(64 * 1024, 256, path).set('key', [u'http://a.ru/'], 100)
+        self.assertEqual([u'http://a.ru/'], SharedCache(64 * 1024, 256, path).get('key'))
+        self.assertIsNone(SharedCache(128 * 1024, 256, path).get('key'))
+        self.assertEqual(128 * 1024, os.path.getsize(path))
+        self.assertEqual(0600, os.stat(path).st_mode & 0777)
+
+    def test_planted_file_rejected(self):
+        """
+        symlinks, files of other users and files writable by others are not mapped
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        target = os.path.join(directory, 'target')
+        with open(target, 'w') as f:
+            f.write('data')
+        link = os.path.join(directory, 'link')
+        os.symlink(target, link)
+        self.assertRaises(OSError, SharedCache, 64 * 1024, 256, link)
+        self.assertEqual('data', open(target).read())
+        with mock.patch('source.lib.shared_cache.os.getuid', mock.Mock(return_value=os.getuid() + 1)):
+            self.assertRaises(OSError, SharedCache, 64 * 1024, 256, target)
+        os.chmod(target, 0666)
+        self.assertRaises(OSError, SharedCache, 64 * 1024, 256, target)
+        self.assertEqual(4, os.path.getsize(target))
@@ -0,0 +1,238 @@
+import os
+import signal
+import time
+import unittest
+
+import mock
+
+from source.lib import supervisor
+from source.lib.supervisor import WorkerPool, DRAIN, HEARTBEAT, PAUSE, RESUME, FLUSH, PROFILE
+
+
+def heartbeat_worker(parent_pid, channel=None):
+    """Sends heartbeats until drained"""
+    while DRAIN not in supervisor.heartbeat(channel, 0):
+        time.sleep(0.01)
+
+
+def exiting_worker(parent_pid, channel=None):
+    pass
+
+
+def silent_worker(parent_pid, channel=None):
+    time.sleep(30)
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def make_pool(self, target, heartbeat_timeout=10, drain_timeout=10):
+        pool = WorkerPool(target, (), heartbeat_timeout, drain_timeout)
+        pool.install_signal_handlers()
+        self.addCleanup(signal.signal, signal.SIGCHLD, signal.SIG_DFL)
+        self.addCleanup(pool.close)
+        self.addCleanup(self.kill_all, pool)
+        return pool
+
+    @staticmethod
+    def kill_all(pool):
+        for pid in pool.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for state in pool.workers.values():
+            state.process.join()
+
+    def wait_for(self, pool, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            pool.wait(0.05)
+        self.assertTrue(condition())
+
+    def test_exited_worker_is_reaped_at_once(self):
+        """
+        SIGCHLD wakes the pool up, no need to wait for the timeout
+        """
+        pool = self.make_pool(exiting_worker)
+        pool.spawn(2, os.getpid())
+        started = time.time()
+        self.wait_for(pool, lambda: not pool.workers)
+        self.assertLess(time.time() - started, 1)
+
+    def test_heartbeats_and_drain(self):
+        """
+        heartbeats keep workers alive, drain makes them exit
+        """
+        pool = self.make_pool(heartbeat_worker)
+        pool.spawn(2, os.getpid())
+        self.assertEqual(2, len(pool))
+        pool.wait(0.2)
+        self.assertEqual(2, len(pool.workers))
+        pool.drain()
+        self.assertEqual(0, len(pool))
+        self.wait_for(pool, lambda: not pool.workers)
+        self.assertEqual(0, pool.killed)
+
+    def test_silent_worker_is_killed(self):
+        """
+        worker without heartbeats is killed after heartbeat_timeout
+        """
+        pool = self.make_pool(silent_worker, heartbeat_timeout=0.1)
+        pool.spawn(1, os.getpid())
+        self.wait_for(pool, lambda: not pool.workers)
+        self.assertEqual(1, pool.killed)
+        self.assertEqual({'workers': 0, 'draining': 0, 'in_flight': 0, 'killed': 1, 'recycled': 0, 'paused': False}, pool.get_stats())
+
+    def test_pause_and_resume(self):
+        """
+        pause and resume are sent to running workers, workers spawned during a pause start paused
+        """
+        pool = self.make_pool(exiting_worker)
+        channels = [mock.Mock(), mock.Mock(), mock.Mock()]
+        processes = [mock.Mock(pid=pid) for pid in (1, 2, 3)]
+        with mock.patch('source.lib.supervisor.spawn_workers',
+                        mock.Mock(side_effect=[zip(processes[:2], channels[:2]), [(processes[2], channels[2])]])):
+            pool.spawn(2, os.getpid())
+            pool.workers[2].drain_deadline = time.time()
+            pool.pause()
+            pool.spawn(1, os.getpid())
+            pool.resume()
+        self.assertEqual([mock.call(PAUSE), mock.call(RESUME)], channels[0].send.call_args_list)
+        self.assertFalse(channels[1].send.called)
+        self.assertEqual([mock.call(PAUSE), mock.call(RESUME)], channels[2].send.call_args_list)
+        self.assertFalse(pool.paused)
+        pool.workers.clear()
+
+    def test_drain_least_busy(self):
+        """
+        shrinking the pool drains the workers with the fewest tasks in flight
+        """
+        pool = self.make_pool(exiting_worker)
+        for pid, in_flight in ((1, 5), (2, 0), (3, 2)):
+            pool.workers[pid] = supervisor.WorkerState(mock.Mock(pid=pid), mock.Mock(), 0)
+            pool.workers[pid].in_flight = in_flight
+        pool.drain(2)
+        self.assertEqual([1], [pid for pid, state in pool.workers.items() if state.drain_deadline is None])
+        pool.workers[2].channel.send.assert_called_once_with(DRAIN)
+        pool.workers.clear()
+
+    def test_wake_up(self):
+        """
+        wake_up interrupts wait at once
+        """
+        pool = self.make_pool(exiting_worker)
+        pool.wake_up()
+        started = time.time()
+        pool.wait(5)
+        self.assertLess(time.time() - started, 1)
+
+    def test_worker_drains_itself(self):
+        """
+        worker that is going to exit on its own frees its place in the pool at once
+        """
+        pool = self.make_pool(exiting_worker)
+        channel = mock.Mock()
+        channel.poll.side_effect = [True, False]
+        channel.recv.return_value = (HEARTBEAT, 1, 2, True)
+        pool.workers[1] = state = supervisor.WorkerState(mock.Mock(pid=1), channel, 0)
+        self.assertEqual(1, len(pool))
+        pool._read_messages(state, 100)
+        self.assertEqual(0, len(pool))
+        self.assertEqual((2, 100 + pool.drain_timeout, 1), (state.in_flight, state.drain_deadline, pool.recycled))
+        pool.workers.clear()
+
+    def test_worker_status_and_rates(self):
+        """
+        heartbeat status is kept per worker, task counters add up into the pool rates
+        """
+        pool = self.make_pool(exiting_worker)
+        channel = mock.Mock()
+        pool.workers[1] = state = supervisor.WorkerState(mock.Mock(pid=1), channel, 0)
+        for now, tasks, errors in ((100, 10, 1), (101, 30, 2), (110, 100, 10)):
+            channel.poll.side_effect = [True, False]
+            channel.recv.return_value = (HEARTBEAT, 1, 4, False, {'state': 'fetching', 'hosts': [('http://a.ru', 3)],
+                                                                  'tasks': tasks, 'errors': errors})
+            pool._read_messages(state, now)
+            pool._sample(now)
+        self.assertEqual({'tasks': 9.0, 'errors': 0.9}, pool.get_rates())
+        self.assertEqual([{'pid': 1, 'state': 'fetching', 'hosts': [('http://a.ru', 3)], 'tasks': 100, 'errors': 10,
+                           'in_flight': 4, 'draining': False, 'last_seen': 2}], pool.get_workers(now=112))
+        # old samples leave the window
+        pool._sample(110 + supervisor.RATE_WINDOW + 1)
+        self.assertEqual({'tasks': 0.0, 'errors': 0.0}, pool.get_rates())
+        pool.workers.clear()
+
+    def test_flush(self):
+        pool = self.make_pool(exiting_worker)
+        pool.workers[1] = supervisor.WorkerState(mock.Mock(pid=1), mock.Mock(), 0)
+        pool.flush()
+        pool.workers[1].channel.send.assert_called_once_with(FLUSH)
+        pool.workers.clear()
+
+    def test_profile(self):
+        pool = self.make_pool(exiting_worker)
+        pool.workers[1] = supervisor.WorkerState(mock.Mock(pid=1), mock.Mock(), 0)
+        pool.profile(10)
+        pool.workers[1].channel.send.assert_called_once_with((PROFILE, 10))
+        pool.workers.clear()
+
+    def test_watch(self):
+        """
+        watched file objects are served by wait
+        """
+        pool = self.make_pool(exiting_worker)
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        fileobj = mock.Mock()
+        fileobj.fileno.return_value = read_fd
+        callback = mock.Mock(side_effect=lambda: os.read(read_fd, 1))
+        pool.watch(fileobj, callback)
+        pool.wait(0)
+        self.assertFalse(callback.called)
+        os.write(write_fd, 'x')
+        pool.wait(5)
+        callback.assert_called_once_with()
+
+    def test_get_private_rss(self):
+        self.assertGreater(supervisor.get_private_rss(), 0)
+        with mock.patch('__builtin__.open', mock.Mock(side_effect=IOError)):
+            self.assertEqual(0, supervisor.get_private_rss())
+
+    def test_heartbeat_without_parent(self):
+        """
+        closed channel means the parent is gone
+        """
+        channel = mock.Mock()
+        channel.send.side_effect = IOError(32, 'Broken pipe')
+        self.assertEqual([DRAIN], supervisor.heartbeat(channel, 1))
+        self.assertEqual([], supervisor.heartbeat(None, 1))
+
+    def test_heartbeat_reads_commands(self):
+        channel = mock.Mock()
+        channel.poll.side_effect = [True, False]
+        channel.recv.return_value = DRAIN
+        self.assertEqual([DRAIN], supervisor.heartbeat(channel, 3))
+        channel.send.assert_called_once_with((HEARTBEAT, os.getpid(), 3, False, {}))
+
+    def test_heartbeat_waits_for_commands(self):
+        """
+        paused worker sleeps on the channel until a command comes or the timeout expires
+        """
+        channel = mock.Mock()
+        channel.poll.side_effect = [True, True, False]
+        channel.recv.return_value = RESUME
+        self.assertEqual([RESUME], supervisor.heartbeat(channel, 0, 1.5))
+        self.assertEqual(mock.call(1.5), channel.poll.call_args_list[0])
+
+    def test_init_worker_process(self):
+        """
+        parent death signal is requested from the kernel
+        """
+        libc = mock.Mock()
+        libc.prctl.return_value = 0
+        with mock.patch('source.lib.supervisor.get_libc', mock.Mock(return_value=libc)),\
+             mock.patch('source.lib.supervisor.signal.signal', mock.Mock()),\
+             mock.patch('source.lib.supervisor.signal.set_wakeup_fd', mock.Mock()):
+            self.assertTrue(supervisor.init_worker_process(os.getppid()))
+            self.assertFalse(supervisor.init_worker_process(-1))
+        libc.prctl.assert_called_with(supervisor.PR_SET_PDEATHSIG, signal.SIGTERM)
@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import mock
+
+from source.lib.timing import Metrics, Histogram, StatsdExporter, FileExporter, SIZE_BUCKETS
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_disabled_metrics_measure_nothing(self):
+        metrics = Metrics()
+        metrics.add('hop.total', 0.1)
+        with mock.patch('source.lib.timing.time') as time_mock:
+            with metrics.timer('parse.meta'):
+                pass
+        self.assertFalse(time_mock.called)
+        self.assertEqual({}, metrics.take())
+
+    def test_timer_and_take(self):
+        """
+        timings pile up until taken, custom buckets apply by name
+        """
+        metrics = Metrics()
+        metrics.enable({'hop.size_download': SIZE_BUCKETS})
+        with mock.patch('source.lib.timing.time', mock.Mock(side_effect=[10, 10.03])):
+            with metrics.timer('parse.meta'):
+                pass
+        metrics.add('hop.size_download', 2000)
+        self.assertEqual({'parse.meta': {'count': 1, 'p50': 0.05, 'p99': 0.05},
+                          'hop.size_download': {'count': 1, 'p50': 4096, 'p99': 4096}}, metrics.get_stats())
+        histograms = metrics.take()
+        self.assertEqual(1, histograms['parse.meta'].count)
+        self.assertEqual({}, metrics.take())
+
+    def test_histogram_percentile(self):
+        histogram = Histogram((1, 2))
+        self.assertIsNone(histogram.get_percentile(0.5))
+        for value in (0.5, 1.5, 5):
+            histogram.add(value)
+        self.assertEqual([1, 1, 1], histogram.counts)
+        self.assertEqual(7, histogram.sum)
+        self.assertEqual(2, histogram.get_percentile(0.5))
+        self.assertEqual(4, histogram.get_percentile(0.99))
+
+    def test_statsd_format(self):
+        """
+        buckets are cumulative counters, empty leading buckets are skipped
+        """
+        histogram = Histogram((0.1, 0.5, 1))
+        for value in (0.2, 0.3, 2):
+            histogram.add(value)
+        exporter = StatsdExporter(('127.0.0.1', 8125), 'rc')
+        self.addCleanup(exporter.close)
+        self.assertEqual(['rc.hop.total.le_0_5:2|c', 'rc.hop.total.le_1:2|c', 'rc.hop.total.le_inf:3|c',
+                          'rc.hop.total.sum:2.500|c'], exporter.format('hop.total', histogram))
+
+    def test_statsd_export(self):
+        """
+        lines are split into datagrams under the packet size
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+        exporter = StatsdExporter(server.getsockname(), 'rc')
+        self.addCleanup(exporter.close)
+        histograms = {}
+        for index in xrange(50):
+            histograms['metric{:02d}'.format(index)] = histogram = Histogram((1,))
+            histogram.add(0.5)
+        exporter.export(histograms)
+        lines = []
+        while len(lines) < 150:
+            packet = server.recv(65536)
+            self.assertLessEqual(len(packet), 1432)
+            lines.extend(packet.split('\n'))
+        self.assertEqual(150, len(lines))
+        self.assertEqual('rc.metric00.le_1:1|c', lines[0])
+        self.assertEqual(0, exporter.dropped)
+
+    def test_file_export(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'metrics.log')
+        exporter = FileExporter(path)
+        histogram = Histogram((1,))
+        histogram.add(2)
+        exporter.export({'queue.ack': histogram})
+        exporter.export({})
+        exporter.export({'queue.ack': histogram})
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(2, len(records))
+        self.assertEqual(os.getpid(), records[0]['pid'])
+        self.assertEqual({'queue.ack': {'buckets': [1], 'counts': [0, 1], 'sum': 2}}, records[0]['histograms'])
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 from mock import patch, Mock
@@ -132,13 +135,56 @@ class UtilsTestCase(unittest.TestCase):
         queue.asser_called_once_with(host, port, space, name)
 
 
+    def test_take_tasks(self):
+        tube = mock.MagicMock()
+        tube.queue.space = 0
+        tube.opt = {'tube': 'url.queue'}
+        tube.queue.tnt.call.return_value = [('id1', 'url.queue', 'taken', 'data1'),
+                                            ('id2', 'url.queue', 'taken', 'data2')]
+        tasks = utils.take_tasks(tube, 10, 0.1)
+        tube.queue.tnt.call.assert_called_once_with('queue.take_batch', ('0', 'url.queue', '0.1', '10'))
+        self.assertEqual(['id1', 'id2'], [task.task_id for task in tasks])
+        self.assertEqual('data2', tasks[1].raw_data)
+        for task in tasks:
+            task.modified = True
+
+    def test_put_tasks(self):
+        tube = mock.MagicMock()
+        tube.queue.space = 0
+        tube.opt = {'tube': 'url.queue', 'ttl': 0, 'ttr': 0, 'pri': 0}
+        tube.serialize = lambda data: 'json:' + data
+        utils.put_tasks(tube, [('a', 0, None), ('b', 300, 5)])
+        tube.queue.tnt.call.assert_called_once_with('queue.put_batch', (
+            '0', 'url.queue', '0', '0', '0', '0', 'json:a', '300', '0', '0', '5', 'json:b'
+        ))
+        utils.put_tasks(tube, [])
+        self.assertEqual(1, tube.queue.tnt.call.call_count)
+
+    def test_ack_tasks(self):
+        tube = mock.MagicMock()
+        tube.queue.space = 0
+        tube.queue.tnt.call.return_value.rowcount = 2
+        tasks = [mock.Mock(task_id='id1', modified=False), mock.Mock(task_id='id2', modified=False)]
+        self.assertEqual(2, utils.ack_tasks(tube, tasks))
+        tube.queue.tnt.call.assert_called_once_with('queue.ack_batch', ('0', 'id1', 'id2'))
+        self.assertTrue(all(task.modified for task in tasks))
+        self.assertEqual(0, utils.ack_tasks(tube, []))
+
+    def test_get_tube_stats(self):
+        tube = mock.Mock()
+        tube.statistics.return_value = {'put': '10', 'tasks': {'ready': '3', 'taken': '2', 'delayed': '0'}}
+        self.assertEqual({'ready': 3, 'taken': 2, 'delayed': 0}, utils.get_tube_stats(tube))
+
+
     def test_spawn_workers(self):
         args = []
         num = 10
         with patch('lib.utils.Process', Mock()) as mock_process:
-            utils.spawn_workers(num, "target", args, num)
+            workers = utils.spawn_workers(num, "target", args, num)
             self.assertTrue(mock_process.called)
             self.assertEqual(mock_process.call_count, num)
+        self.assertEqual(num, len(workers))
+        self.assertIn('channel', mock_process.call_args[1]['kwargs'])
 
 
     def test_spawn_workers_fail(self):
@@ -161,4 +207,36 @@ class UtilsTestCase(unittest.TestCase):
         check_url = Mock()
         timeout = 123
         with patch('urllib2.urlopen', Mock(side_effect=ValueError("network status fail"))):
-            self.assertFalse(utils.check_network_status(check_url, timeout))
\ No newline at end of file
+            self.assertFalse(utils.check_network_status(check_url, timeout))
+    def test_load_counter_types_from_pyfile(self):
+        import os
+        from lib import COUNTER_TYPES
+        rules_file = os.path.join(os.path.dirname(__file__), '..', 'config', 'counter_rules.py')
+        counter_types = utils.load_counter_types_from_pyfile(rules_file)
+        self.assertEqual([(name, regexp.pattern) for name, regexp in COUNTER_TYPES], counter_types)
+
+    def test_create_private_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'state', 'checker')
+        utils.create_private_dir(path)
+        self.assertEqual(0700, os.stat(path).st_mode & 0777)
+        utils.create_private_dir(path)
+
+    def test_create_private_dir_rejects_shared(self):
+        """
+        a directory open to others, a symlink or a directory of another user is not used
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        link = os.path.join(directory, 'link')
+        os.symlink(directory, link)
+        self.assertRaises(OSError, utils.create_private_dir, link)
+        with patch('lib.utils.os.getuid', Mock(return_value=os.getuid() + 1)):
+            self.assertRaises(OSError, utils.create_private_dir, directory)
+        os.chmod(directory, 0755)
+        self.assertRaises(OSError, utils.create_private_dir, directory)
+
+    def test_load_counter_types_from_pyfile_no_rules(self):
+        with patch('lib.utils.exec_pyfile', Mock(return_value={'OTHER': 1})):
+            self.assertRaises(KeyError, utils.load_counter_types_from_pyfile, 'rules.py')
@@ -1,12 +1,24 @@
 from tarantool import DatabaseError
+import signal
 import unittest
 import mock
+import pycurl
 
-from source.lib import worker
+from source.lib import worker, get_redirect_history, ChainResult, ERROR_DNS, ERROR_CONNECT
+from source.lib.breaker import HostBreaker
+from source.lib.timing import StatsdExporter, FileExporter
+from source.lib.supervisor import DRAIN, PAUSE, RESUME, FLUSH, PROFILE
+from source.lib.utils import Config
 
 
 class WorkerTestCase(unittest.TestCase):
-    def test_get_redirect_history_from_task_error_and_no_recheck(self):
+    def setUp(self):
+        for target in ('source.lib.worker.init_worker_process', 'source.lib.worker.signal.signal'):
+            patcher = mock.patch(target, mock.Mock(return_value=True))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_result_from_history_error_and_no_recheck(self):
         """
         path with 'ERROR' in history_types and not is_recheck
         """
@@ -15,10 +27,10 @@ class WorkerTestCase(unittest.TestCase):
         is_input = True
         data_modified = task.data.copy()
         data_modified['recheck'] = True
-        with mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=(['ERROR'], [], []))):
-            self.assertEquals((is_input, data_modified), (worker.get_redirect_history_from_task(task, 1)))
+        data_modified['rechecks'] = 1
+        self.assertEquals((is_input, data_modified), worker.get_result_from_history(task, (['ERROR'], [], [])))
 
-    def test_get_redirect_history_from_task_error_(self):
+    def test_get_result_from_history_error_(self):
         """
         alter path
         """
@@ -27,10 +39,48 @@ class WorkerTestCase(unittest.TestCase):
         return_value = [['ERROR'], [], []]
         is_input = False
         data_modified = dict(url_id=task.data['url_id'], result=return_value, check_type='normal')
-        with mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=return_value)):
-            self.assertEquals((is_input, data_modified), worker.get_redirect_history_from_task(task, 1))
+        self.assertEquals((is_input, data_modified), worker.get_result_from_history(task, return_value))
+
+    def test_get_result_from_history_deadline_rechecked(self):
+        """
+        chain cut by the task deadline is rechecked like an error
+        """
+        task = mock.Mock()
+        task.data = dict(url='some_url', url_id='url_id')
+        is_input, data = worker.get_result_from_history(task, (['DEADLINE'], ['http://a.ru/', 'http://a.ru/'], []))
+        self.assertTrue(is_input)
+        self.assertTrue(data['recheck'])
+        self.assertEqual(1, data['rechecks'])
+        self.assertNotIn('resume', data)
+
+    def test_get_result_from_history_saves_progress(self):
+        """
+        a broken chain keeps the hops passed so far, the recheck resumes from the failed url
+        """
+        task = mock.Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id')
+        history = (['http_status', 'ERROR'], ['http://a.ru/', 'http://b.ru/', 'http://b.ru/'], [])
+        is_input, data = worker.get_result_from_history(task, history, max_rechecks=3)
+        self.assertTrue(is_input)
+        self.assertEqual([['http_status'], ['http://a.ru/', 'http://b.ru/']], data['resume'])
+        self.assertEqual(1, data['rechecks'])
 
-    def test_get_redirect_history_from_task_with_suspicious(self):
+    def test_get_result_from_history_max_rechecks(self):
+        """
+        rechecks stop at max_rechecks, the last result is the whole chain
+        """
+        task = mock.Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id', recheck=True, rechecks=2,
+                         resume=[['http_status'], ['http://a.ru/', 'http://b.ru/']])
+        history = (['http_status', 'ERROR'], ['http://a.ru/', 'http://b.ru/', 'http://b.ru/'], [])
+        is_input, data = worker.get_result_from_history(task, history, max_rechecks=3)
+        self.assertTrue(is_input)
+        self.assertEqual(3, data['rechecks'])
+        is_input, data = worker.get_result_from_history(task, history, max_rechecks=3)
+        self.assertFalse(is_input)
+        self.assertEqual(list(history), data['result'])
+
+    def test_get_result_from_history_with_suspicious(self):
         """
         with suspicious
         """
@@ -40,21 +90,19 @@ class WorkerTestCase(unittest.TestCase):
         is_input = False
         data_modified = dict(url_id=task.data['url_id'], result=return_value, check_type='normal',
                              suspicious=task.data['suspicious'])
-        with mock.patch('source.lib.worker.get_redirect_history', mock.Mock(return_value=return_value)):
-            self.assertEquals((is_input, data_modified), worker.get_redirect_history_from_task(task, 1))
+        self.assertEquals((is_input, data_modified), worker.get_result_from_history(task, return_value))
 
     def test_worker_parent_is_dead(self):
         """
-        let parent is dead - is_path_exists - false
+        parent died before the worker started - nothing is taken
         """
         config = mock.MagicMock()
         parent_pid = 123
         tube = mock.MagicMock()
         input_tube = mock.MagicMock()
         output_tube = mock.MagicMock()
-        is_path_exists = False
         with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)), \
-             mock.patch('os.path.exists', mock.Mock(return_value=is_path_exists)), \
+             mock.patch('source.lib.worker.init_worker_process', mock.Mock(return_value=False)), \
              mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[input_tube, output_tube])):
             worker.worker(config, parent_pid)
 
@@ -67,81 +115,534 @@ class WorkerTestCase(unittest.TestCase):
         config = mock.MagicMock()
         parent_pid = 123
         tube = mock.MagicMock()
-        input_tube_take = None
-        tube.take = mock.Mock(return_value=input_tube_take)
+        resolver = FakeResolver()
         with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
-             mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])),\
-             mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock())\
-                as get_redirect_history_from_task:
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)):
             worker.worker(config, parent_pid)
 
-        self.assertFalse(get_redirect_history_from_task.called)
+        self.assertEqual([], resolver.added)
 
-    def test_worker_result_is_none(self):
+    def test_finish_tasks_result_is_none(self):
         """
-        result is None.
+        task without result is only acked
         """
         config = mock.MagicMock()
-        parent_pid = 123
-        tube = mock.MagicMock()
-        is_result = None
-        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
-             mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])),\
-             mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=is_result)),\
-             mock.patch('source.lib.worker.logger', mock.Mock()) as logger:
-                        worker.worker(config, parent_pid)
+        task = mock.MagicMock()
+        input_tube = mock.MagicMock()
+        output_tube = mock.MagicMock()
+        with mock.patch('source.lib.worker.logger', mock.Mock()) as logger,\
+             mock.patch('source.lib.worker.put_tasks', mock.Mock()) as put_tasks,\
+             mock.patch('source.lib.worker.ack_tasks', mock.Mock(return_value=1)) as ack_tasks:
+            worker.finish_tasks([(task, None, None)], input_tube, output_tube, config)
         self.assertFalse(logger.debug.called)
+        self.assertEqual([mock.call(output_tube, []), mock.call(input_tube, [])], put_tasks.call_args_list)
+        ack_tasks.assert_called_once_with(input_tube, [task])
 
-    def test_worker_result_is_input(self):
+    def test_finish_tasks_puts_before_ack(self):
         """
-        is_input isnt none
+        results go to their queues in one call per queue, then all tasks are acked in one call
         """
         config = mock.MagicMock()
-        parent_pid = 123
-        tube = mock.MagicMock()
+        rechecked, checked = mock.MagicMock(), mock.MagicMock()
         input_tube = mock.MagicMock()
         output_tube = mock.MagicMock()
-        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
-             mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])),\
-             mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[input_tube, output_tube])),\
-             mock.patch('source.lib.worker.get_redirect_history_from_task',
-                        mock.Mock(return_value=['is_input', 'data'])),\
-             mock.patch('source.lib.worker.logger', mock.Mock()):
-            worker.worker(config, parent_pid)
-        self.assertFalse(output_tube.put.called)
+        calls = mock.Mock()
+        calls.ack_tasks.return_value = 2
+        with mock.patch('source.lib.worker.logger', mock.Mock()),\
+             mock.patch('source.lib.worker.put_tasks', calls.put_tasks),\
+             mock.patch('source.lib.worker.ack_tasks', calls.ack_tasks):
+            worker.finish_tasks([(rechecked, [True, 'recheck'], None), (checked, [False, 'data'], None)],
+                                input_tube, output_tube, config)
+        self.assertEqual([
+            mock.call.put_tasks(output_tube, [('data', 0, None)]),
+            mock.call.put_tasks(input_tube, [('recheck', config.RECHECK_DELAY, rechecked.meta()['pri'])]),
+            mock.call.ack_tasks(input_tube, [rechecked, checked]),
+        ], calls.mock_calls)
 
-    def test_worker_result_not_is_input(self):
+    def test_finish_tasks_recheck_delay(self):
         """
-        is_input is None
+        recheck is put with its own delay
         """
         config = mock.MagicMock()
-        parent_pid = 123
-        tube = mock.MagicMock()
+        task = mock.MagicMock()
         input_tube = mock.MagicMock()
-        output_tube = mock.MagicMock()
-        is_input = None
-        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
-             mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])),\
-             mock.patch('source.lib.worker.get_tube', mock.Mock(side_effect=[input_tube, output_tube])),\
-             mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=[is_input, 'data'])),\
-             mock.patch('source.lib.worker.logger', mock.Mock()):
-            worker.worker(config, parent_pid)
-        self.assertFalse(input_tube.put.called)
+        with mock.patch('source.lib.worker.logger', mock.Mock()),\
+             mock.patch('source.lib.worker.put_tasks', mock.Mock()) as put_tasks,\
+             mock.patch('source.lib.worker.ack_tasks', mock.Mock(return_value=1)):
+            worker.finish_tasks([(task, [True, 'data'], 900)], input_tube, mock.MagicMock(), config)
+        put_tasks.assert_called_with(input_tube, [('data', 900, task.meta()['pri'])])
 
-    def test_worker_not_result_database_error(self):
+    def test_finish_tasks_put_error_no_ack(self):
+        """
+        tasks are not acked when their results are not put
+        """
+        config = mock.MagicMock()
+        with mock.patch('source.lib.worker.put_tasks', mock.Mock(side_effect=DatabaseError)),\
+             mock.patch('source.lib.worker.ack_tasks', mock.Mock()) as ack_tasks:
+            self.assertRaises(DatabaseError, worker.finish_tasks, [(mock.MagicMock(), [False, 'data'], None)],
+                              mock.MagicMock(), mock.MagicMock(), config)
+        self.assertFalse(ack_tasks.called)
+
+    def test_finish_tasks_database_error(self):
         """
         Raise exception
         """
+        config = mock.MagicMock()
+        task = mock.MagicMock()
+        with mock.patch('source.lib.worker.logger', mock.Mock()) as logger,\
+             mock.patch('source.lib.worker.put_tasks', mock.Mock()),\
+             mock.patch('source.lib.worker.ack_tasks', mock.Mock(side_effect=DatabaseError)):
+            worker.finish_tasks([(task, None, None)], mock.MagicMock(), mock.MagicMock(), config)
+        self.assertTrue(logger.exception.called)
 
+    def test_finish_tasks_not_acked(self):
+        """
+        tasks the queue did not ack are logged
+        """
         config = mock.MagicMock()
-        parent_pid = 123
+        with mock.patch('source.lib.worker.logger', mock.Mock()) as logger,\
+             mock.patch('source.lib.worker.put_tasks', mock.Mock()),\
+             mock.patch('source.lib.worker.ack_tasks', mock.Mock(return_value=1)):
+            worker.finish_tasks([(mock.MagicMock(task_id='1'), None, None), (mock.MagicMock(task_id='2'), None, None)],
+                                mock.MagicMock(), mock.MagicMock(), config)
+        self.assertTrue(logger.warning.called)
+
+    def test_worker_fills_resolver(self):
+        """
+        takes tasks until MAX_TASKS_IN_FLIGHT are in the resolver
+        """
+        config = _worker_config(max_tasks_in_flight=3)
+        config.TAKE_BATCH_SIZE = 2
+        tube = mock.MagicMock()
+        tasks = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        resolver = FakeResolver()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(side_effect=[tasks[:2], tasks[2:]])) as take,\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.get_url_from_task', mock.Mock(side_effect=lambda task: task.url)),\
+             mock.patch('source.lib.worker.logger', mock.Mock()):
+            worker.worker(config, 123)
+        self.assertEqual([task.url for task in tasks], resolver.added)
+        self.assertEqual([mock.call(tube, 2, config.QUEUE_TAKE_TIMEOUT), mock.call(tube, 1, 0)], take.call_args_list)
+        self.assertTrue(resolver.closed)
+
+    def test_worker_stops_taking_when_hosts_are_busy(self):
+        """
+        no new tasks while MAX_TASKS_WAITING tasks wait for their hosts
+        """
+        config = _worker_config()
+        config.MAX_TASKS_WAITING = 1
+        tube = mock.MagicMock()
+        resolver = FakeResolver()
+        resolver.waiting = 1
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock()) as take,\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)):
+            worker.worker(config, 123)
+        self.assertFalse(take.called)
+
+    def test_worker_finishes_resolved_tasks(self):
+        """
+        resolved tasks are finished in one batch when the batch is full
+        """
+        config = _worker_config()
+        config.RESULT_BATCH_SIZE = 2
+        tube = mock.MagicMock()
+        tasks = [mock.MagicMock(), mock.MagicMock()]
+        history = [[], ['http://example.com/'], []]
+        resolver = FakeResolver(results=[(tasks[0], history), (tasks[1], history)])
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.get_result_from_history', mock.Mock(return_value=[False, 'data'])) \
+                as get_result_from_history,\
+             mock.patch('source.lib.worker.finish_tasks', mock.Mock()) as finish_tasks:
+            worker.worker(config, 123)
+        self.assertEqual([mock.call(tasks[0], history, config.RECHECK_MAX_ATTEMPTS),
+                          mock.call(tasks[1], history, config.RECHECK_MAX_ATTEMPTS)],
+                         get_result_from_history.call_args_list)
+        finish_tasks.assert_called_once_with([(tasks[0], [False, 'data'], config.RECHECK_DELAY),
+                                              (tasks[1], [False, 'data'], config.RECHECK_DELAY)],
+                                             tube, tube, config)
+
+    def test_worker_lingers_results(self):
+        """
+        results wait for the batch until RESULT_BATCH_LINGER, the rest are finished on exit
+        """
+        config = _worker_config()
         tube = mock.MagicMock()
         task = mock.MagicMock()
-        tube.take = mock.Mock(return_value=task)
-        task.ack = mock.Mock(side_effect=DatabaseError)
+        history = [[], ['http://example.com/'], []]
+        resolver = FakeResolver(results=[(task, history)])
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[], [DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.get_result_from_history', mock.Mock(return_value=[False, 'data'])),\
+             mock.patch('source.lib.worker.finish_tasks', mock.Mock()) as finish_tasks:
+            worker.worker(config, 123)
+        finish_tasks.assert_called_once_with([(task, [False, 'data'], config.RECHECK_DELAY)], tube, tube, config)
+        self.assertTrue(resolver.closed)
+
+    def test_worker_pause_and_resume(self):
+        """
+        on pause running tasks are released and no tasks are taken until resume
+        """
+        config = _worker_config()
+        tube = mock.MagicMock()
+        tasks = [mock.MagicMock(), mock.MagicMock()]
+        resolver = FakeResolver()
+        resolver.perform = lambda timeout: []
         with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
-             mock.patch('os.path.exists', mock.Mock(side_effect=[True, False])),\
-             mock.patch('source.lib.worker.get_redirect_history_from_task', mock.Mock(return_value=None)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(side_effect=[tasks, []])) as take,\
+             mock.patch('source.lib.worker.heartbeat',
+                        mock.Mock(side_effect=[[PAUSE], [], [RESUME], [DRAIN]])) as heartbeat,\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.get_url_from_task', mock.Mock(side_effect=lambda task: task.url)),\
+             mock.patch('source.lib.worker.logger', mock.Mock()):
+            worker.worker(config, 123)
+        for task in tasks:
+            task.release.assert_called_once_with()
+        self.assertEqual(2, take.call_count)
+        self.assertEqual(mock.call(None, 0, config.WORKER_HEARTBEAT_INTERVAL, False, mock.ANY),
+                         heartbeat.call_args_list[1])
+
+    def test_worker_recycles_after_task_limit(self):
+        """
+        worker over its task limit finishes its tasks, tells the parent and exits
+        """
+        config = _worker_config()
+        config.MAX_TASKS_PER_WORKER = 2
+        config.RECYCLE_JITTER = 0
+        config.RESULT_BATCH_SIZE = 2
+        tube = mock.MagicMock()
+        tasks = [mock.MagicMock(), mock.MagicMock()]
+        history = [[], ['http://example.com/'], []]
+        resolver = FakeResolver(results=[(tasks[0], history), (tasks[1], history)])
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])) as take,\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(return_value=[])) as heartbeat,\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.get_result_from_history', mock.Mock(return_value=[False, 'data'])),\
+             mock.patch('source.lib.worker.finish_tasks', mock.Mock()) as finish_tasks:
+            worker.worker(config, 123)
+        finish_tasks.assert_called_once_with(mock.ANY, tube, tube, config)
+        self.assertEqual(1, take.call_count)
+        self.assertEqual(mock.call(None, 0, 0, True, mock.ANY), heartbeat.call_args)
+        self.assertTrue(resolver.closed)
+
+    def test_worker_flush(self):
+        """
+        flush command drops idle connections and the DNS cache of the worker
+        """
+        config = _worker_config()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock())),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[FLUSH], [DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=FakeResolver())),\
+             mock.patch('source.lib.worker.reset_connections', mock.Mock()) as reset_connections:
+            worker.worker(config, 123)
+        reset_connections.assert_called_once_with()
+
+    def test_worker_exports_metrics_on_exit(self):
+        """
+        exporters are created once, metrics gathered since the last export are sent on exit
+        """
+        config = _worker_config()
+        exporter = mock.Mock()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock())),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=FakeResolver())),\
+             mock.patch('source.lib.worker.init_metrics', mock.Mock()) as init_metrics,\
+             mock.patch('source.lib.worker.export_metrics', mock.Mock()) as export_metrics,\
+             mock.patch('source.lib.worker.get_metrics_exporters',
+                        mock.Mock(return_value=[exporter])) as get_metrics_exporters:
+            worker.worker(config, 123)
+        get_metrics_exporters.assert_called_once_with(config)
+        init_metrics.assert_called_once_with()
+        export_metrics.assert_called_once_with([exporter])
+        exporter.close.assert_called_once_with()
+
+    def test_worker_profile(self):
+        """
+        profile command starts the profiler of the worker, its stacks are written on exit at the latest
+        """
+        config = _worker_config()
+        profiler = mock.Mock()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock())),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[(PROFILE, 5)], [DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=FakeResolver())):
+            profiler_class = mock.Mock(return_value=profiler)
+            worker.worker(config, 123, profiler_class=profiler_class)
+        profiler_class.assert_called_once_with('redirect_checker', '/tmp', 30, 0.01)
+        profiler.start.assert_called_once_with(5)
+        self.assertTrue(profiler.check.called)
+        profiler.stop.assert_called_once_with()
+
+    def test_worker_profile_off(self):
+        """
+        without a profiler class the worker ignores the profile command and keeps SIGUSR2 as is
+        """
+        config = _worker_config()
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=mock.MagicMock())),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[(PROFILE, 5)], [DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=FakeResolver())):
+            worker.worker(config, 123)
+        self.assertNotIn(signal.SIGUSR2, [args[0] for args, _ in worker.signal.signal.call_args_list])
+
+    def test_get_worker_status(self):
+        resolver = FakeResolver()
+        resolver.get_busy_hosts = mock.Mock(return_value=[('http://a.ru', 2)])
+        self.assertEqual({'state': 'idle', 'hosts': [('http://a.ru', 2)], 'tasks': 5, 'errors': 1},
+                         worker.get_worker_status(resolver, False, 5, 1))
+        self.assertEqual('paused', worker.get_worker_status(resolver, True, 5, 1)['state'])
+        resolver.waiting = 1
+        self.assertEqual('waiting_for_hosts', worker.get_worker_status(resolver, False, 5, 1)['state'])
+        resolver.in_flight = 1
+        self.assertEqual('fetching', worker.get_worker_status(resolver, False, 5, 1)['state'])
+        with mock.patch('source.lib.worker.drain_requested', True):
+            self.assertEqual('draining', worker.get_worker_status(resolver, False, 5, 1)['state'])
+
+    def test_get_recycle_reason(self):
+        config = _worker_config()
+        config.MAX_WORKER_RSS = 100 * 1024 * 1024
+        self.assertIsNone(worker.get_recycle_reason(9, 10, 50 * 1024 * 1024, config))
+        self.assertIn(u'10 tasks', worker.get_recycle_reason(10, 10, 0, config))
+        self.assertIn(u'150.0MB', worker.get_recycle_reason(1, 0, 150 * 1024 * 1024, config))
+        config.MAX_WORKER_RSS = 0
+        self.assertIsNone(worker.get_recycle_reason(1, 0, 150 * 1024 * 1024, config))
+
+    def test_get_task_limit(self):
+        """
+        limit is lowered by up to RECYCLE_JITTER, 0 stays unlimited
+        """
+        config = _worker_config()
+        config.MAX_TASKS_PER_WORKER = 1000
+        limits = set(worker.get_task_limit(config) for _ in xrange(20))
+        self.assertTrue(all(900 <= limit <= 1000 for limit in limits))
+        self.assertGreater(len(limits), 1)
+        config.MAX_TASKS_PER_WORKER = 0
+        self.assertEqual(0, worker.get_task_limit(config))
+
+    def test_release_tasks(self):
+        """
+        failed release does not stop the others
+        """
+        tasks = [mock.MagicMock(), mock.MagicMock()]
+        tasks[0].release.side_effect = DatabaseError('error')
+        with mock.patch('source.lib.worker.logger', mock.Mock()):
+            worker.release_tasks(tasks)
+        tasks[1].release.assert_called_once_with()
+
+    def test_worker_reloads_counter_rules(self):
+        """
+        counter rules are reloaded in the main loop after SIGHUP
+        """
+        config = _worker_config()
+        config.COUNTER_RULES_FILE = 'rules.py'
+        tube = mock.MagicMock()
+        resolver = FakeResolver()
+
+        def perform(timeout=1.0):
+            worker.request_counters_reload(signal.SIGHUP, None)
+            return []
+        resolver.perform = perform
+        with mock.patch('source.lib.worker.get_tube', mock.Mock(return_value=tube)),\
+             mock.patch('source.lib.worker.take_tasks', mock.Mock(return_value=[])),\
+             mock.patch('source.lib.worker.heartbeat', mock.Mock(side_effect=[[DRAIN]])),\
+             mock.patch('source.lib.worker.MultiRedirectResolver', mock.Mock(return_value=resolver)),\
+             mock.patch('source.lib.worker.signal.signal', mock.Mock()) as signal_mock,\
+             mock.patch('source.lib.worker.load_counter_rules', mock.Mock()) as load_counter_rules:
+            worker.worker(config, 123)
+        signal_mock.assert_any_call(signal.SIGHUP, worker.request_counters_reload)
+        self.assertEqual([mock.call(config), mock.call(config)], load_counter_rules.call_args_list)
+        self.assertFalse(worker.reload_counters)
+
+    def test_load_counter_rules(self):
+        """
+        rules from COUNTER_RULES_FILE are compiled into the counter matcher
+        """
+        config = _worker_config()
+        config.COUNTER_RULES_FILE = 'rules.py'
+        counter_types = [('EXAMPLE', r'.*example\.com/hit.*')]
+        with mock.patch('source.lib.worker.load_counter_types_from_pyfile', mock.Mock(return_value=counter_types)),\
+             mock.patch('source.lib.worker.set_counter_types', mock.Mock(return_value=1)) as set_counter_types:
+            worker.load_counter_rules(config)
+        set_counter_types.assert_called_once_with(counter_types)
+
+    def test_load_counter_rules_broken_file(self):
+        """
+        broken rules file is logged and the current rules are kept
+        """
+        config = _worker_config()
+        config.COUNTER_RULES_FILE = 'rules.py'
+        with mock.patch('source.lib.worker.load_counter_types_from_pyfile', mock.Mock(side_effect=SyntaxError())),\
+             mock.patch('source.lib.worker.set_counter_types', mock.Mock()) as set_counter_types,\
              mock.patch('source.lib.worker.logger', mock.Mock()) as logger:
-            worker.worker(config, parent_pid)
-        self.assertTrue(logger.exception.called)
\ No newline at end of file
+            worker.load_counter_rules(config)
+        self.assertFalse(set_counter_types.called)
+        self.assertTrue(logger.exception.called)
+
+    def test_load_counter_rules_builtin(self):
+        """
+        without COUNTER_RULES_FILE the built-in counters are used
+        """
+        with mock.patch('source.lib.worker.load_counter_types_from_pyfile', mock.Mock()) as load:
+            worker.load_counter_rules(_worker_config())
+        self.assertFalse(load.called)
+
+    def test_get_recheck_delay(self):
+        """
+        recheck waits for the host where the chain failed
+        """
+        config = _worker_config()
+        with mock.patch('source.lib.worker.get_url_retry_delay', mock.Mock(return_value=899.5)) as retry_delay:
+            self.assertEqual(900, worker.get_recheck_delay([['ERROR'], ['http://a.ru/', 'http://a.ru/'], []], config))
+            retry_delay.assert_called_once_with('http://a.ru/')
+            self.assertEqual(config.RECHECK_DELAY, worker.get_recheck_delay([[], ['http://a.ru/'], []], config))
+        with mock.patch('source.lib.worker.get_url_retry_delay', mock.Mock(return_value=0)):
+            self.assertEqual(config.RECHECK_DELAY,
+                             worker.get_recheck_delay([['ERROR'], ['http://a.ru/', 'http://a.ru/'], []], config))
+
+    def test_get_metrics_exporters(self):
+        config = _worker_config()
+        self.assertEqual([], worker.get_metrics_exporters(config))
+        config.METRICS_STATSD_ADDRESS = ('127.0.0.1', 8125)
+        config.METRICS_FILE = '/tmp/metrics.log'
+        exporters = worker.get_metrics_exporters(config)
+        self.addCleanup(exporters[0].close)
+        self.assertEqual([StatsdExporter, FileExporter], [type(exporter) for exporter in exporters])
+
+    def test_export_metrics(self):
+        """
+        histograms are taken once, a failed exporter does not stop the others
+        """
+        failed, exporter = mock.Mock(), mock.Mock()
+        failed.export.side_effect = IOError('disk full')
+        with mock.patch('source.lib.worker.metrics') as metrics:
+            worker.export_metrics([failed, exporter])
+        exporter.export.assert_called_once_with(metrics.take.return_value)
+        metrics.take.assert_called_once_with()
+
+    def test_get_recheck_delay_backoff(self):
+        """
+        the delay doubles with every recheck up to the cap of the error class, jitter only cuts it
+        """
+        config = _worker_config()
+        config.RECHECK_BACKOFF = {ERROR_DNS: (600, 3600)}
+        history = ChainResult(['ERROR'], ['http://a.ru/', 'http://a.ru/'], [], ERROR_DNS)
+        random = mock.Mock()
+        random.uniform.return_value = 0
+        with mock.patch('source.lib.worker.get_url_retry_delay', mock.Mock(return_value=0)):
+            self.assertEqual([600, 1200, 2400, 3600],
+                             [worker.get_recheck_delay(history, config, rechecks, random) for rechecks in (1, 2, 3, 4)])
+            random.uniform.return_value = 0.5
+            self.assertEqual(300, worker.get_recheck_delay(history, config, 1, random))
+            random.uniform.assert_called_with(0, config.RECHECK_JITTER)
+            # unknown class falls back to RECHECK_DELAY without growth
+            history.error = ERROR_CONNECT
+            self.assertEqual(150, worker.get_recheck_delay(history, config, 3, random))
+
+    def test_get_recheck_delay_sequential_history(self):
+        """
+        a chain checked hop by hop backs off by its error class like a batched one
+        """
+        config = _worker_config()
+        config.RECHECK_BACKOFF = {ERROR_DNS: (600, 3600)}
+        curl = mock.Mock()
+        curl.perform.side_effect = pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, 'no such host')
+        random = mock.Mock()
+        random.uniform.return_value = 0
+        with mock.patch('source.lib.host_breaker', HostBreaker()), \
+             mock.patch('source.lib.pycurl.Curl', mock.Mock(return_value=curl)), \
+             mock.patch('source.lib.worker.get_url_retry_delay', mock.Mock(return_value=0)):
+            history = get_redirect_history(u'http://a.ru/', 1, use_cache=False)
+            self.assertEqual(ERROR_DNS, history.error)
+            self.assertEqual(600, worker.get_recheck_delay(history, config, 1, random))
+
+
+class FakeResolver(object):
+    def __init__(self, results=()):
+        self.added = []
+        self.tags = []
+        self.in_flight = 0
+        self.results = list(results)
+        self.closed = False
+        self.waiting = 0
+
+    def __len__(self):
+        return self.in_flight
+
+    def add(self, url, tag=None, use_cache=True, resume=None):
+        self.added.append(url)
+        self.tags.append(tag)
+        self.in_flight += 1
+
+    def perform(self, timeout=1.0):
+        results, self.results = self.results, []
+        self.in_flight = 0
+        return results
+
+    def get_busy_hosts(self, limit=5):
+        return []
+
+    def cancel(self):
+        tags, self.tags = self.tags, []
+        self.in_flight = 0
+        return tags
+
+    def close(self):
+        self.closed = True
+        return []
+
+
+def _worker_config(max_tasks_in_flight=10):
+    config = Config()
+    config.INPUT_QUEUE_HOST = config.OUTPUT_QUEUE_HOST = 'localhost'
+    config.INPUT_QUEUE_PORT = config.OUTPUT_QUEUE_PORT = 33013
+    config.INPUT_QUEUE_SPACE = config.OUTPUT_QUEUE_SPACE = 0
+    config.INPUT_QUEUE_TUBE = 'url.queue'
+    config.OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
+    config.QUEUE_TAKE_TIMEOUT = 0.1
+    config.MAX_TASKS_IN_FLIGHT = max_tasks_in_flight
+    config.MAX_TASKS_WAITING = 100
+    config.TAKE_BATCH_SIZE = 10
+    config.RESULT_BATCH_SIZE = 20
+    config.RESULT_BATCH_LINGER = 0.2
+    config.HOST_CONCURRENCY_LIMITS = ()
+    config.HOST_CONCURRENCY_DEFAULT = 0
+    config.HTTP_TIMEOUT = 3
+    config.HTTP_CONNECT_TIMEOUT = 1
+    config.TASK_DEADLINE = 20
+    config.MAX_REDIRECTS = 30
+    config.USER_AGENT = 'ua'
+    config.MAX_CONTENT_SIZE = 1024
+    config.RECHECK_DELAY = 300
+    config.RECHECK_MAX_ATTEMPTS = 1
+    config.RECHECK_BACKOFF = {}
+    config.RECHECK_JITTER = 0
+    config.CURL_POOL_SIZE = 32
+    config.CURL_POOL_MAX_IDLE_TIME = 60
+    config.DNS_CACHE_TTL = 300
+    config.STATS_LOG_INTERVAL = 60
+    config.METRICS_INTERVAL = 10
+    config.METRICS_STATSD_ADDRESS = None
+    config.METRICS_PREFIX = 'redirect_checker'
+    config.METRICS_FILE = None
+    config.WORKER_HEARTBEAT_INTERVAL = 0
+    config.COUNTER_RULES_FILE = None
+    config.MAX_WORKER_RSS = 0
+    config.MAX_TASKS_PER_WORKER = 0
+    config.RECYCLE_JITTER = 0.1
+    config.PROFILE_DIR = '/tmp'
+    config.PROFILE_DURATION = 30
+    config.PROFILE_INTERVAL = 0.01
+    return config